@@ -0,0 +1,86 @@
+"""
+Peak memory vs. step time of the activation checkpointing policies.
+
+Example (one GPU):
+    python -m benchmarks.checkpoint_policy --models DiT-XL U-ViT-H --image_size 32 --in_chans 4 --batch_size 64
+
+On CPU, the peak-memory column is empty and the saved-activation column,
+which counts the tensors autograd keeps for backward, is the memory proxy.
+"""
+
+import argparse
+import json
+
+import torch
+
+from benchmarks.common import (
+    dummy_inputs,
+    model_args,
+    peak_memory_mb,
+    print_table,
+    saved_activation_mb,
+    time_fn,
+)
+from main import build_model
+from tools.nn import CHECKPOINT_POLICIES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark activation checkpointing policies")
+    parser.add_argument("--models", nargs="+", default=["ADM-64", "DiT-XL", "U-ViT-H"])
+    parser.add_argument("--policies", nargs="+", default=["default"] + CHECKPOINT_POLICIES,
+                        help="'default' leaves the model's own setting")
+    parser.add_argument("--checkpoint_every", type=int, default=2)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--in_chans", type=int, default=3)
+    parser.add_argument("--patch_size", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--amp", action="store_true", help="Run the forward under bf16 autocast")
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file")
+    return parser.parse_args()
+
+
+def bench(args, name, policy):
+    margs = model_args(
+        name, image_size=args.image_size, in_chans=args.in_chans, patch_size=args.patch_size,
+        checkpoint_policy=None if policy == "default" else policy,
+        checkpoint_every=args.checkpoint_every,
+    )
+    model = build_model(margs).to(args.device).train()
+    x, t, y = dummy_inputs(margs, args.batch_size, args.device)
+
+    def step():
+        with torch.autocast(torch.device(args.device).type, dtype=torch.bfloat16, enabled=args.amp):
+            out = model(x, t, y)
+        out.float().square().mean().backward()
+        model.zero_grad(set_to_none=True)
+
+    row = dict(
+        model=name,
+        policy=policy,
+        step_ms=time_fn(step, args.device, iters=args.iters),
+        peak_mb=peak_memory_mb(step, args.device),
+        saved_mb=saved_activation_mb(step, model.parameters()),
+    )
+    del model
+    return row
+
+
+def main():
+    args = parse_args()
+    rows = []
+    for name in args.models:
+        for policy in args.policies:
+            rows.append(bench(args, name, policy))
+            print(f"{name} / {policy}: {rows[-1]['step_ms']:.1f} ms")
+    print()
+    print_table(rows, ["model", "policy", "step_ms", "peak_mb", "saved_mb"])
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
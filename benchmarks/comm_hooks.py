@@ -0,0 +1,152 @@
+"""
+Gradient compression of DDP (--ddp_comm_hook) over gloo on CPU processes.
+
+Spawns --world_size processes and trains the same model from the same
+initialisation on the same per-rank batches with each hook. Reports:
+  mb_per_step  MiB all-reduced per rank and step, after --powersgd_start_iter
+  step_ms      median wall-clock time per training step
+  final_loss   diffusion loss at the last step, averaged over ranks
+  max_dloss    largest difference of the per-step loss to the uncompressed run
+
+gloo on one machine is far faster than a real interconnect, so step times
+mostly show the compression overhead; bytes are what scale to multi-node.
+
+Example:
+    python -m benchmarks.comm_hooks --model DiT-S --world_size 2 --steps 30 --hooks none fp16 powersgd
+"""
+
+import argparse
+import copy
+import os
+import statistics
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from benchmarks.common import model_args, print_table
+from main import build_model
+from tools.comm_hooks import COMM_HOOKS, build_comm_hook
+from tools.gaussian_diffusion import (
+    GaussianDiffusion,
+    LossType,
+    ModelMeanType,
+    ModelVarType,
+    get_named_beta_schedule,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare DDP gradient compression hooks over gloo")
+    parser.add_argument("--model", type=str, default="DiT-S")
+    parser.add_argument("--image_size", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=8, help="Per-rank batch size")
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--hooks", nargs="+", default=["none", "fp16", "powersgd"], choices=COMM_HOOKS,
+                        help="bf16 needs a gloo build with bfloat16 all-reduce")
+    parser.add_argument("--powersgd_rank", type=int, default=4)
+    parser.add_argument("--powersgd_start_iter", type=int, default=2)
+    parser.add_argument("--powersgd_warm_start", type=int, default=1)
+    parser.add_argument("--port", type=str, default="29519")
+    return parser.parse_args()
+
+
+class AllReduceCounter:
+    """Counts the bytes passed to dist.all_reduce while active."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.active = False
+        self._all_reduce = dist.all_reduce
+
+    def __enter__(self):
+        def counted(tensor, *args, **kwargs):
+            if self.active:
+                self.bytes += tensor.numel() * tensor.element_size()
+            return self._all_reduce(tensor, *args, **kwargs)
+
+        # The hooks look up dist.all_reduce when they run
+        dist.all_reduce = counted
+        return self
+
+    def __exit__(self, *exc):
+        dist.all_reduce = self._all_reduce
+
+
+def run_hook(rank, bench, hook, reference):
+    hook_args = argparse.Namespace(ddp_comm_hook=hook, powersgd_rank=bench.powersgd_rank,
+                                   powersgd_start_iter=bench.powersgd_start_iter,
+                                   powersgd_warm_start=bool(bench.powersgd_warm_start), seed=0)
+    model = DDP(copy.deepcopy(reference))
+    state, comm_hook = build_comm_hook(hook_args)
+    model.register_comm_hook(state=state, hook=comm_hook)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=bench.lr)
+    diffusion = GaussianDiffusion(
+        betas=get_named_beta_schedule("linear", 1000, 1), model_mean_type=ModelMeanType.EPSILON,
+        model_var_type=ModelVarType.FIXED_LARGE, loss_type=LossType.MSE, rescale_timesteps=True, gamma=0,
+    )
+    # Compressed steps only: PowerSGD all-reduces uncompressed before its start iteration
+    warmup = max(2, bench.powersgd_start_iter) if hook == "powersgd" else 0
+    losses, times, counted_bytes = [], [], []
+    with AllReduceCounter() as counter:
+        for step in range(bench.steps):
+            g = torch.Generator().manual_seed(1000 * step + rank)
+            x = torch.randn(bench.batch_size, 3, bench.image_size, bench.image_size, generator=g)
+            t = torch.randint(0, 1000, (bench.batch_size,), generator=g)
+            noise = torch.randn(x.shape, generator=g)
+            y = torch.randint(0, 10, (bench.batch_size,), generator=g)
+
+            start = time.perf_counter()
+            loss = diffusion.training_losses(model, x, t=t, model_kwargs={"y": y}, noise=noise)["loss"].mean()
+            counter.bytes, counter.active = 0, True
+            loss.backward()
+            counter.active = False
+            optimizer.step()
+            optimizer.zero_grad()
+            times.append((time.perf_counter() - start) * 1000)
+            if step >= warmup:
+                counted_bytes.append(counter.bytes)
+
+            loss = loss.detach()
+            dist.all_reduce(loss)
+            losses.append(loss.item() / dist.get_world_size())
+    return {
+        "mb_per_step": statistics.mean(counted_bytes) / 2 ** 20 if counted_bytes else None,
+        "step_ms": statistics.median(times),
+        "losses": losses,
+    }
+
+
+def worker(rank, bench):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=bench.port)
+    dist.init_process_group("gloo", rank=rank, world_size=bench.world_size)
+    torch.manual_seed(0)
+    reference = build_model(model_args(bench.model, image_size=bench.image_size, num_classes=10))
+    results = {hook: run_hook(rank, bench, hook, reference) for hook in bench.hooks}
+
+    if rank == 0:
+        baseline = results.get("none")
+        rows = []
+        for hook, result in results.items():
+            dloss = None
+            if baseline is not None:
+                dloss = max(abs(a - b) for a, b in zip(result["losses"], baseline["losses"]))
+            rows.append({"hook": hook, "mb_per_step": result["mb_per_step"], "step_ms": result["step_ms"],
+                         "final_loss": result["losses"][-1], "max_dloss": dloss})
+        params = sum(p.numel() for p in reference.parameters())
+        print(f"{bench.model}: {params / 1e6:.2f} M params, {bench.world_size} gloo ranks, {bench.steps} steps")
+        print_table(rows, ["hook", "mb_per_step", "step_ms", "final_loss", "max_dloss"])
+    dist.destroy_process_group()
+
+
+def main():
+    bench = parse_args()
+    mp.spawn(worker, args=(bench,), nprocs=bench.world_size, join=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Run the scripts from the repository root as modules, e.g.
+    python -m benchmarks.checkpoint_policy --models DiT-XL U-ViT-H
+"""
+
+import argparse
+import statistics
+import time
+
+import torch
+
+
+def model_args(model, **overrides):
+    """
+    Build the minimal argument namespace main.build_model() needs.
+    """
+    args = dict(
+        model=model,
+        image_size=32,
+        patch_size=2,
+        in_chans=3,
+        num_classes=1000,
+        class_cond=True,
+        learn_sigma=False,
+        dropout=0.0,
+        drop_label_prob=0.0,
+        checkpoint_policy=None,
+        checkpoint_every=2,
+    )
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def dummy_inputs(args, batch_size, device):
+    """
+    Random images, timesteps and labels matching `args`.
+    """
+    x = torch.randn(batch_size, args.in_chans, args.image_size, args.image_size, device=device)
+    t = torch.randint(0, 1000, (batch_size,), device=device)
+    y = torch.randint(0, args.num_classes, (batch_size,), device=device)
+    return x, t, y
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, device, warmup=2, iters=10):
+    """
+    Return the median wall-clock time of `fn()` in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        synchronize(device)
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def peak_memory_mb(fn, device):
+    """
+    Return the CUDA peak memory of one call of `fn()` in MiB, or None on CPU.
+    """
+    if torch.device(device).type != "cuda":
+        return None
+    synchronize(device)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    fn()
+    synchronize(device)
+    return torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+
+def saved_activation_mb(fn, params=()):
+    """
+    Return the size in MiB of the tensors autograd keeps for backward while
+    running `fn()`. Works on any device; storages are counted once, and those
+    of `params` are excluded.
+
+    Tensors saved inside a checkpointed region are dropped and recomputed, so
+    they are not counted.
+    """
+    exclude = {p.untyped_storage().data_ptr() for p in params}
+    storages = {}
+
+    def pack(x):
+        storage = x.untyped_storage()
+        if storage.data_ptr() not in exclude:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return x
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        fn()
+    return sum(storages.values()) / 2 ** 20
+
+
+def print_table(rows, columns):
+    """
+    Print a list of dicts as an aligned text table.
+    """
+    def fmt(v):
+        if v is None:
+            return "-"
+        if isinstance(v, float):
+            return f"{v:.2f}"
+        return str(v)
+
+    widths = [max(len(c), *(len(fmt(r[c])) for r in rows)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print("  ".join(fmt(r[c]).ljust(w) for c, w in zip(columns, widths)))
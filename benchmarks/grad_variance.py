@@ -0,0 +1,116 @@
+"""
+Variance of the training gradient under different batch constructions.
+
+For a fixed model (an exported weights file, see export.py) and a few fixed
+data batches, the loss gradient is computed for --draws independent draws of
+timesteps and noise per batch. The variance is the mean squared distance of
+the draws' gradients to their mean, averaged over the batches. Each
+construction is reported relative to i.i.d. timesteps and noise.
+
+Constructions: iid, stratified (--stratify_timesteps rank), antithetic
+(--antithetic_noise), stratified+antithetic, and repeats2 (--noise_repeats 2:
+half the images, each twice, with stratified timesteps and antithetic pairs).
+
+Dataset flags are parsed like main.py's and passed after the tool's own:
+    python -m benchmarks.grad_variance --weights dit_s.pt --batches 4 --draws 16 \\
+        --dataset Latent --data_dir ./ImageNet/ImageNet_256/ImageNet.h5 --batch_size 128
+"""
+
+import argparse
+
+import torch
+
+from main import build_dataset, build_diffusion, build_model
+from main import parse_args as parse_train_args
+from tools.batch_sampling import BatchConstructor, repeat_batch
+from tools.utils import load_inference_checkpoint
+
+CONSTRUCTIONS = {
+    "iid": dict(),
+    "stratified": dict(stratify="rank"),
+    "antithetic": dict(antithetic=True),
+    "stratified+antithetic": dict(stratify="rank", antithetic=True),
+    "repeats2": dict(stratify="rank", antithetic=True, repeats=2),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare gradient variance of batch constructions")
+    parser.add_argument("--weights", type=str, required=True, help="Exported weights file (export.py)")
+    parser.add_argument("--constructions", nargs="+", default=list(CONSTRUCTIONS), choices=list(CONSTRUCTIONS))
+    parser.add_argument("--batches", type=int, default=4, help="Number of fixed data batches")
+    parser.add_argument("--draws", type=int, default=16, help="Draws of timesteps and noise per batch")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_known_args()
+
+
+def flat_grad(model):
+    return torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+
+
+def gradient_variance(model, diffusion, config, batches, construction, draws, device):
+    """Mean over batches of E||g - E[g]||^2 over draws of t and noise."""
+    repeats = construction.get("repeats", 1)
+    constructor = BatchConstructor(
+        getattr(diffusion, "num_timesteps", None), stratify=construction.get("stratify", "none"),
+        antithetic=construction.get("antithetic", False))
+    variances = []
+    for images, labels in batches:
+        images, labels = images.to(device), labels.to(device)
+        # Same number of loss terms as the other constructions
+        images, labels = repeat_batch(images[: len(images) // repeats], labels[: len(labels) // repeats], repeats)
+        grad_sum, grad_sq_sum = 0, 0
+        for _ in range(draws):
+            x = images
+            if config["in_chans"] == 4:
+                mean, std = torch.chunk(images, 2, dim=1)
+                x = (mean + std * torch.randn_like(mean)) * config["latent_scale"]
+            t, noise = constructor(x)
+            model_kwargs = {"y": labels} if config["class_cond"] else {}
+            loss = diffusion.training_losses(model, x, t=t, model_kwargs=model_kwargs, noise=noise)["loss"].mean()
+            model.zero_grad(set_to_none=True)
+            loss.backward()
+            g = flat_grad(model).double()
+            grad_sum = grad_sum + g
+            grad_sq_sum = grad_sq_sum + g.square().sum()
+        mean_grad = grad_sum / draws
+        variances.append((grad_sq_sum / draws - mean_grad.square().sum()).item() * draws / (draws - 1))
+    return sum(variances) / len(variances)
+
+
+def main():
+    args, train_argv = parse_args()
+    model, config = load_inference_checkpoint(args.weights, build_model, args.device)
+    # Gradients of the EMA weights, with dropout off for a deterministic forward
+    model.eval()
+    train_args = parse_train_args(train_argv)
+    for key, value in config.items():
+        setattr(train_args, key, value)
+    train_args.parallel, train_args.noise_repeats = False, 1
+    diffusion = build_diffusion(train_args)
+
+    torch.manual_seed(0)
+    train_loader, _ = build_dataset(train_args)
+    batches = []
+    for images, labels in train_loader:
+        batches.append((images, labels))
+        if len(batches) == args.batches:
+            break
+
+    results = {}
+    for name in args.constructions:
+        torch.manual_seed(0)
+        results[name] = gradient_variance(model, diffusion, config, batches, CONSTRUCTIONS[name],
+                                          args.draws, args.device)
+        print(f"{name}: {results[name]:.4e}")
+
+    reference = results.get("iid")
+    print()
+    print(f"{'construction':<24}{'grad variance':>16}{'vs iid':>10}")
+    for name, value in results.items():
+        ratio = f"{value / reference:.3f}" if reference else "-"
+        print(f"{name:<24}{value:>16.4e}{ratio:>10}")
+
+
+if __name__ == "__main__":
+    main()
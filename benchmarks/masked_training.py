@@ -0,0 +1,108 @@
+"""
+Cost and convergence of masked-token training (--mask_ratio).
+
+For each mask ratio this measures, on a DiT or ViT at a fixed batch size:
+  gflops       forward FLOPs of the training step (the mask decoder included)
+  step_ms      forward + backward wall-clock time
+  speedup      step time of the unmasked model over that of the masked one
+With --fid, each ratio is also trained in its own run of main.py (flags
+after "--" are passed through, as in benchmarks.timestep_sampler_convergence)
+and the FID (EMA) at every evaluation step is joined into a second table,
+so the savings per step can be weighed against the FID reached at a step.
+
+Examples:
+    python -m benchmarks.masked_training --model DiT-XL --mask_ratios 0 0.5 0.75 --mask_decoder_depth 2
+    python -m benchmarks.masked_training --model DiT-S --fid -- \\
+        --dataset Latent --data_dir ./ImageNet/ImageNet_256/ImageNet.h5 --total_steps 100000 --eval_step 20000
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+import torch
+
+from benchmarks.common import dummy_inputs, model_args, print_table, time_fn
+from benchmarks.model_bench import count_flops
+from benchmarks.timestep_sampler_convergence import read_fid
+from main import build_model
+from tools import masking
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark masked-token training")
+    parser.add_argument("--model", type=str, default="DiT-XL", choices=["DiT-S", "DiT-B", "DiT-L", "DiT-XL",
+                                                                      "ViT-S", "ViT-B", "ViT-L", "ViT-XL"])
+    parser.add_argument("--mask_ratios", type=float, nargs="+", default=[0.0, 0.25, 0.5, 0.75])
+    parser.add_argument("--mask_decoder_depth", type=int, default=2)
+    parser.add_argument("--image_size", type=int, default=32, help="Latent resolution")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--fid", action="store_true", help="Also train every ratio with main.py and report FID")
+    parser.add_argument("--logdir", type=str, default="./logs/masked_training", help="One sub-directory per ratio")
+    parser.add_argument("--nproc_per_node", type=int, default=1, help="Launch each run with torchrun on this many processes")
+    return parser.parse_known_args()
+
+
+def step_cost(args, model, margs, mask_ratio):
+    x, t, y = dummy_inputs(margs, args.batch_size, args.device)
+    num_tokens = (margs.image_size // margs.patch_size) ** 2
+    kwargs = {}
+    if mask_ratio > 0:
+        kwargs["token_mask"] = masking.random_token_mask(args.batch_size, num_tokens, mask_ratio, args.device)
+
+    def fwd_bwd():
+        model(x, t, y, **kwargs).float().square().mean().backward()
+        model.zero_grad(set_to_none=True)
+
+    model.train()
+    gflops = count_flops(model, (x, t, y), **kwargs) / 1e9
+    return dict(mask_ratio=mask_ratio, gflops=gflops, step_ms=time_fn(fwd_bwd, args.device, iters=args.iters))
+
+
+def train(mask_ratio, logdir, args, train_argv):
+    if args.nproc_per_node > 1:
+        launcher = [sys.executable, "-m", "torch.distributed.run", f"--nproc_per_node={args.nproc_per_node}"]
+        train_argv = train_argv + ["--parallel", "True"]
+    else:
+        launcher = [sys.executable]
+    command = launcher + ["main.py", *train_argv, "--model", args.model, "--mask_ratio", str(mask_ratio),
+                          "--mask_decoder_depth", str(args.mask_decoder_depth), "--logdir", logdir,
+                          "--train", "True", "--eval", "True"]
+    print(" ".join(command))
+    subprocess.run(command, check=True)
+
+
+def main():
+    args, train_argv = parse_args()
+    if train_argv and train_argv[0] == "--":
+        train_argv = train_argv[1:]
+
+    margs = model_args(args.model, image_size=args.image_size, in_chans=4, patch_size=2,
+                       mask_decoder_depth=args.mask_decoder_depth)
+    torch.manual_seed(0)
+    model = build_model(margs).to(args.device)
+    rows = [step_cost(args, model, margs, ratio) for ratio in args.mask_ratios]
+    reference = next((r["step_ms"] for r in rows if r["mask_ratio"] == 0), None)
+    for row in rows:
+        row["speedup"] = reference / row["step_ms"] if reference else None
+    print_table(rows, ["mask_ratio", "gflops", "step_ms", "speedup"])
+    del model
+
+    if not args.fid:
+        return
+    results = {}
+    for ratio in args.mask_ratios:
+        logdir = os.path.join(args.logdir, f"mask_{ratio:g}")
+        train(ratio, logdir, args, train_argv)
+        results[f"mask_{ratio:g}"] = read_fid(logdir)
+    steps = sorted({step for fid in results.values() for step in fid})
+    print()
+    print_table([{"step": step, **{k: v.get(step) for k, v in results.items()}} for step in steps],
+                ["step", *results])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Training and sampling cost of every model variant.
+
+For each variant built through main.build_model, and each batch size and
+precision, this measures:
+  fwd_ms          training-mode forward (autograd recording)
+  fwd_bwd_ms      forward + backward
+  sample_step_ms  one denoiser call as in sampling (eval, no_grad)
+  peak_mb         CUDA peak memory of forward + backward (saved_mb on CPU)
+together with the parameter count and the analytic forward GFLOPs (matmuls
+and convolutions, attention included, counted by forward hooks).
+
+Examples:
+    python -m benchmarks.model_bench --batch_sizes 32 64 --precisions fp32 bf16 --json bench.json
+    python -m benchmarks.model_bench --small --csv bench.csv   # CPU / CI
+"""
+
+import argparse
+import csv
+import json
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import (
+    dummy_inputs,
+    model_args,
+    peak_memory_mb,
+    print_table,
+    saved_activation_mb,
+    time_fn,
+)
+from main import build_model, model_variants
+from models.attention import ATTENTION_BACKENDS, Attention as TokenAttention, set_attention_backend
+from models.unet import QKVAttention, QKVAttentionLegacy, count_flops_attn, count_flops_token_attn
+from models.vit import Attention as ViTAttention
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark every model variant")
+    parser.add_argument("--models", nargs="+", default=model_variants, choices=model_variants)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16"], choices=list(PRECISIONS))
+    parser.add_argument("--small", action="store_true",
+                        help="Reduced image sizes, batch sizes and iterations, e.g. for CPU runs in CI")
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--attention_backend", type=str, default="sdpa", choices=list(ATTENTION_BACKENDS))
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--json", type=str, default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--csv", type=str, default=None, help="Write the results as CSV to this file")
+    args = parser.parse_args()
+    if args.small:
+        args.batch_sizes = [1, 2]
+        args.iters = 2
+    return args
+
+
+def variant_args(name, small):
+    """
+    Input geometry of a variant: pixel-space UNets at the resolution in their
+    name, latent-space models (LDM and the transformers) on 4-channel latents.
+    The UNets are fully convolutional, so `small` runs them at 1/8 of their
+    resolution, which still fits all their downsampling stages.
+    """
+    if name == "LDM" or not any(x in name for x in ["UNet", "ADM"]):
+        return model_args(name, image_size=8 if small else 32, in_chans=4, patch_size=2)
+    image_size = int(name.split("-")[-1])
+    return model_args(name, image_size=max(image_size // 8, 8) if small else image_size)
+
+
+def count_flops(model, inputs, **kwargs):
+    """
+    Forward FLOPs (2 x multiply-accumulates) of linear layers, convolutions
+    and attention matmuls, using the thop-style counters of models/unet.py.
+    `kwargs` are passed to the model.
+    """
+    counters = {
+        QKVAttention: lambda m, x, y: count_flops_attn(m, x, (y,)),
+        QKVAttentionLegacy: lambda m, x, y: count_flops_attn(m, x, (y,)),
+        TokenAttention: count_flops_token_attn,
+        ViTAttention: count_flops_token_attn,
+        nn.Linear: _count_linear,
+        nn.Conv1d: _count_conv,
+        nn.Conv2d: _count_conv,
+    }
+    handles = []
+    for m in model.modules():
+        counter = counters.get(type(m))
+        if counter is not None:
+            m.total_ops = torch.zeros(1, dtype=torch.float64)
+            handles.append(m.register_forward_hook(counter))
+    with torch.no_grad():
+        model(*inputs, **kwargs)
+    macs = sum(m.total_ops.item() for m in model.modules() if hasattr(m, "total_ops"))
+    for h in handles:
+        h.remove()
+    for m in model.modules():
+        if hasattr(m, "total_ops"):
+            del m.total_ops
+    return 2 * macs
+
+
+def _count_linear(m, _x, y):
+    m.total_ops += torch.DoubleTensor([y.numel() * m.in_features])
+
+
+def _count_conv(m, _x, y):
+    kernel_ops = (m.in_channels // m.groups) * int(torch.tensor(m.kernel_size).prod())
+    m.total_ops += torch.DoubleTensor([y.numel() * kernel_ops])
+
+
+def bench(args, name):
+    margs = variant_args(name, args.small)
+    model = build_model(margs).to(args.device)
+    params = sum(p.numel() for p in model.parameters())
+    flops_per_sample = count_flops(model.eval(), dummy_inputs(margs, 1, args.device))
+
+    rows = []
+    device_type = torch.device(args.device).type
+    for precision in args.precisions:
+        dtype = PRECISIONS[precision]
+        if device_type == "cpu" and dtype == torch.float16:
+            continue  # no fp16 autocast on CPU
+        for batch_size in args.batch_sizes:
+            x, t, y = dummy_inputs(margs, batch_size, args.device)
+
+            def forward():
+                with torch.autocast(device_type, dtype=dtype or torch.bfloat16, enabled=dtype is not None):
+                    return model(x, t, y)
+
+            def fwd():
+                model.train()
+                forward()
+
+            def fwd_bwd():
+                model.train()
+                forward().float().square().mean().backward()
+                model.zero_grad(set_to_none=True)
+
+            @torch.no_grad()
+            def sample_step():
+                model.eval()
+                forward()
+
+            try:
+                row = dict(
+                    model=name, batch_size=batch_size, precision=precision,
+                    image_size=margs.image_size, params_m=params / 1e6,
+                    gflops=flops_per_sample * batch_size / 1e9,
+                    fwd_ms=time_fn(fwd, args.device, iters=args.iters),
+                    fwd_bwd_ms=time_fn(fwd_bwd, args.device, iters=args.iters),
+                    sample_step_ms=time_fn(sample_step, args.device, iters=args.iters),
+                    peak_mb=peak_memory_mb(fwd_bwd, args.device),
+                    saved_mb=saved_activation_mb(fwd_bwd, model.parameters()),
+                )
+            except torch.cuda.OutOfMemoryError:
+                row = dict(model=name, batch_size=batch_size, precision=precision, error="OOM")
+                torch.cuda.empty_cache()
+            rows.append(row)
+            print(f"{name} bs={batch_size} {precision}: {row.get('fwd_bwd_ms', 'OOM')}")
+    del model
+    return rows
+
+
+def main():
+    args = parse_args()
+    set_attention_backend(args.attention_backend)
+    rows = []
+    for name in args.models:
+        rows.extend(bench(args, name))
+
+    columns = ["model", "batch_size", "precision", "image_size", "params_m", "gflops",
+               "fwd_ms", "fwd_bwd_ms", "sample_step_ms", "peak_mb", "saved_mb"]
+    print()
+    print_table([{c: r.get(c) for c in columns} for r in rows], columns)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns + ["error"], restval="")
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Throughput and convergence of --noise_repeats.
+
+Trains the same model from the same initialisation with each number of
+repeats k at a fixed effective batch size, on a synthetic latent dataset
+whose loading costs --io_ms per image (as a stand-in for an I/O-bound
+loader). For each k this reports:
+  images_per_s  images the loader has to deliver per second
+  step_ms       wall-clock time per training step, data wait included
+  eval_loss     denoising loss on a fixed set of images, timesteps and noise
+                after --steps steps (lower is better)
+
+Repeating images cuts the loader's work by k, so I/O-bound steps get up to
+k times faster, but the k copies of an image give correlated gradients:
+per step, k > 1 usually converges somewhat slower than fresh images. The
+stratified timesteps of the copies recover part of that.
+
+Example:
+    python -m benchmarks.noise_repeats --repeats 1 2 4 --io_ms 2 --steps 200
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from benchmarks.common import model_args, print_table
+from main import build_model
+from tools import batch_sampling
+from tools.gaussian_diffusion import (
+    GaussianDiffusion,
+    LossType,
+    ModelMeanType,
+    ModelVarType,
+    get_named_beta_schedule,
+)
+
+
+class SlowLatents(Dataset):
+    """Fixed random latents whose every access sleeps for `io_ms`."""
+
+    def __init__(self, num, shape, num_classes, io_ms):
+        g = torch.Generator().manual_seed(0)
+        # A low-rank dataset, so that there is something to learn
+        basis = torch.randn(8, *shape, generator=g)
+        self.images = torch.einsum("nk,k...->n...", torch.randn(num, 8, generator=g), basis) / 8 ** 0.5
+        self.labels = torch.randint(0, num_classes, (num,), generator=g)
+        self.io_ms = io_ms
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        time.sleep(self.io_ms / 1000)
+        return self.images[i], self.labels[i]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark --noise_repeats")
+    parser.add_argument("--model", type=str, default="DiT-S")
+    parser.add_argument("--repeats", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch_size", type=int, default=64, help="Effective batch size")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--io_ms", type=float, default=2.0, help="Simulated loading time per image")
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--stratified", default=True, type=lambda v: v.lower() in ("true", "1"))
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def eval_loss(model, diffusion, dataset, device):
+    g = torch.Generator().manual_seed(1)
+    x = dataset.images[:256].to(device)
+    y = dataset.labels[:256].to(device)
+    t = torch.linspace(0, diffusion.num_timesteps - 1, len(x)).long().to(device)
+    noise = torch.randn(x.shape, generator=g).to(device)
+    model.eval()
+    loss = diffusion.training_losses(model, x, t=t, model_kwargs={"y": y}, noise=noise)["loss"].mean()
+    model.train()
+    return loss.item()
+
+
+def run(args, k, init_model, diffusion, dataset):
+    device = args.device
+    model = copy.deepcopy(init_model).to(device).train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    loader = DataLoader(dataset, batch_size=args.batch_size // k, shuffle=True, drop_last=True,
+                        num_workers=args.num_workers, persistent_workers=args.num_workers > 0)
+    torch.manual_seed(0)
+    iterator = iter(loader)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        try:
+            images, labels = next(iterator)
+        except StopIteration:
+            iterator = iter(loader)
+            images, labels = next(iterator)
+        images, labels = batch_sampling.repeat_batch(images.to(device), labels.to(device), k)
+        t = None
+        if k > 1 and args.stratified:
+            t = batch_sampling.stratified_timesteps(args.batch_size // k, k, diffusion.num_timesteps, device)
+        loss = diffusion.training_losses(model, images, t=t, model_kwargs={"y": labels})["loss"].mean()
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    return dict(
+        repeats=k,
+        loader_batch=args.batch_size // k,
+        images_per_s=args.steps * (args.batch_size // k) / elapsed,
+        step_ms=elapsed / args.steps * 1000,
+        eval_loss=eval_loss(model, diffusion, dataset, device),
+    )
+
+
+def main():
+    args = parse_args()
+    margs = model_args(args.model, image_size=8, in_chans=4, num_classes=10)
+    torch.manual_seed(0)
+    init_model = build_model(margs)
+    diffusion = GaussianDiffusion(
+        betas=get_named_beta_schedule("cosine", 1000, 1), model_mean_type=ModelMeanType.EPSILON,
+        model_var_type=ModelVarType.FIXED_LARGE, loss_type=LossType.MSE, rescale_timesteps=True, gamma=0,
+    )
+    dataset = SlowLatents(4096, (4, 8, 8), 10, args.io_ms)
+
+    rows = []
+    for k in args.repeats:
+        assert args.batch_size % k == 0, "--batch_size must be divisible by every repeat count"
+        rows.append(run(args, k, init_model, diffusion, dataset))
+        print(rows[-1])
+    print()
+    print_table(rows, ["repeats", "loader_batch", "images_per_s", "step_ms", "eval_loss"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Sampling-time cost of routing UNet attention through gradient checkpointing.
+
+"checkpointed" reproduces the previous behaviour, where every AttentionBlock
+call went through the custom CheckpointFunction autograd function of
+tools/nn.py (rebuilt here, it has since been replaced by torch.utils.checkpoint)
+even under torch.no_grad();
+"direct" is the current inference path. Each row is one denoiser call, i.e.
+one sampling step, in eval mode under no_grad.
+
+Example:
+    python -m benchmarks.sampling_attention --models ADM-64 ADM-256 --batch_size 64 --steps 50
+"""
+
+import argparse
+import json
+
+import torch
+
+from benchmarks.common import dummy_inputs, model_args, print_table, time_fn
+from main import build_model
+from models.unet import AttentionBlock
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the UNet attention inference path")
+    parser.add_argument("--models", nargs="+", default=["ADM-64", "ADM-256"])
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=50, help="Sampling steps used to extrapolate per-sample time")
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file")
+    return parser.parse_args()
+
+
+class CheckpointFunction(torch.autograd.Function):
+    """The checkpoint autograd function tools.nn.checkpoint used to apply."""
+
+    @staticmethod
+    def forward(ctx, run_function, length, *args):
+        ctx.run_function = run_function
+        ctx.input_tensors = list(args[:length])
+        ctx.input_params = list(args[length:])
+        with torch.no_grad():
+            output_tensors = ctx.run_function(*ctx.input_tensors)
+        return output_tensors
+
+    @staticmethod
+    def backward(ctx, *output_grads):
+        ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
+        with torch.enable_grad():
+            shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
+            output_tensors = ctx.run_function(*shallow_copies)
+        input_grads = torch.autograd.grad(
+            output_tensors, ctx.input_tensors + ctx.input_params, output_grads, allow_unused=True,
+        )
+        del ctx.input_tensors
+        del ctx.input_params
+        del output_tensors
+        return (None, None) + input_grads
+
+
+def force_checkpoint(model):
+    """
+    Make every AttentionBlock of `model` go through CheckpointFunction
+    unconditionally, as before the inference fast path.
+    """
+    for m in model.modules():
+        if isinstance(m, AttentionBlock):
+            m.forward = lambda x, m=m: CheckpointFunction.apply(m._forward, 1, x, *m.parameters())
+
+
+def bench(args, name, path):
+    image_size = int(name.split("-")[-1])
+    margs = model_args(name, image_size=image_size)
+    model = build_model(margs).to(args.device).eval()
+    if path == "checkpointed":
+        force_checkpoint(model)
+    x, t, y = dummy_inputs(margs, args.batch_size, args.device)
+
+    @torch.no_grad()
+    def step():
+        model(x, t, y)
+
+    step_ms = time_fn(step, args.device, iters=args.iters)
+    del model
+    return dict(model=name, path=path, step_ms=step_ms, sample_s=step_ms * args.steps / 1000)
+
+
+def main():
+    args = parse_args()
+    rows = []
+    for name in args.models:
+        for path in ["checkpointed", "direct"]:
+            rows.append(bench(args, name, path))
+        saved = 1 - rows[-1]["step_ms"] / rows[-2]["step_ms"]
+        print(f"{name}: direct path saves {saved * 100:.1f}% per sampling step")
+    print()
+    print_table(rows, ["model", "path", "step_ms", "sample_s"])
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Convergence speed of the training timestep samplers, as FID at each
+evaluation step.
+
+Each sampler is trained in its own run of main.py (under torchrun with
+--nproc_per_node > 1) with its own --logdir; all other flags are passed
+through unchanged, so --eval_step sets the evaluation points. The FID
+columns of the runs' metric CSVs are then joined into one table, with the
+first step at which each sampler reaches --fid_target.
+
+Example:
+    python -m benchmarks.timestep_sampler_convergence --samplers uniform speed --fid_target 30 -- \\
+        --dataset CIFAR-10 --model UNet-32 --total_steps 100000 --eval_step 10000 --num_samples 10000
+"""
+
+import argparse
+import csv
+import glob
+import os
+import subprocess
+import sys
+
+from benchmarks.common import print_table
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare FID-at-step of the training timestep samplers")
+    parser.add_argument("--samplers", nargs="+", default=["uniform", "loss-second-moment", "speed"])
+    parser.add_argument("--logdir", type=str, default="./logs/timestep_samplers", help="One sub-directory per sampler")
+    parser.add_argument("--nproc_per_node", type=int, default=1, help="Launch each run with torchrun on this many processes")
+    parser.add_argument("--fid_target", type=float, default=None, help="Report the first step reaching this FID")
+    parser.add_argument("--skip_training", action="store_true", help="Only collect the metrics of earlier runs")
+    parser.add_argument("--csv", type=str, default=None, help="Write the joined table to this file")
+    return parser.parse_known_args()
+
+
+def train(sampler, logdir, nproc_per_node, train_argv):
+    if nproc_per_node > 1:
+        launcher = [sys.executable, "-m", "torch.distributed.run", f"--nproc_per_node={nproc_per_node}"]
+        train_argv = train_argv + ["--parallel", "True"]
+    else:
+        launcher = [sys.executable]
+    command = launcher + ["main.py", *train_argv, "--timestep_sampler", sampler, "--logdir", logdir,
+                          "--train", "True", "--eval", "True"]
+    print(" ".join(command))
+    subprocess.run(command, check=True)
+
+
+def read_fid(logdir):
+    """FID (EMA) per evaluation step from the metric CSVs of a run."""
+    fid = {}
+    for path in glob.glob(os.path.join(logdir, "*", "evaluate", "*.csv")):
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                fid[int(row["Step"])] = float(row["FID (EMA)"])
+    return fid
+
+
+def main():
+    args, train_argv = parse_args()
+    if train_argv and train_argv[0] == "--":
+        train_argv = train_argv[1:]
+
+    results = {}
+    for sampler in args.samplers:
+        logdir = os.path.join(args.logdir, sampler)
+        if not args.skip_training:
+            train(sampler, logdir, args.nproc_per_node, train_argv)
+        results[sampler] = read_fid(logdir)
+
+    steps = sorted({step for fid in results.values() for step in fid})
+    rows = [{"step": step, **{s: results[s].get(step) for s in args.samplers}} for step in steps]
+    print()
+    print_table(rows, ["step"] + args.samplers)
+
+    if args.fid_target is not None:
+        print(f"\nfirst step with FID <= {args.fid_target}:")
+        for sampler in args.samplers:
+            reached = [step for step in steps if results[sampler].get(step, float("inf")) <= args.fid_target]
+            print(f"  {sampler}: {reached[0] if reached else 'not reached'}")
+
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["step"] + args.samplers)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
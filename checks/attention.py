@@ -0,0 +1,104 @@
+"""
+Check every attention backend of models.attention against the previous
+implementation of each model family.
+
+    python -m checks.attention
+"""
+
+import copy
+import math
+
+import torch
+import torch.nn.functional as F
+from timm.models.vision_transformer import Attention as TimmAttention
+
+from models import attention
+from models.attention import ATTENTION_BACKENDS, Attention, get_attention_backend, set_attention_backend
+from models.unet import QKVAttention, QKVAttentionLegacy
+from models.vit import Attention as ViTAttention, RelativePositionBias
+
+
+def check_backends(atol=1e-5):
+    """
+    Compare every backend, on every model family's attention module, with
+    the implementation it replaced (in float32 on CPU, eval mode).
+    """
+    def unet_legacy(qkv, n_heads):
+        bs, width, length = qkv.shape
+        ch = width // (3 * n_heads)
+        q, k, v = qkv.reshape(bs * n_heads, ch * 3, length).split(ch, dim=1)
+        scale = 1 / math.sqrt(math.sqrt(ch))
+        weight = torch.einsum("bct,bcs->bts", q * scale, k * scale)
+        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+        return torch.einsum("bts,bcs->bct", weight, v).reshape(bs, -1, length)
+
+    def unet_new_order(qkv, n_heads):
+        bs, width, length = qkv.shape
+        ch = width // (3 * n_heads)
+        q, k, v = qkv.chunk(3, dim=1)
+        scale = 1 / math.sqrt(math.sqrt(ch))
+        weight = torch.einsum("bct,bcs->bts", (q * scale).view(bs * n_heads, ch, length),
+                              (k * scale).view(bs * n_heads, ch, length))
+        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+        return torch.einsum("bts,bcs->bct", weight, v.reshape(bs * n_heads, ch, length)).reshape(bs, -1, length)
+
+    def vit_attention(m, x, rel_pos_bias=None):
+        B, N, C = x.shape
+        qkv_bias = torch.cat((m.q_bias, torch.zeros_like(m.v_bias), m.v_bias))
+        qkv = F.linear(x, m.qkv.weight, qkv_bias).reshape(B, N, 3, m.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0] * m.scale, qkv[1], qkv[2]
+        attn = q @ k.transpose(-2, -1)
+        if m.relative_position_bias_table is not None:
+            n = m.window_size[0] * m.window_size[1] + m.num_extra_tokens
+            bias = m.relative_position_bias_table[m.relative_position_index.view(-1)].view(n, n, -1)
+            attn = attn + bias.permute(2, 0, 1).unsqueeze(0)
+        if rel_pos_bias is not None:
+            attn = attn + rel_pos_bias
+        x = (attn.softmax(dim=-1) @ v).transpose(1, 2).reshape(B, N, -1)
+        return m.proj(x)
+
+    torch.manual_seed(0)
+    heads, window, extra = 4, (4, 4), 2
+    tokens = torch.randn(2, window[0] * window[1] + extra, 32)
+    qkv = torch.randn(2, 3 * 32, 50)
+
+    timm_attn = TimmAttention(32, num_heads=heads, qkv_bias=True).eval()
+    token_attn = Attention(32, num_heads=heads, qkv_bias=True).eval()
+    token_attn.load_state_dict(timm_attn.state_dict())
+
+    vit_attn = ViTAttention(32, num_heads=heads, qkv_bias=True, window_size=window, num_extra_tokens=extra).eval()
+    with torch.no_grad():
+        for p in vit_attn.parameters():
+            p.normal_(std=0.1)
+    shared_bias = RelativePositionBias(window, heads, num_extra_tokens=extra)
+    with torch.no_grad():
+        shared_bias.relative_position_bias_table.normal_(std=0.1)
+    rel_pos_bias = shared_bias()
+
+    cases = [
+        ("unet legacy", lambda: QKVAttentionLegacy(heads)(qkv), lambda: unet_legacy(qkv, heads)),
+        ("unet new order", lambda: QKVAttention(heads)(qkv), lambda: unet_new_order(qkv, heads)),
+        ("vit", lambda: vit_attn(tokens, rel_pos_bias=rel_pos_bias),
+         lambda: vit_attention(vit_attn, tokens, rel_pos_bias)),
+        ("dit / u-vit (timm)", lambda: token_attn(tokens), lambda: timm_attn(tokens)),
+    ]
+    previous, previous_chunk_size = get_attention_backend(), attention.CHUNK_SIZE
+    try:
+        for name in ATTENTION_BACKENDS:
+            set_attention_backend(name, chunk_size=7)  # several uneven chunks
+            with torch.no_grad():
+                for case, new, old in cases:
+                    err = (new() - old()).abs().max().item()
+                    assert err < atol, f"{name} backend, {case}: max abs error {err:.2e}"
+            # Gradients flow through every backend
+            x = tokens.clone().requires_grad_(True)
+            copy.deepcopy(token_attn).train()(x).sum().backward()
+            assert x.grad is not None and torch.isfinite(x.grad).all()
+            print(f"{name}: ok")
+    finally:
+        set_attention_backend(previous, chunk_size=previous_chunk_size)
+    print("attention check passed")
+
+
+if __name__ == "__main__":
+    check_backends()
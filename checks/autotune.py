@@ -0,0 +1,31 @@
+"""
+Check the batch size search and the micro-batch choice of tools.autotune on CPU.
+
+    python -m checks.autotune
+"""
+
+from tools.autotune import _covers, max_batch_size, micro_batch_size
+
+
+def check_search():
+    probes = []
+
+    def fits(n):
+        probes.append(n)
+        return n <= 37
+
+    assert max_batch_size(fits, 256) == 37 and len(probes) < 15
+    assert max_batch_size(fits, 20) == 20
+    assert max_batch_size(lambda n: False, 8) == 0
+    assert micro_batch_size(64, 37) == 32
+    assert micro_batch_size(96, 37) == 32
+    assert micro_batch_size(96, 37, multiple=3) == 24
+    assert micro_batch_size(7, 5) == 1
+    assert _covers({"max_micro_batch": 37, "micro_batch_cap": 256}, 1024, 0)
+    assert not _covers({"max_micro_batch": 64, "micro_batch_cap": 64}, 128, 0)
+    assert not _covers({"max_micro_batch": 64, "micro_batch_cap": 64}, 32, 16)
+    print("autotune check passed")
+
+
+if __name__ == "__main__":
+    check_search()
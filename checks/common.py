@@ -0,0 +1,122 @@
+"""
+Fixtures shared by the self-checks.
+
+Run the checks from the repository root as modules, e.g.
+    python -m checks.resume
+"""
+
+import argparse
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import TensorDataset
+
+from models.dit import DiT
+from models.uvit import UViT
+from tools.gaussian_diffusion import (
+    GaussianDiffusion, LossType, ModelMeanType, ModelVarType, get_named_beta_schedule,
+)
+
+
+def train_args(**overrides):
+    """
+    Build the argument namespace Trainer needs for a small CPU run.
+    """
+    args = dict(
+        dataset='check',
+        model='DiT-S',
+        mean_type='EPSILON',
+        weight_type='constant',
+        beta_schedule='linear',
+        p=1,
+        parallel=False,
+        amp=False,
+        grad_accumulation=2,
+        grad_clip=1.0,
+        ema_decay=0.9,
+        class_cond=True,
+        in_chans=3,
+        compile=False,
+        compile_explain=False,
+        lr=1e-3,
+        final_lr=1e-4,
+        warmup_steps=2,
+        total_steps=7,
+        cosine_decay=True,
+        seed=0,
+        timing=False,
+        model_mode='diffusion',
+        timestep_sampler='uniform',
+        noise_repeats=1,
+        stratified_repeats=False,
+        stratify_timesteps='none',
+        antithetic_noise=False,
+        mask_ratio=0.0,
+        mask_recon_weight=0.0,
+    )
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def small_dit(**overrides):
+    """
+    An 8px DiT. No label dropout, which would draw differently per model.
+    """
+    kwargs = dict(image_size=8, patch_size=2, in_channels=3, hidden_size=32, depth=2, num_heads=2,
+                  num_classes=10, class_dropout_prob=0.0)
+    kwargs.update(overrides)
+    return DiT(**kwargs)
+
+
+def small_uvit(**overrides):
+    """
+    An 8px U-ViT.
+    """
+    kwargs = dict(image_size=8, patch_size=2, in_channels=3, embed_dim=32, depth=3, num_heads=2, num_classes=10)
+    kwargs.update(overrides)
+    return UViT(**kwargs)
+
+
+def small_diffusion():
+    """
+    A 100-step linear-schedule epsilon-prediction diffusion with the MSE loss.
+    """
+    return GaussianDiffusion(
+        betas=get_named_beta_schedule('linear', 100, 1), model_mean_type=ModelMeanType.EPSILON,
+        model_var_type=ModelVarType.FIXED_LARGE, loss_type=LossType.MSE, rescale_timesteps=True, gamma=0,
+    )
+
+
+def toy_dataset(size=12):
+    """
+    Fixed random 8px images with labels: 3 batches of 4.
+    """
+    g = torch.Generator().manual_seed(0)
+    return TensorDataset(torch.randn(size, 3, 8, 8, generator=g), torch.randint(0, 10, (size,), generator=g))
+
+
+def dit_batch(step, rank, device='cpu'):
+    """
+    The model inputs (x, t, y) of `rank` at `step`, the same in every process.
+    """
+    g = torch.Generator().manual_seed(1000 * step + rank)
+    x = torch.randn(4, 3, 8, 8, generator=g)
+    t = torch.randint(0, 1000, (4,), generator=g)
+    y = torch.randint(0, 10, (4,), generator=g)
+    return x.to(device), t.to(device), y.to(device)
+
+
+def perturb(model, std=0.05):
+    """
+    Move the weights away from DiT's zero init, so that every weight gets a gradient.
+    """
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * std)
+    return model
+
+
+def init_process_group(rank, world_size, port, backend='gloo'):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
@@ -0,0 +1,38 @@
+"""
+Check the torchrun-style setup of tools.dist_util on 2 gloo CPU processes.
+
+    python -m checks.dist_util
+"""
+
+import os
+
+import torch as th
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from tools.dist_util import cleanup_dist, dev, node_group, setup_dist
+
+
+def check_worker(rank, world_size):
+    """
+    Set up a rank as torchrun would on a CPU-only machine, and check that the
+    backend, device and collectives agree.
+    """
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(world_size),
+                      LOCAL_WORLD_SIZE=str(world_size), MASTER_ADDR="127.0.0.1", MASTER_PORT="29518",
+                      CUDA_VISIBLE_DEVICES="")
+    device = setup_dist()
+    assert device == th.device("cpu") and device == dev(), device
+    assert dist.get_backend() == "gloo"
+    assert dist.get_rank() == rank and dist.get_world_size() == world_size
+    x = th.full((2,), float(rank), device=device)
+    dist.all_reduce(x)
+    assert th.equal(x, th.full((2,), float(sum(range(world_size)))))
+    group, leader = node_group()
+    assert leader == 0
+    cleanup_dist()
+
+
+if __name__ == "__main__":
+    mp.spawn(check_worker, args=(2,), nprocs=2, join=True)
+    print("dist_util check passed")
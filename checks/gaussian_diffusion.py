@@ -0,0 +1,44 @@
+"""
+Check the cached coefficient and loss weight tables of tools.gaussian_diffusion.
+
+    python -m checks.gaussian_diffusion
+"""
+
+import torch as th
+
+from tools.gaussian_diffusion import (
+    GaussianDiffusion, LossType, ModelMeanType, ModelVarType, _extract_into_tensor,
+    compute_mse_loss_weight, get_named_beta_schedule,
+)
+from tools.respace import SpacedDiffusion, space_timesteps
+
+
+def check_tables():
+    """
+    Check the cached device tables against gathering the float64 numpy
+    arrays, for a plain and a respaced diffusion, and the MSE loss weight
+    tables against evaluating the weighting on the gathered alpha, sigma.
+    """
+    kwargs = dict(
+        betas=get_named_beta_schedule("cosine", 1000, 1), model_mean_type=ModelMeanType.EPSILON,
+        model_var_type=ModelVarType.FIXED_LARGE, loss_type=LossType.MSE, rescale_timesteps=True, gamma=0,
+    )
+    for diffusion in [GaussianDiffusion(**kwargs), SpacedDiffusion(space_timesteps(1000, "ddim50"), **kwargs)]:
+        t = th.randint(0, diffusion.num_timesteps, (64,))
+        for name, arr in diffusion._coefficient_tables().items():
+            expected = _extract_into_tensor(arr, t, (64, 3, 8, 8))
+            assert th.equal(diffusion._extract(name, t, (64, 3, 8, 8)), expected), name
+
+    alpha = _extract_into_tensor(diffusion.sqrt_alphas_cumprod, t, t.shape)
+    sigma = _extract_into_tensor(diffusion.sqrt_one_minus_alphas_cumprod, t, t.shape)
+    for mean_type, weight_type in [("EPSILON", "min_snr_5"), ("EPSILON", "p2"), ("EPSILON", "debias"),
+                                   ("START_X", "trunc_snr"), ("VELOCITY", "min_snr_5")]:
+        diffusion = GaussianDiffusion(**{**kwargs, "model_mean_type": ModelMeanType[mean_type]},
+                                      mse_loss_weight_type=weight_type)
+        expected = compute_mse_loss_weight(ModelMeanType[mean_type], weight_type, t, alpha, sigma)
+        assert th.allclose(diffusion._mse_loss_weight(t), expected, rtol=1e-4), weight_type
+    print("coefficient table check passed")
+
+
+if __name__ == "__main__":
+    check_tables()
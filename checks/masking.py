@@ -0,0 +1,44 @@
+"""
+Check the token masking helpers of tools.masking on CPU.
+
+    python -m checks.masking
+"""
+
+import torch as th
+
+from tools.masking import (
+    drop_tokens, masked_mean, masked_mse, random_token_mask, restore_tokens, visible_pixels,
+)
+
+
+def check_masking(batch_size=3, grid=4, dim=5, patch_size=2, mask_ratio=0.5):
+    th.manual_seed(0)
+    num_tokens = grid * grid
+    mask = random_token_mask(batch_size, num_tokens, mask_ratio)
+    assert (mask.sum(dim=1) == num_tokens // 2).all()
+
+    x = th.randn(batch_size, num_tokens, dim)
+    kept = drop_tokens(x, mask)
+    for i in range(batch_size):
+        assert th.equal(kept[i], x[i][~mask[i]])
+    fill = th.randn(1, num_tokens, dim)
+    restored = restore_tokens(kept, mask, fill)
+    expected = th.where(mask.unsqueeze(-1), fill.expand_as(x), x)
+    assert th.equal(restored, expected)
+
+    pixels = visible_pixels(mask, patch_size)
+    assert pixels.shape == (batch_size, 1, grid * patch_size, grid * patch_size)
+    assert th.equal(pixels[:, 0, ::patch_size, ::patch_size].flatten(1), (~mask).float())
+
+    # Without a mask the visible loss is the plain MSE
+    out, target, x_t = th.randn(3, batch_size, 2, 8, 8)
+    mse, recon = masked_mse(out, target, x_t, th.ones(batch_size, 1, 8, 8))
+    assert th.allclose(mse, ((target - out) ** 2).mean(dim=(1, 2, 3)))
+    mse, recon = masked_mse(out, target, x_t, pixels)
+    assert th.allclose(recon, ((x_t - out) ** 2 * (1 - pixels)).sum(dim=(1, 2, 3)) / (2 * 32))
+    assert th.allclose(masked_mean(out, pixels), (out * pixels).sum(dim=(1, 2, 3)) / (2 * 32))
+    print("masking check passed")
+
+
+if __name__ == "__main__":
+    check_masking()
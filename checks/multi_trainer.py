@@ -0,0 +1,51 @@
+"""
+Check on CPU that two identical experiments trained together with
+--share_noise stay identical, and that the data is fetched once per step.
+
+    python -m checks.multi_trainer
+"""
+
+import copy
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader
+
+from checks.common import small_diffusion, small_dit, toy_dataset, train_args
+from tools.multi_trainer import MultiTrainer, experiment_args
+from tools.utils import get_lr_lambda
+
+
+def check_shared_batches(steps=3):
+    with tempfile.TemporaryDirectory() as logdir:
+        args = train_args(dataset='multi-check', total_steps=steps, logdir=logdir, log_interval=1,
+                          share_noise=True, experiments=['a', 'b:lr=0.001'])
+        loader = DataLoader(toy_dataset(), batch_size=4, shuffle=True, drop_last=True)
+
+        experiments = []
+        for exp_args in experiment_args(args):
+            torch.manual_seed(0)
+            model = small_dit()
+            optimizer = torch.optim.AdamW(model.parameters(), lr=exp_args.lr)
+            experiments.append({
+                'args': exp_args, 'model': model, 'ema_model': copy.deepcopy(model), 'optimizer': optimizer,
+                'scheduler': torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=get_lr_lambda(exp_args)),
+                'diffusion': small_diffusion(),
+            })
+        assert experiments[1]['args'].logdir == os.path.join(logdir, 'b')
+
+        trainer = MultiTrainer(args, 'cpu', experiments, loader, 0)
+        for step in range(1, steps + 1):
+            losses = trainer.train_step(step)
+            assert losses['a'] == losses['b'], losses
+        trainer.close()
+    a, b = (exp['model'].state_dict() for exp in experiments)
+    assert all(torch.equal(a[k], b[k]) for k in a)
+    assert trainer.trainers[0].state_dict()['data']['batches'] == steps * args.grad_accumulation
+    assert trainer.trainers[1].state_dict()['data'] is None
+    print(f"multi-experiment check passed: {len(experiments)} experiments, {steps} steps on shared batches")
+
+
+if __name__ == '__main__':
+    check_shared_batches()
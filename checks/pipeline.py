@@ -0,0 +1,74 @@
+"""
+Check a 3-stage pipelined DiT and U-ViT against the unsplit models.
+
+    python -m checks.pipeline
+"""
+
+import copy
+
+import torch as th
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from checks.common import init_process_group, perturb, small_diffusion, small_dit, small_uvit
+from tools.pipeline import PipelineRunner
+
+
+def check_worker(rank, world_size, num_microbatches=2, grad_accumulation=2, atol=1e-5):
+    """
+    Train a small DiT and U-ViT split into `world_size` stages and compare
+    against the unsplit model trained like Trainer.train_step.
+    """
+    init_process_group(rank, world_size, 29521)
+    diffusion = small_diffusion()
+    th.manual_seed(0)
+    models = {
+        "dit": small_dit(depth=4),
+        # In 3 stages: the 2 in-blocks, then the mid-block and an out-block,
+        # then the other out-block, so the first skip crosses two boundaries
+        "uvit": small_uvit(depth=5),
+    }
+
+    def batches(step):
+        g = th.Generator().manual_seed(step)
+        return [(th.randn(4, 3, 8, 8, generator=g), th.randint(0, 100, (4,), generator=g),
+                 th.randn(4, 3, 8, 8, generator=g), {"y": th.randint(0, 10, (4,), generator=g)})
+                for _ in range(grad_accumulation)]
+
+    for name, reference in models.items():
+        perturb(reference)
+        runner = PipelineRunner(copy.deepcopy(reference), th.device("cpu"), num_microbatches=num_microbatches)
+        optimizer = th.optim.AdamW(runner.stage.parameters(), lr=1e-3)
+        ref_optimizer = th.optim.AdamW(reference.parameters(), lr=1e-3)
+
+        for step in range(3):
+            loss = runner.train_step(diffusion, optimizer, batches(step), grad_clip=0.5)
+            # Trainer.train_step on the unsplit model
+            ref_loss = 0.0
+            for x_start, t, noise, model_kwargs in batches(step):
+                scaled = diffusion.training_losses(reference, x_start, t=t, model_kwargs=model_kwargs,
+                                                   noise=noise)["loss"].mean() / grad_accumulation
+                scaled.backward()
+                ref_loss += scaled.item()
+            th.nn.utils.clip_grad_norm_(reference.parameters(), 0.5)
+            ref_optimizer.step()
+            ref_optimizer.zero_grad()
+            assert abs(loss - ref_loss) < atol, f"{name} step {step}: loss {loss} != {ref_loss}"
+
+        state = runner.full_state_dict()
+        if rank == 0:
+            expected = reference.state_dict()
+            assert state.keys() == expected.keys()
+            diff = max((state[k] - v).abs().max().item() for k, v in expected.items())
+            print(f"[{name}] {world_size} stages, {num_microbatches} micro-batches x {grad_accumulation} "
+                  f"accumulation steps, max |param - reference| after 3 steps: {diff:.2e}")
+            assert diff < atol, f"{name}: pipelined training diverged from the reference"
+        objects = [state]
+        dist.broadcast_object_list(objects, src=0)
+        runner.load_full_state_dict(objects[0])
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    mp.spawn(check_worker, args=(3,), nprocs=3, join=True)
+    print("pipeline check passed")
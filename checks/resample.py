@@ -0,0 +1,67 @@
+"""
+Check the timestep samplers of tools.resample on CPU.
+
+    python -m checks.resample
+"""
+
+import types
+
+import numpy as np
+import torch as th
+
+from tools.resample import (
+    FLOW_SAMPLERS, AdaptiveHistogramSampler, LossSecondMomentResampler, create_flow_time_sampler,
+)
+
+
+def check_resampler(num_timesteps=50, history=4, steps=40, batch_size=16):
+    """
+    Check the vectorized ring-buffer update against the original sequential
+    shift-out update of guided-diffusion, and the flow matching samplers.
+    """
+    diffusion = types.SimpleNamespace(num_timesteps=num_timesteps)
+    sampler = LossSecondMomentResampler(diffusion, history_per_term=history)
+    ref_history = np.zeros([num_timesteps, history], dtype=np.float64)
+    ref_counts = np.zeros([num_timesteps], dtype=int)
+
+    g = th.Generator().manual_seed(0)
+    for _ in range(steps):
+        # Few distinct timesteps, so that a batch often repeats one more than
+        # `history` times.
+        ts = th.randint(0, num_timesteps, (batch_size,), generator=g) // 3
+        losses = th.rand(batch_size, generator=g, dtype=th.float64)
+        sampler.update_with_local_losses(ts, losses)
+        for t, loss in zip(ts.tolist(), losses.tolist()):
+            if ref_counts[t] == history:
+                ref_history[t, :-1] = ref_history[t, 1:]
+                ref_history[t, -1] = loss
+            else:
+                ref_history[t, ref_counts[t]] = loss
+                ref_counts[t] += 1
+
+    # Same set of losses per timestep; the ring buffer only stores them rotated.
+    actual = np.sort(sampler._loss_history.numpy(), axis=1)
+    assert np.array_equal(actual, np.sort(ref_history, axis=1)), "loss history differs from the reference"
+    assert np.array_equal(sampler._loss_counts.numpy(), ref_counts), "loss counts differ from the reference"
+
+    # Not every timestep was seen, so sampling is still uniform.
+    _, weights = sampler.sample(1000, "cpu")
+    assert th.allclose(weights, th.ones_like(weights)), "sampling before warm-up must be uniform"
+
+    # Continuous samplers stay in [0, 1]; the adaptive histogram shifts its
+    # mass towards high-loss times and keeps the weighted loss unbiased.
+    for name in FLOW_SAMPLERS:
+        t, _ = create_flow_time_sampler(name, bins=8).sample(4096, "cpu")
+        assert t.min() >= 0 and t.max() <= 1, name
+    adaptive = AdaptiveHistogramSampler(bins=8, decay=0.5)
+    for _ in range(20):
+        t, _ = adaptive.sample(256, "cpu")
+        adaptive.update_with_local_losses(t, 1 + 4 * (t > 0.5).double())
+    t, weights = adaptive.sample(100000, "cpu")
+    assert (t > 0.5).float().mean() > 0.6, "adaptive sampler did not favour high-loss times"
+    assert abs(weights.mean().item() - 1) < 0.05, "importance weights are biased"
+    print(f"resampler check passed: {steps} updates of {batch_size} losses, flow samplers")
+
+
+if __name__ == "__main__":
+    check_resampler()
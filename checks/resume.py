@@ -0,0 +1,85 @@
+"""
+Check on CPU that runs resumed from a checkpoint end bit-for-bit identical
+to an uninterrupted run.
+
+    python -m checks.resume
+"""
+
+import copy
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader, DistributedSampler
+
+from checks.common import small_diffusion, small_dit, toy_dataset, train_args
+from tools.checkpoint_io import latest_checkpoint
+from tools.trainer import Trainer
+from tools.utils import (
+    checkpoint_dir, checkpoint_prefix, get_lr_lambda, load_checkpoint,
+    restore_training_state, save_checkpoint, set_random_seed,
+)
+
+
+def check_resume(total_steps=7, resume_steps=(1, 4)):
+    """
+    Resume from checkpoints saved at each of `resume_steps` and compare the
+    final model and EMA with those of an uninterrupted run.
+    """
+    args = train_args(dataset='resume-check', parallel=True, total_steps=total_steps,
+                      timestep_sampler='loss-second-moment')
+    diffusion = small_diffusion()
+    # 3 batches per epoch, 2 per step: checkpoints fall in the middle of the
+    # first epoch and of a later one. The single-replica DistributedSampler
+    # reads the epoch train_step sets, as in parallel runs.
+    dataset = toy_dataset()
+
+    def start(seed):
+        set_random_seed(args, seed)
+        model = small_dit(class_dropout_prob=0.1)
+        ema_model = copy.deepcopy(model)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=get_lr_lambda(args))
+        loader = DataLoader(dataset, batch_size=4, sampler=DistributedSampler(dataset, num_replicas=1, rank=0),
+                            drop_last=True)
+        trainer = Trainer(args, 'cpu', model, ema_model, optimizer, scheduler, diffusion, loader, 0)
+        return model, ema_model, optimizer, scheduler, trainer
+
+    def final_state(model, ema_model):
+        return {**{f'model.{k}': v for k, v in model.state_dict().items()},
+                **{f'ema.{k}': v for k, v in ema_model.state_dict().items()}}
+
+    model, ema_model, _, _, trainer = start(args.seed)
+    for step in range(1, total_steps + 1):
+        trainer.train_step(step)
+    expected = final_state(model, ema_model)
+
+    for resume_step in resume_steps:
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                model, ema_model, optimizer, scheduler, trainer = start(args.seed)
+                for step in range(1, resume_step + 1):
+                    trainer.train_step(step)
+                save_checkpoint(args, resume_step, model, optimizer, ema_model=ema_model,
+                                scheduler=scheduler, trainer=trainer)
+
+                # A new process: different seed, fresh objects, then resume
+                model, ema_model, optimizer, scheduler, trainer = start(args.seed + 1)
+                path = latest_checkpoint(checkpoint_dir(args), checkpoint_prefix(args))
+                checkpoint = load_checkpoint(path, model=model, optimizer=optimizer, ema_model=ema_model)
+                restore_training_state(checkpoint, scheduler, trainer)
+                for step in range(checkpoint['step'] + 1, total_steps + 1):
+                    trainer.train_step(step)
+            finally:
+                os.chdir(cwd)
+
+        resumed = final_state(model, ema_model)
+        mismatched = [k for k in expected if not torch.equal(expected[k], resumed[k].to(expected[k].device))]
+        assert not mismatched, f"run resumed at step {resume_step} differs in {mismatched}"
+        print(f"resume check passed: step {resume_step} -> {total_steps} matches bit-for-bit")
+
+
+if __name__ == '__main__':
+    check_resume()
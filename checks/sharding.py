@@ -0,0 +1,97 @@
+"""
+Check ZeRO (and, with 2 GPUs, FSDP) training against plain AdamW, including
+a round trip through the consolidated state dicts.
+
+    python -m checks.sharding
+"""
+
+import argparse
+import copy
+
+import torch as th
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from checks.common import dit_batch, init_process_group, small_dit
+from tools import dist_util
+from tools.sharding import (
+    build_optimizer, load_model_state_dict, load_optimizer_state_dict, model_state_dict,
+    optimizer_state_dict, wrap_model,
+)
+
+
+def check_worker(rank, world_size, shard):
+    """
+    Train a small DiT for a few steps with `shard` and compare against plain
+    single-process AdamW on the concatenated batch, then check that the
+    consolidated optimizer state reloads into a fresh sharded optimizer.
+    """
+    use_cuda = shard == "fsdp"
+    init_process_group(rank, world_size, 29517, "nccl" if use_cuda else "gloo")
+    device = th.device(f"cuda:{rank}") if use_cuda else th.device("cpu")
+    if use_cuda:
+        th.cuda.set_device(device)
+
+    args = argparse.Namespace(
+        parallel=True, shard=shard, lr=1e-3, betas=(0.9, 0.999), weight_decay=0.01, eps=1e-8
+    )
+    th.manual_seed(0)
+    reference = small_dit(hidden_size=64).to(device)
+    model = wrap_model(copy.deepcopy(reference), args, device)
+    optimizer = build_optimizer(model, args)
+    ref_optimizer = optim.AdamW(reference.parameters(), lr=args.lr, betas=args.betas,
+                                weight_decay=args.weight_decay, eps=args.eps)
+
+    def train_step(step):
+        x, t, y = dit_batch(step, rank, device)
+        model(x, t, y).square().mean().backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        xs, ts, ys = zip(*(dit_batch(step, r, device) for r in range(world_size)))
+        reference(th.cat(xs), th.cat(ts), th.cat(ys)).square().mean().backward()
+        ref_optimizer.step()
+        ref_optimizer.zero_grad()
+
+    def max_diff():
+        state = model_state_dict(model)
+        if not dist_util.is_main_process():
+            return 0.0
+        return max(
+            (state[f"module.{k}"].to(device) - v).abs().max().item()
+            for k, v in reference.state_dict().items()
+        )
+
+    for step in range(3):
+        train_step(step)
+    diff = max_diff()
+
+    # Round trip through the consolidated state dicts, as save/load_checkpoint do.
+    opt_state = optimizer_state_dict(model, optimizer)
+    objects = [opt_state]
+    dist.broadcast_object_list(objects, src=0)
+    model_state = [model_state_dict(model)]
+    dist.broadcast_object_list(model_state, src=0)
+    model = wrap_model(copy.deepcopy(reference), args, device)
+    load_model_state_dict(model, model_state[0])
+    optimizer = build_optimizer(model, args)
+    load_optimizer_state_dict(model, optimizer, objects[0])
+    train_step(3)
+    resumed_diff = max_diff()
+
+    if dist_util.is_main_process():
+        print(f"[{shard}] max |param - reference| after 3 steps: {diff:.2e}, after resume: {resumed_diff:.2e}")
+        assert diff < 1e-5 and resumed_diff < 1e-5, "sharded training diverged from the reference"
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    world_size = 2
+    modes = ["zero"]
+    if th.cuda.device_count() >= world_size:
+        modes.append("fsdp")
+    else:
+        print("fewer than 2 GPUs: skipping the fsdp check (FSDP requires CUDA in torch 2.1)")
+    for mode in modes:
+        mp.spawn(check_worker, args=(world_size, mode), nprocs=world_size, join=True)
+    print("sharding check passed")
@@ -37,7 +37,7 @@ cd /home/workspace/ddpm # Set working directory to where main.py is located
 BASE_CMD="torchrun --nproc_per_node=$NPROC_PER_NODE main.py --train True --eval True --dataset 'Latent' \
           --patch_size 2 --in_chans 4 --image_size 32 --num_classes 1000 --model 'DiT-S' \
           --lr 1e-4 --betas 0.9 0.999 --dropout 0.0 --drop_label_prob 0.0 --total_steps 400000 --batch_size 256 --grad_accumulation 1 \
-          --beta_schedule 'linear' --loss_type 'MSE' --sampler_type 'uniform' --mapping False \
+          --beta_schedule 'linear' --loss_type 'MSE' --timestep_sampler 'uniform' --mapping False \
           --warmup_steps 0 --cosine_decay False --class_cond True --parallel True --amp True --sample_size 16 \
           --sample_timesteps 50 --guidance_scale 1.0 --sample_step 10000 --num_samples 50000 --save_step 100000 --eval_step 50000 \
           --data_dir '$DATA_DIR' --ref_batch '$REF_BATCH'"
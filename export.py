@@ -0,0 +1,53 @@
+"""
+Export the EMA weights of a training checkpoint for inference.
+
+    python export.py --checkpoint checkpoint/ImageNet/DiT-XL/EPSILON_..._400000.pth --output dit_xl.pt --bf16 True
+
+The output holds only the EMA weights, without the DDP `module.` prefix, and the
+model and diffusion config, so that `sample.py --weights dit_xl.pt` rebuilds the
+model without any other model flag. Checkpoints saved before the config was
+recorded need the training flags (--model, --image_size, ...) after the export
+flags; they are parsed like main.py's.
+"""
+
+import argparse
+import os
+
+import torch
+
+from main import parse_args as parse_train_args
+from tools.utils import model_config, str2bool, strip_prefix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export EMA weights for inference")
+    parser.add_argument("--checkpoint", type=str, required=True, help="Training checkpoint to export")
+    parser.add_argument("--output", type=str, required=True, help="Path of the exported weights file")
+    parser.add_argument("--bf16", default=False, type=str2bool, help="Store the weights in bfloat16")
+    return parser.parse_known_args()
+
+
+def main():
+    args, train_argv = parse_args()
+    checkpoint = torch.load(args.checkpoint, map_location="cpu", mmap=True)
+
+    config = checkpoint.get("config")
+    if config is None:
+        print("checkpoint has no config, taking it from the training flags")
+        config = model_config(parse_train_args(train_argv))
+
+    state_dict = strip_prefix(checkpoint["ema_model"])
+    if args.bf16:
+        state_dict = {
+            k: v.to(torch.bfloat16) if v.is_floating_point() else v for k, v in state_dict.items()
+        }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    torch.save({"ema_model": state_dict, "config": config, "step": checkpoint.get("step")}, args.output)
+    size_in = os.path.getsize(args.checkpoint) / 2 ** 20
+    size_out = os.path.getsize(args.output) / 2 ** 20
+    print(f"Exported {args.output} ({size_out:.1f} MiB, from {size_in:.1f} MiB): {config['model']}")
+
+
+if __name__ == "__main__":
+    main()
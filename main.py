@@ -14,7 +14,12 @@ import torch.distributed as dist
 from torch.utils.data import DistributedSampler
 from torchvision.utils import make_grid, save_image
 from tools.utils import *
-from tools import dist_util, logger
+from tools import dist_util, logger, compile_util, sharding, autotune, tensor_parallel
+from tools.comm_hooks import COMM_HOOKS
+from tools.multi_trainer import MultiTrainer, experiment_args
+from tools.nn import CHECKPOINT_POLICIES, set_checkpoint_policy
+from tools.resample import TIMESTEP_SAMPLERS
+from models.attention import ATTENTION_BACKENDS, set_attention_backend
 from evaluations.evaluator import Evaluator
 import tensorflow.compat.v1 as tf  # type: ignore
 from tools.trainer import Trainer
@@ -41,7 +46,7 @@ model_variants = [
     "DiT-S", "DiT-B", "DiT-L", "DiT-XL",
     "U-ViT-S", "U-ViT-S-D", "U-ViT-M", "U-ViT-L", "U-ViT-H"]
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Train and evaluate guided diffusion models")
     # Enable/Disable Training and Evaluation
     parser.add_argument("--train", default=True, type=str2bool, help="Enable training")
@@ -62,7 +67,7 @@ def parse_args():
                                                     help="Choose diffusion mode: 'flow' for SDE/ODE-based modeling, 'diffusion' for DDPM-like modeling.")
     # Flow matching
     parser.add_argument("--path_type", type=str, default='linear', choices=['linear', 'cosine'], help="Path type for flow matching")    
-    parser.add_argument('--sampler_type', type=str, default='sde', choices=['sde', 'ode'], help='Type of flow matching sampler to use')   
+    parser.add_argument('--sampler_type', type=str, default='sde', choices=['sde', 'ode'], help='Type of flow matching sampler to use (sampling only, see --timestep_sampler for training)')   
     # Discrete Diffusionsdasmnnbmmnb
     parser.add_argument("--beta_schedule", type=str, default='cosine', help="Beta schedule type 'linear', 'cosine', 'laplace', and 'power'.")
     parser.add_argument("--p", type=float, default=2, help="power for power schedule.")
@@ -75,6 +80,11 @@ def parse_args():
     parser.add_argument("--gamma", type=float, default=0, help="Coefficient for loss regularization")
     parser.add_argument("--p2_gamma", type=int, default=1, help="hyperparameter for P2 weight")
     parser.add_argument("--p2_k", type=int, default=1, help="hyperparameter for P2 weight")
+    parser.add_argument("--timestep_sampler", type=str, default='uniform', choices=TIMESTEP_SAMPLERS, help="Training timestep distribution, independent of the sampling solver. Diffusion: 'loss-second-moment' importance-samples t by the RMS of recent losses, 'speed' is SpeeDiffusion's asymmetric sampling with P2-weighted MSE. Flow: 'logit-normal', 'mode', 'cosine' reshape the density of t, 'adaptive' importance-samples t from a histogram of recent losses")
+    parser.add_argument("--logit_location", type=float, default=0.0, help="Mean of the normal of --timestep_sampler logit-normal")
+    parser.add_argument("--logit_scale", type=float, default=1.0, help="Std of the normal of --timestep_sampler logit-normal")
+    parser.add_argument("--mode_scale", type=float, default=1.29, help="Scale s of --timestep_sampler mode")
+    parser.add_argument("--adaptive_bins", type=int, default=64, help="Number of histogram bins of --timestep_sampler adaptive")
 
 
     # Training
@@ -101,13 +111,48 @@ def parse_args():
     parser.add_argument("--cosine_decay", default=True, type=str2bool, help="Whether to use cosine learning rate decay")
     # DDP nad mixed precision training
     parser.add_argument("--parallel", default=False, type=str2bool, help="Use multi-GPU training")
+    parser.add_argument("--dist_backend", type=str, default=None, choices=["nccl", "gloo"], help="Process group backend for --parallel (default: nccl with CUDA, gloo on CPU)")
     parser.add_argument('--amp', default=True, type=str2bool, help='Use AMP for mixed precision training')
     parser.add_argument('--grad_accumulation', type=int, default=1, help='Number of gradient accumulation steps (default: 1, no accumulation)')
-    parser.add_argument('--resume', type=str, default=None, help='Path to the checkpoint to resume from')   
+    parser.add_argument('--autotune', default=False, type=str2bool, help='Probe memory at startup to pick the largest micro-batch that fits and derive --grad_accumulation (keeping --batch_size x --grad_accumulation), and pick --sample_size')
+    parser.add_argument('--autotune_headroom', type=float, default=0.1, help='Fraction of device memory --autotune leaves free')
+    parser.add_argument('--autotune_cache', type=str, default='./logs/autotune.json', help='Cache of --autotune results per model, resolution, device and memory settings')
+    parser.add_argument('--noise_repeats', type=int, default=1, help='Use each loaded image k times per step with independent noise and timesteps; the loader yields batch_size / k images')
+    parser.add_argument('--stratified_repeats', default=True, type=str2bool, help='With --noise_repeats, draw the timesteps of the copies of an image from k equal strata of the t-range')
+    parser.add_argument('--mask_ratio', type=float, default=0.0, help='DiT/ViT: fraction of patch tokens dropped before the transformer blocks during training (MaskDiT); 0 trains unmasked')
+    parser.add_argument('--mask_decoder_depth', type=int, default=0, help='DiT/ViT: number of decoder blocks run on the restored token grid (part of the model, also used unmasked)')
+    parser.add_argument('--mask_recon_weight', type=float, default=0.0, help='With --mask_ratio, weight of the reconstruction loss of the noisy input on the dropped patches')
+    parser.add_argument('--stratify_timesteps', type=str, default='none', choices=['none', 'rank', 'global'], help="Draw one training timestep per stratum of the t-range, over each rank's batch or over the global batch")
+    parser.add_argument('--antithetic_noise', default=False, type=str2bool, help='Pair the noise of consecutive batch elements as (eps, -eps); pairs are copies of one image with --noise_repeats')
+    parser.add_argument('--shard', type=str, default='none', choices=sharding.SHARD_MODES, help='With --parallel: shard optimizer state (zero) or params, grads and optimizer state (fsdp, CUDA only)')
+    parser.add_argument('--tensor_parallel', type=int, default=1, help='With --parallel: shard the attention and MLP linears (and adaLN) of DiT/U-ViT blocks across groups of this many ranks; data parallelism runs across the groups')
+    parser.add_argument('--ddp_comm_hook', type=str, default='none', choices=COMM_HOOKS, help='With --parallel and DDP: compress the gradient all-reduce to fp16/bf16, or low-rank with PowerSGD')
+    parser.add_argument('--powersgd_rank', type=int, default=4, help='Rank of the PowerSGD gradient approximation')
+    parser.add_argument('--powersgd_start_iter', type=int, default=1000, help='Number of all-reduce calls with uncompressed gradients before PowerSGD starts (at least 2)')
+    parser.add_argument('--powersgd_warm_start', default=True, type=str2bool, help='Reuse the previous low-rank factors to start each PowerSGD power iteration')
+    parser.add_argument('--experiments', type=str, nargs='+', default=None, help="Co-train several experiments on the same batches, each 'name:key=value,...' overriding settings of this run, e.g. 'minsnr:weight_type=min_snr_5'")
+    parser.add_argument('--share_noise', default=True, type=str2bool, help='With --experiments, train every experiment on the same timesteps and noise')
+    parser.add_argument('--resume', type=str, default=None, help="Path to the checkpoint to resume from, or 'auto' for the latest checkpoint of this run")   
+    # torch.compile
+    parser.add_argument('--compile', default=False, type=str2bool, help='Compile the forward+loss for training and the denoiser for sampling with torch.compile')
+    parser.add_argument('--compile_backend', type=str, default='inductor', help='torch.compile backend (inductor also runs on CPU via its C++ backend)')
+    parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode')
+    parser.add_argument('--compile_explain', default=False, type=str2bool, help='Report graph breaks of the compiled train step before training')
+    parser.add_argument('--compile_verbose', default=False, type=str2bool, help='Log recompilations and graph breaks as they happen')
+    parser.add_argument('--compile_cache_limit', type=int, default=8, help='Max number of recompilations per compiled frame before falling back to eager')
+    # Attention
+    parser.add_argument('--attention_backend', type=str, default='sdpa', choices=list(ATTENTION_BACKENDS), help='Attention implementation of every model family: sdpa, chunked (blocks of --attention_chunk_size queries, for CPU and long sequences), reference (float32 math) or xformers if installed')
+    parser.add_argument('--attention_chunk_size', type=int, default=1024, help='Queries per block of --attention_backend chunked')
+    # Activation checkpointing
+    parser.add_argument('--checkpoint_policy', type=str, default=None, choices=CHECKPOINT_POLICIES, help='Activation checkpointing policy; unset keeps the model default (UNet attention only)')
+    parser.add_argument('--checkpoint_every', type=int, default=2, help='Checkpoint every k-th block with --checkpoint_policy every_k')
 
 
     # Logging & Sampling
     parser.add_argument("--logdir", type=str, default='./logs', help="Log directory")
+    parser.add_argument("--log_interval", type=int, default=100, help="Frequency of writing the loss and step timings to the logger")
+    parser.add_argument("--log_format", type=str, default='csv,json', help="Comma-separated logger outputs: stdout, log, csv, json, tensorboard")
+    parser.add_argument("--timing", default=False, type=str2bool, help="Time the phases of each training step (data, h2d, forward, loss, backward, allreduce, optimizer, ema); under DDP the all-reduce then runs through a Python comm hook")
     parser.add_argument("--sample_size", type=int, default=64, help="Sampling size of images")
     parser.add_argument("--sample_freq", type=int, default=10000, help="Frequency of sampling during training")        
     parser.add_argument("--sample_steps", type=int, default=18, help="Number of sample diffusion steps")   
@@ -131,45 +176,52 @@ def parse_args():
 
     # Evaluation
     parser.add_argument("--save_step", type=int, default=100000, help="Frequency of saving checkpoints, 0 to disable during training")
+    parser.add_argument("--async_save", default=True, type=str2bool, help="Write checkpoints on a background thread from a pinned CPU snapshot")
+    parser.add_argument("--keep_last", type=int, default=0, help="Number of most recent checkpoints to keep, 0 to keep all")
+    parser.add_argument("--milestone_step", type=int, default=0, help="Never delete checkpoints at multiples of this step, 0 to disable")
     parser.add_argument("--eval_step", type=int, default=50000, help="Frequency of evaluating model, 0 to disable during training")
     parser.add_argument("--num_samples", type=int, default=50000, help="The number of generated images for evaluation")
     parser.add_argument("--ref_batch", type=str, default='./reference_batches/fid_stats_cifar_train.npz', help="FID cache")
 
-    args = parser.parse_args()    
+    args = parser.parse_args(argv)    
     return args
 
 
 def build_dataset(args):
+    # With --noise_repeats k every loaded image is used k times per step
+    assert args.batch_size % args.noise_repeats == 0, "--batch_size must be divisible by --noise_repeats"
+    batch_size = args.batch_size // args.noise_repeats
     if args.dataset == 'CIFAR-10':
         image_size = args.image_size or 32
         train_loader, test_loader = load_dataset(
-            args.data_dir, args.dataset, args.batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
+            args.data_dir, args.dataset, batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
     elif args.dataset == 'CelebA':
         image_size = args.image_size or 64
         train_loader, test_loader = load_dataset(
-            args.data_dir,  args.dataset, args.batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
+            args.data_dir,  args.dataset, batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
     elif args.dataset == 'ImageNet':
         if args.image_size not in [64, 128, 256]:
             raise ValueError("Image size for ImageNet must be one of [64, 128, 256]")
         image_size = args.image_size
         train_loader, test_loader = load_dataset(
-            args.data_dir, args.dataset, args.batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
+            args.data_dir, args.dataset, batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
     elif args.dataset == 'LSUN':
         image_size = args.image_size or 256
         train_loader, test_loader = load_dataset(
-            args.data_dir, args.dataset, args.batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
+            args.data_dir, args.dataset, batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
     elif args.dataset == 'Latent':
         image_size = args.image_size or 32  # Assuming latent is 32x32x4
         train_loader, test_loader = load_dataset(
-            args.data_dir, args.dataset, args.batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
+            args.data_dir, args.dataset, batch_size, image_size, num_workers=args.num_workers, shuffle=not args.parallel)
     else:
         raise ValueError(f"Unsupported dataset: {args.dataset}")
     
     if args.parallel:
-        world_size = dist.get_world_size()
-        rank = dist.get_rank()
+        # The ranks of a tensor-parallel group share a data shard
+        world_size = tensor_parallel.data_parallel_size()
+        rank = tensor_parallel.data_parallel_rank()
 
-        per_gpu_batch_size = args.batch_size // world_size
+        per_gpu_batch_size = batch_size // world_size
 
         train_sampler = DistributedSampler(train_loader.dataset, num_replicas=world_size, rank=rank)
 
@@ -214,14 +266,19 @@ def build_model(args):
         model = model_dict[args.model](image_size=args.image_size, patch_size=args.patch_size,
                                        num_classes=args.num_classes, in_channels=args.in_chans,
                                        learn_sigma=args.learn_sigma, drop_rate=args.dropout, 
-                                       drop_label_prob=args.drop_label_prob)
+                                       drop_label_prob=args.drop_label_prob,
+                                       mask_decoder_depth=getattr(args, 'mask_decoder_depth', 0))
 
     elif "DiT" in args.model:
         model = model_dict[args.model](image_size=args.image_size, patch_size=args.patch_size,
                                        in_channels=args.in_chans, num_classes=args.num_classes,
                                        learn_sigma=args.learn_sigma,
-                                       class_dropout_prob=args.drop_label_prob)
-    
+                                       class_dropout_prob=args.drop_label_prob,
+                                       mask_decoder_depth=getattr(args, 'mask_decoder_depth', 0))
+
+    if getattr(args, 'checkpoint_policy', None) is not None:
+        set_checkpoint_policy(model.checkpoint_blocks(), args.checkpoint_policy, args.checkpoint_every)
+
     return model
 
 
@@ -310,62 +367,119 @@ def train(args, **kwargs):
     # If resuming training from a checkpoint, set the start step
     start_step = checkpoint['step'] if args.resume and checkpoint else 0
 
+    writer = build_checkpoint_writer(args)
+
     # Start training
     with trange(start_step, args.total_steps, initial=start_step, total=args.total_steps, 
                 dynamic_ncols=True, disable=not dist_util.is_main_process()) as pbar:
         trainer = Trainer(args, device, model, ema_model, optimizer, scheduler, diffusion, train_loader, start_step, pbar)
+        if args.resume and checkpoint:
+            restore_training_state(checkpoint, scheduler, trainer)
         for step in range(start_step + 1, args.total_steps + 1):
             
             loss = trainer.train_step(step)      
             # Sample and save images
             if args.sample_freq > 0 and step % args.sample_freq == 0:
                 # sample_and_save(args, step, device, ema_model, sample_diffusion, save_grid=True)
-                generate_samples(args, step, device, ema_model, sample_diffusion, save_grid=True)
+                with trainer.timer.phase("sample"):
+                    generate_samples(args, step, device, ema_model, sample_diffusion, save_grid=True)
     
             # Save checkpoint
             if args.save_step > 0 and step % args.save_step == 0 and step > 0:
-                if dist_util.is_main_process():
-                    save_checkpoint(args, step, model, optimizer, ema_model=ema_model)  
+                # Called on every rank: gathering sharded state is a collective
+                save_checkpoint(args, step, model, optimizer, ema_model=ema_model, writer=writer,
+                                scheduler=scheduler, trainer=trainer)  
         
-            # Evaluate
+            # Evaluate, without consuming the RNG streams of training so that
+            # a run resumed from the checkpoint above continues identically
             if args.eval and args.eval_step > 0 and step % args.eval_step == 0 and step > 0:
-                eval(args, **{**kwargs, 'step': step})  
+                with preserve_rng_state(), trainer.timer.phase("eval"):
+                    eval(args, **{**kwargs, 'step': step})  
                 
             if args.parallel: 
                 dist.barrier()                        
 
+            trainer.log_step(step, loss)
 
-def init(args):
-    if args.parallel:
-        dist_util.setup_dist()  
-        local_rank = int(os.getenv('LOCAL_RANK', 0))
-        device = torch.device(f'cuda:{local_rank}')
-    else:
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        
-    set_random_seed(args, args.seed)
-    train_loader, _ = build_dataset(args)
-    
+    if writer is not None:
+        writer.close()
+
+
+def train_experiments(args, **kwargs):
+    """Train the --experiments together; samples, metrics and checkpoints stay per experiment."""
+    experiments, train_loader, device, start_step = (
+        kwargs['experiments'], kwargs['train_loader'], kwargs['device'], kwargs['step'])
+
+    for exp in experiments:
+        exp_args = exp['args']
+        exp['writer'] = build_checkpoint_writer(exp_args)
+        exp['eval_dir'] = os.path.join(exp_args.logdir, exp_args.dataset, 'evaluate')
+        if dist_util.is_main_process():
+            os.makedirs(exp['eval_dir'], exist_ok=True)
+            model_size = sum(param.data.nelement() for param in exp['model'].parameters())
+            print('%s: %s, %.2f M params' % (exp_args.experiment, exp_args.model, model_size / 1_000_000))
+    if dist_util.is_main_process():
+        print('Total batch size (per update step): %d' % (args.batch_size * args.grad_accumulation))
+
+    with trange(start_step, args.total_steps, initial=start_step, total=args.total_steps,
+                dynamic_ncols=True, disable=not dist_util.is_main_process()) as pbar:
+        trainer = MultiTrainer(args, device, experiments, train_loader, start_step, pbar)
+        for exp, exp_trainer in zip(experiments, trainer.trainers):
+            if exp['checkpoint']:
+                restore_training_state(exp['checkpoint'], exp['scheduler'], exp_trainer)
+        for step in range(start_step + 1, args.total_steps + 1):
+
+            losses = trainer.train_step(step)
+            if args.sample_freq > 0 and step % args.sample_freq == 0:
+                for exp in experiments:
+                    generate_samples(exp['args'], step, device, exp['ema_model'], exp['sample_diffusion'], save_grid=True)
+
+            # Saved after all sampling, so every experiment stores the same RNG state
+            if args.save_step > 0 and step % args.save_step == 0:
+                for exp, exp_trainer in zip(experiments, trainer.trainers):
+                    # Called on every rank: gathering sharded state is a collective
+                    save_checkpoint(exp['args'], step, exp['model'], exp['optimizer'], ema_model=exp['ema_model'],
+                                    writer=exp['writer'], scheduler=exp['scheduler'], trainer=exp_trainer)
+
+            if args.eval and args.eval_step > 0 and step % args.eval_step == 0:
+                for exp in experiments:
+                    with preserve_rng_state():
+                        eval(exp['args'], **{**kwargs, 'model': exp['model'], 'ema_model': exp['ema_model'],
+                                             'sample_diffusion': exp['sample_diffusion'],
+                                             'eval_dir': exp['eval_dir'], 'step': step})
+
+            if args.parallel:
+                dist.barrier()
+
+            trainer.log_step(step, losses)
+        trainer.close()
+
+    for exp in experiments:
+        if exp['writer'] is not None:
+            exp['writer'].close()
+
+
+def build_training_state(args, device):
+    """The diffusions, models, optimizer and scheduler of a run, restored from --resume."""
     diffusion = build_diffusion(args, use_ddim=False)
     sample_diffusion = build_diffusion(args, use_ddim=True)
 
-    
     if args.eval and not args.train:
         ema_model = build_model(args).to(device)
         model = None
         
-        if args.parallel:
-            ema_model = DDP(ema_model, device_ids=[local_rank], output_device=local_rank)
+        ema_model = sharding.wrap_model(ema_model, args, device)
     else:
         model = build_model(args).to(device)
+        if tensor_parallel.is_initialized():
+            model = tensor_parallel.parallelize(model)
         ema_model = copy.deepcopy(model).to(device)
 
-        if args.parallel:
-            model = DDP(model, device_ids=[local_rank], output_device=local_rank)
-            ema_model = DDP(ema_model, device_ids=[local_rank], output_device=local_rank)
+        model = sharding.wrap_model(model, args, device)
+        ema_model = sharding.wrap_model(ema_model, args, device)
 
     if args.train:
-        optimizer = optim.AdamW(model.parameters(), lr=args.lr, betas=args.betas, weight_decay=args.weight_decay, eps=args.eps)
+        optimizer = sharding.build_optimizer(model, args)
         scheduler = optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=get_lr_lambda(args))
     else:
         optimizer = None
@@ -381,6 +495,43 @@ def init(args):
         checkpoint = None
         step = 0
 
+    return {
+        'model': model, 'ema_model': ema_model, 'checkpoint': checkpoint, 'diffusion': diffusion,
+        'sample_diffusion': sample_diffusion, 'optimizer': optimizer, 'scheduler': scheduler, 'step': step }
+
+
+def init(args):
+    device = dist_util.setup_dist(args.dist_backend) if args.parallel else dist_util.dev()
+    assert args.tensor_parallel == 1 or args.parallel, "--tensor_parallel needs --parallel True"
+    if args.parallel and args.tensor_parallel > 1:
+        assert args.shard == 'none', "--tensor_parallel composes with DDP (--shard none)"
+        tensor_parallel.initialize(args.tensor_parallel)
+        
+    set_random_seed(args, args.seed)
+    compile_util.configure(args)
+    set_attention_backend(args.attention_backend, args.attention_chunk_size)
+    if args.autotune:
+        autotune.autotune(args, device, build_model, build_diffusion)
+    if args.resume and not args.experiments:
+        args.resume = resolve_resume(args)
+    logger.configure(dir=os.path.join(args.logdir, args.dataset, 'log'),
+                     format_strs=args.log_format.split(',') if dist_util.is_main_process() else [])
+    train_loader, _ = build_dataset(args)
+    
+    if args.experiments:
+        assert args.train, "--experiments trains; evaluate each experiment's checkpoint on its own"
+        experiments = []
+        for exp_args in experiment_args(args):
+            assert exp_args.resume in (None, 'auto'), "--experiments resumes with --resume auto"
+            if exp_args.resume:
+                exp_args.resume = resolve_resume(exp_args)
+            experiments.append({'args': exp_args, **build_training_state(exp_args, device)})
+        steps = {exp['step'] for exp in experiments}
+        assert len(steps) == 1, f"--experiments resume from different steps {sorted(steps)}; they share one data stream"
+        state = {'experiments': experiments, 'step': steps.pop()}
+    else:
+        state = build_training_state(args, device)
+
     config = tf.ConfigProto(allow_soft_placement=True)
     config.gpu_options.allow_growth = True
     evaluator = Evaluator(tf.Session(config=config))
@@ -405,14 +556,15 @@ def init(args):
         dist.barrier()
 
     return {
-        'device': device, 'train_loader': train_loader, 'model': model, 'ema_model': ema_model, 'checkpoint': checkpoint,
-        'diffusion': diffusion, 'sample_diffusion': sample_diffusion, 'optimizer': optimizer, 'scheduler': scheduler,'evaluator': evaluator, 
-        'ref_acts': ref_acts, 'ref_stats': ref_stats, 'ref_stats_spatial': ref_stats_spatial, 'eval_dir': eval_dir, 'step': step }
+        'device': device, 'train_loader': train_loader, 'evaluator': evaluator, 'ref_acts': ref_acts,
+        'ref_stats': ref_stats, 'ref_stats_spatial': ref_stats_spatial, 'eval_dir': eval_dir, **state }
 
 def main():
     args = parse_args()
     init_params = init(args)  
-    if args.train:
+    if args.train and args.experiments:
+        train_experiments(args, **init_params)
+    elif args.train:
         train(args, **init_params)  
     if args.eval and not args.train:        
         assert args.resume, "Evaluation requires a checkpoint path provided with --resume"   
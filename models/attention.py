@@ -0,0 +1,154 @@
+"""
+Attention backends shared by every model family.
+
+The models keep their own projections and parameter layouts (so existing
+checkpoints load unchanged) and call attention() for the core
+softmax(q k^T * scale + bias) v, which dispatches to the backend selected
+with set_attention_backend() (--attention_backend):
+
+  sdpa       torch.nn.functional.scaled_dot_product_attention, which picks
+             the flash / memory-efficient kernels when it can.
+  chunked    math in blocks of CHUNK_SIZE queries with a float32 softmax, so
+             the score matrix is never materialised in full; for CPU and
+             long sequences.
+  reference  the plain math in float32, as the models computed it before.
+  xformers   xformers.ops.memory_efficient_attention, if installed.
+
+New backends only need a registered function of (q, k, v, scale, bias,
+dropout_p) on [B x H x L x D] tensors:
+
+    @register_attention_backend("mine")
+    def _mine(q, k, v, scale, bias=None, dropout_p=0.0):
+        ...
+
+Run `python -m checks.attention` to check every backend against the
+previous attention implementations of the UNet, ViT, DiT (timm) and U-ViT.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+ATTENTION_BACKENDS = {}
+
+# Queries per block of the chunked backend
+CHUNK_SIZE = 1024
+
+_BACKEND = "sdpa"
+
+
+def register_attention_backend(name):
+    def decorator(fn):
+        ATTENTION_BACKENDS[name] = fn
+        return fn
+
+    return decorator
+
+
+def set_attention_backend(name, chunk_size=None):
+    """
+    Select the backend of every attention() call, and optionally the number
+    of queries per block of the chunked backend.
+    """
+    global _BACKEND, CHUNK_SIZE
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {name!r}, expected one of {list(ATTENTION_BACKENDS)}")
+    _BACKEND = name
+    if chunk_size is not None:
+        CHUNK_SIZE = chunk_size
+
+
+def get_attention_backend():
+    return _BACKEND
+
+
+def attention(q, k, v, scale=None, bias=None, dropout_p=0.0):
+    """
+    Multi-head attention with the selected backend.
+
+    :param q, k, v: [B x H x L x D] tensors.
+    :param scale: the factor of the scores, default D ** -0.5.
+    :param bias: an optional additive bias of the scores, broadcastable to
+                 [B x H x L x L].
+    :param dropout_p: dropout probability of the attention weights.
+    :return: a [B x H x L x D] tensor.
+    """
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+    return ATTENTION_BACKENDS[_BACKEND](q, k, v, scale, bias=bias, dropout_p=dropout_p)
+
+
+@register_attention_backend("sdpa")
+def _sdpa(q, k, v, scale, bias=None, dropout_p=0.0):
+    if bias is not None:
+        bias = bias.to(q.dtype)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=dropout_p, scale=scale)
+
+
+@register_attention_backend("chunked")
+def _chunked(q, k, v, scale, bias=None, dropout_p=0.0):
+    k_t = k.transpose(-2, -1)
+    chunks = []
+    for start in range(0, q.shape[-2], CHUNK_SIZE):
+        scores = (q[..., start:start + CHUNK_SIZE, :] @ k_t).float() * scale
+        if bias is not None:
+            scores = scores + bias[..., start:start + CHUNK_SIZE, :]
+        weights = F.dropout(scores.softmax(dim=-1), p=dropout_p)
+        chunks.append(weights.type(v.dtype) @ v)
+    return torch.cat(chunks, dim=-2)
+
+
+@register_attention_backend("reference")
+def _reference(q, k, v, scale, bias=None, dropout_p=0.0):
+    scores = (q.float() @ k.float().transpose(-2, -1)) * scale
+    if bias is not None:
+        scores = scores + bias.float()
+    weights = F.dropout(scores.softmax(dim=-1), p=dropout_p)
+    return (weights @ v.float()).type(q.dtype)
+
+
+try:
+    import xformers.ops
+except ImportError:
+    pass
+else:
+    @register_attention_backend("xformers")
+    def _xformers(q, k, v, scale, bias=None, dropout_p=0.0):
+        if bias is not None:
+            bias = bias.to(q.dtype).expand(q.shape[0], q.shape[1], q.shape[2], k.shape[2])
+        # xformers takes [B x L x H x D]
+        out = xformers.ops.memory_efficient_attention(
+            q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_bias=bias, p=dropout_p, scale=scale
+        )
+        return out.transpose(1, 2)
+
+
+class Attention(nn.Module):
+    """
+    Token self-attention with the parameter layout of timm's Attention (used
+    by DiT and U-ViT), computed with attention().
+    """
+
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+        super().__init__()
+        assert dim % num_heads == 0, "dim should be divisible by num_heads"
+        self.num_heads = num_heads
+        head_dim = dim // num_heads
+        self.scale = qk_scale or head_dim ** -0.5
+
+        self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
+        self.attn_drop = nn.Dropout(attn_drop)
+        self.proj = nn.Linear(dim, dim)
+        self.proj_drop = nn.Dropout(proj_drop)
+
+    def forward(self, x):
+        B, L, C = x.shape
+        # Heads and widths from qkv's output, which tensor parallelism shards
+        qkv = self.qkv(x).reshape(B, L, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)  # B H L D
+        dropout_p = self.attn_drop.p if self.training else 0.0
+        x = attention(q, k, v, scale=self.scale, dropout_p=dropout_p)
+        x = x.transpose(1, 2).reshape(B, L, -1)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
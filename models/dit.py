@@ -14,7 +14,12 @@ import math
 import numpy as np
 import torch
 import torch.nn as nn
-from timm.models.vision_transformer import Attention, Mlp, PatchEmbed
+from timm.models.vision_transformer import Mlp, PatchEmbed
+
+from models.attention import Attention
+
+from tools.masking import drop_tokens, restore_tokens
+from tools.nn import checkpoint
 #import warnings
 
 #warnings.filterwarnings("ignore", message=".*flash attention.*")
@@ -120,13 +125,31 @@ class DiTBlock(nn.Module):
         approx_gelu = lambda: nn.GELU(approximate="tanh")
         self.mlp = Mlp(in_features=hidden_size, hidden_features=mlp_hidden_dim, act_layer=approx_gelu, drop=0)
         self.adaLN_modulation = nn.Sequential(nn.SiLU(), nn.Linear(hidden_size, 6 * hidden_size, bias=True))
+        # Activation checkpointing of the whole block or of a single sub-layer,
+        # see tools.nn.set_checkpoint_policy().
+        self.use_checkpoint = False
+        self.checkpoint_attn = False
+        self.checkpoint_mlp = False
 
     def forward(self, x, c):
+        return checkpoint(self._forward, (x, c), self.parameters(), self.use_checkpoint)
+
+    def _forward(self, x, c):
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
-        x = x + gate_msa.unsqueeze(1) * self.attn(modulate(self.norm1(x), shift_msa, scale_msa))
-        x = x + gate_mlp.unsqueeze(1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
+        x = x + gate_msa.unsqueeze(1) * checkpoint(
+            self._attn, (x, shift_msa, scale_msa), self.attn.parameters(), self.checkpoint_attn
+        )
+        x = x + gate_mlp.unsqueeze(1) * checkpoint(
+            self._mlp, (x, shift_mlp, scale_mlp), self.mlp.parameters(), self.checkpoint_mlp
+        )
         return x
 
+    def _attn(self, x, shift, scale):
+        return self.attn(modulate(self.norm1(x), shift, scale))
+
+    def _mlp(self, x, shift, scale):
+        return self.mlp(modulate(self.norm2(x), shift, scale))
+
 
 class FinalLayer(nn.Module):
     """
@@ -163,6 +186,7 @@ class DiT(nn.Module):
         class_dropout_prob=0.1,
         num_classes=1000,
         learn_sigma=False,
+        mask_decoder_depth=0,
     ):
         super().__init__()
         self.learn_sigma = learn_sigma
@@ -179,6 +203,11 @@ class DiT(nn.Module):
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches, hidden_size), requires_grad=False)
 
         self.blocks = nn.ModuleList([DiTBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio) for _ in range(depth)])
+        # Masked training (see tools/masking.py): blocks on the restored token grid
+        self.decoder_blocks = nn.ModuleList(
+            [DiTBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio) for _ in range(mask_decoder_depth)]
+        )
+        self.mask_token = nn.Parameter(torch.zeros(1, 1, hidden_size)) if mask_decoder_depth > 0 else None
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
         self.initialize_weights()
 
@@ -208,8 +237,11 @@ class DiT(nn.Module):
         nn.init.normal_(self.t_embedder.mlp[0].weight, std=0.02)
         nn.init.normal_(self.t_embedder.mlp[2].weight, std=0.02)
 
+        if self.mask_token is not None:
+            nn.init.normal_(self.mask_token, std=0.02)
+
         # Zero-out adaLN modulation layers in DiT blocks:
-        for block in self.blocks:
+        for block in [*self.blocks, *self.decoder_blocks]:
             nn.init.constant_(block.adaLN_modulation[-1].weight, 0)
             nn.init.constant_(block.adaLN_modulation[-1].bias, 0)
 
@@ -219,6 +251,9 @@ class DiT(nn.Module):
         nn.init.constant_(self.final_layer.linear.weight, 0)
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
+    def checkpoint_blocks(self):
+        return [*self.blocks, *self.decoder_blocks]
+
     def unpatchify(self, x):
         """
         x: (N, T, patch_size**2 * C)
@@ -234,19 +269,27 @@ class DiT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], c, h * p, h * p))
         return imgs
 
-    def forward(self, x, t, y, **kwargs):
+    def forward(self, x, t, y, token_mask=None, **kwargs):
         """
         Forward pass of DiT.
         x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
         t: (N,) tensor of diffusion timesteps
         y: (N,) tensor of class labels
+        token_mask: optional (N, T) bool tensor of patch tokens to drop before the blocks
         """
         x = self.x_embedder(x) + self.pos_embed  # (N, T, D), where T = H * W / patch_size ** 2
         t = self.t_embedder(t)  # (N, D)
         y = self.y_embedder(y, self.training)  # (N, D)
         c = t + y  # (N, D)
+        if token_mask is not None:
+            x = drop_tokens(x, token_mask)  # (N, T_visible, D)
         for block in self.blocks:
             x = block(x, c)  # (N, T, D)
+        if token_mask is not None:
+            fill = self.pos_embed if self.mask_token is None else self.mask_token + self.pos_embed
+            x = restore_tokens(x, token_mask, fill)
+        for block in self.decoder_blocks:
+            x = block(x, c)
         x = self.final_layer(x, c)  # (N, T, patch_size ** 2 * out_channels)
         x = self.unpatchify(x)  # (N, out_channels, H, W)
         return x
@@ -8,6 +8,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.cuda.amp import autocast
 # from tools.fp16_util import convert_module_to_f16, convert_module_to_f32
+from models.attention import attention
 from tools.nn import (
     checkpoint,
     conv_nd,
@@ -157,6 +158,8 @@ class ResBlock(TimestepBlock):
     :param down: if True, use this block for downsampling.
     """
 
+    checkpoint_kind = "mlp"
+
     def __init__(
         self,
         channels,
@@ -264,6 +267,8 @@ class AttentionBlock(nn.Module):
     https://github.com/hojonathanho/diffusion/blob/1e0dceb3b3495bbe19116a5e1b3596cd0706c543/diffusion_tf/models/unet.py#L66.
     """
 
+    checkpoint_kind = "attn"
+
     def __init__(
         self,
         channels,
@@ -281,7 +286,10 @@ class AttentionBlock(nn.Module):
                 channels % num_head_channels == 0
             ), f"q,k,v channels {channels} is not divisible by num_head_channels {num_head_channels}"
             self.num_heads = channels // num_head_channels
-        self.use_checkpoint = use_checkpoint
+        # Attention activations grow quadratically with resolution, so this
+        # block has always been checkpointed regardless of `use_checkpoint`.
+        # tools.nn.set_checkpoint_policy() can override it.
+        self.use_checkpoint = True
         self.norm = normalization(channels)
         self.qkv = conv_nd(1, channels, channels * 3, 1)
         if use_new_attention_order:
@@ -294,7 +302,11 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)
+        # Checkpointing only pays off when a backward pass follows; sampling and
+        # evaluation take the direct path.
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(self._forward, (x,), self.parameters(), True)
+        return self._forward(x)
 
     def _forward(self, x):
         b, c, *spatial = x.shape
@@ -326,6 +338,19 @@ def count_flops_attn(model, _x, y):
     model.total_ops += torch.DoubleTensor([matmul_ops])
 
 
+def count_flops_token_attn(model, _x, y):
+    """
+    The counterpart of `count_flops_attn` for the token attention of the
+    transformer models, whose output `y` is [N x T x C]. The width of the
+    attention is taken from the qkv projection, which may differ from C.
+    """
+    b, num_tokens, c = y.shape
+    if hasattr(model, "qkv"):
+        c = model.qkv.out_features // 3
+    matmul_ops = 2 * b * (num_tokens ** 2) * c
+    model.total_ops += torch.DoubleTensor([matmul_ops])
+
+
 class QKVAttentionLegacy(nn.Module):
     """
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
@@ -345,14 +370,10 @@ class QKVAttentionLegacy(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, -1, length)
+        # [N x H x T x C] per head, see models/attention.py
+        q, k, v = qkv.reshape(bs, self.n_heads, ch * 3, length).transpose(-2, -1).split(ch, dim=-1)
+        a = attention(q, k, v, scale=1 / math.sqrt(ch))
+        return a.transpose(-2, -1).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -378,16 +399,10 @@ class QKVAttention(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
-        return a.reshape(bs, -1, length)
+        # [N x H x T x C] per head, see models/attention.py
+        q, k, v = (x.reshape(bs, self.n_heads, ch, length).transpose(-2, -1) for x in qkv.chunk(3, dim=1))
+        a = attention(q, k, v, scale=1 / math.sqrt(ch))
+        return a.transpose(-2, -1).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -641,6 +656,15 @@ class UNetModel(nn.Module):
     #     self.middle_block.apply(convert_module_to_f32)
     #     self.output_blocks.apply(convert_module_to_f32)
 
+    def checkpoint_blocks(self):
+        """
+        Return the ResBlocks and AttentionBlocks in forward order, for
+        tools.nn.set_checkpoint_policy().
+        """
+        return [
+            m for m in self.modules() if isinstance(m, (ResBlock, AttentionBlock))
+        ]
+
     def token_drop(self, labels, force_drop_ids=None):
         """
         Drops labels to enable classifier-free guidance.
@@ -3,18 +3,8 @@ import torch.nn as nn
 import math
 from tools.timm import trunc_normal_, Mlp
 import einops
-import torch.utils.checkpoint
-
-if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
-    ATTENTION_MODE = 'flash'
-else:
-    try:
-        import xformers
-        import xformers.ops
-        ATTENTION_MODE = 'xformers'
-    except:
-        ATTENTION_MODE = 'math'
-print(f'attention mode is {ATTENTION_MODE}')
+from tools.nn import checkpoint
+from models.attention import Attention
 
 
 def timestep_embedding(timesteps, dim, max_period=10000):
@@ -51,47 +41,6 @@ def unpatchify(x, channels=3):
     return x
 
 
-class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
-        super().__init__()
-        self.num_heads = num_heads
-        head_dim = dim // num_heads
-        self.scale = qk_scale or head_dim ** -0.5
-
-        self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
-        self.attn_drop = nn.Dropout(attn_drop)
-        self.proj = nn.Linear(dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
-
-    def forward(self, x):
-        B, L, C = x.shape
-
-        qkv = self.qkv(x)
-        if ATTENTION_MODE == 'flash':
-            qkv = einops.rearrange(qkv, 'B L (K H D) -> K B H L D', K=3, H=self.num_heads).float()
-            q, k, v = qkv[0], qkv[1], qkv[2]  # B H L D
-            x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
-            x = einops.rearrange(x, 'B H L D -> B L (H D)')
-        elif ATTENTION_MODE == 'xformers':
-            qkv = einops.rearrange(qkv, 'B L (K H D) -> K B L H D', K=3, H=self.num_heads)
-            q, k, v = qkv[0], qkv[1], qkv[2]  # B L H D
-            x = xformers.ops.memory_efficient_attention(q, k, v)
-            x = einops.rearrange(x, 'B L H D -> B L (H D)', H=self.num_heads)
-        elif ATTENTION_MODE == 'math':
-            qkv = einops.rearrange(qkv, 'B L (K H D) -> K B H L D', K=3, H=self.num_heads)
-            q, k, v = qkv[0], qkv[1], qkv[2]  # B H L D
-            attn = (q @ k.transpose(-2, -1)) * self.scale
-            attn = attn.softmax(dim=-1)
-            attn = self.attn_drop(attn)
-            x = (attn @ v).transpose(1, 2).reshape(B, L, C)
-        else:
-            raise NotImplemented
-
-        x = self.proj(x)
-        x = self.proj_drop(x)
-        return x
-
-
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None,
@@ -105,20 +54,25 @@ class Block(nn.Module):
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer)
         self.skip_linear = nn.Linear(2 * dim, dim) if skip else None
         self.use_checkpoint = use_checkpoint
+        self.checkpoint_attn = False
+        self.checkpoint_mlp = False
 
     def forward(self, x, skip=None):
-        if self.use_checkpoint:
-            return torch.utils.checkpoint.checkpoint(self._forward, x, skip)
-        else:
-            return self._forward(x, skip)
+        return checkpoint(self._forward, (x, skip), self.parameters(), self.use_checkpoint)
 
     def _forward(self, x, skip=None):
         if self.skip_linear is not None:
             x = self.skip_linear(torch.cat([x, skip], dim=-1))
-        x = x + self.attn(self.norm1(x))
-        x = x + self.mlp(self.norm2(x))
+        x = x + checkpoint(self._attn, (x,), self.attn.parameters(), self.checkpoint_attn)
+        x = x + checkpoint(self._mlp, (x,), self.mlp.parameters(), self.checkpoint_mlp)
         return x
 
+    def _attn(self, x):
+        return self.attn(self.norm1(x))
+
+    def _mlp(self, x):
+        return self.mlp(self.norm2(x))
+
 
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
@@ -198,6 +152,9 @@ class UViT(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed'}
 
+    def checkpoint_blocks(self):
+        return [*self.in_blocks, self.mid_block, *self.out_blocks]
+
     def forward(self, x, timesteps, y=None):
         x = self.patch_embed(x)
         B, L, D = x.shape
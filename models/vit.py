@@ -14,7 +14,11 @@ import torch.nn.functional as F
 from timm.models.layers import drop_path, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
 from copy import deepcopy
-from timm.models.vision_transformer import Attention, Mlp, PatchEmbed
+from timm.models.vision_transformer import Mlp, PatchEmbed
+
+from models.attention import attention
+from tools.masking import drop_tokens, restore_tokens
+from tools.nn import checkpoint
 
 # def _cfg(url='', **kwargs):
 #     return {
@@ -151,34 +155,27 @@ class Attention(nn.Module):
 
     def forward(self, x, rel_pos_bias=None):
         B, N, C = x.shape
-        qkv_bias = None
-        if self.q_bias is not None:
-            qkv_bias = torch.cat((self.q_bias, torch.zeros_like(self.v_bias, requires_grad=False), self.v_bias))
-        #qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        # Ensure qkv_bias has the same dtype as x        
-        qkv_bias = qkv_bias.type_as(x) if qkv_bias is not None else None
-        #qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias.type(x.dtype))
-        qkv = F.linear(input=x, weight=self.qkv.weight.type_as(x), bias=qkv_bias)
+        qkv = F.linear(input=x, weight=self.qkv.weight.type_as(x))
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
+        if self.q_bias is not None:
+            # k has no bias; adding q and v biases here avoids concatenating a zero k-bias
+            q = q + self.q_bias.type_as(x).view(self.num_heads, 1, -1)
+            v = v + self.v_bias.type_as(x).view(self.num_heads, 1, -1)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
+        bias = None
         if self.relative_position_bias_table is not None:
             relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
                 self.window_size[0] * self.window_size[1] + self.num_extra_tokens,
                 self.window_size[0] * self.window_size[1] + self.num_extra_tokens, -1)
-            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()
-            attn = attn + relative_position_bias.unsqueeze(0)
+            bias = relative_position_bias.permute(2, 0, 1).unsqueeze(0)
 
         if rel_pos_bias is not None:
-            attn = attn + rel_pos_bias
+            bias = rel_pos_bias if bias is None else bias + rel_pos_bias
 
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+        dropout_p = self.attn_drop.p if self.training else 0.0
+        x = attention(q, k, v, scale=self.scale, bias=bias, dropout_p=dropout_p)
+        x = x.transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x.type_as(self.proj.weight))
         x = self.proj_drop(x)
         return x
@@ -205,16 +202,28 @@ class Block(nn.Module):
             self.gamma_2 = nn.Parameter(init_values * torch.ones((dim)),requires_grad=True)
         else:
             self.gamma_1, self.gamma_2 = None, None
+        # Activation checkpointing of the whole block or of a single sub-layer,
+        # see tools.nn.set_checkpoint_policy().
+        self.use_checkpoint = False
+        self.checkpoint_attn = False
+        self.checkpoint_mlp = False
 
     def forward(self, x, rel_pos_bias=None):
-        if self.gamma_1 is None:
-            x = x + self.drop_path(self.attn(self.norm1(x.float()).type(x.dtype), rel_pos_bias=rel_pos_bias))
-            x = x + self.drop_path(self.mlp(self.norm2(x.float()).type(x.dtype)))
-        else:
-            x = x + self.drop_path(self.gamma_1 * self.attn(self.norm1(x.float()).type(x.dtype), rel_pos_bias=rel_pos_bias))
-            x = x + self.drop_path(self.gamma_2 * self.mlp(self.norm2(x.float()).type(x.dtype)))
+        return checkpoint(self._forward, (x, rel_pos_bias), self.parameters(), self.use_checkpoint)
+
+    def _forward(self, x, rel_pos_bias=None):
+        h = checkpoint(self._attn, (x, rel_pos_bias), self.attn.parameters(), self.checkpoint_attn)
+        x = x + self.drop_path(h if self.gamma_1 is None else self.gamma_1 * h)
+        h = checkpoint(self._mlp, (x,), self.mlp.parameters(), self.checkpoint_mlp)
+        x = x + self.drop_path(h if self.gamma_2 is None else self.gamma_2 * h)
         return x
 
+    def _attn(self, x, rel_pos_bias=None):
+        return self.attn(self.norm1(x.float()).type(x.dtype), rel_pos_bias=rel_pos_bias)
+
+    def _mlp(self, x):
+        return self.mlp(self.norm2(x.float()).type(x.dtype))
+
 
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
@@ -304,7 +313,7 @@ class ViT(nn.Module):
                  drop_path_rate=0., norm_layer=nn.LayerNorm, init_values=None,
                  use_abs_pos_emb=True, use_rel_pos_bias=False, use_shared_rel_pos_bias=False,
                  use_mean_pooling=True, init_scale=0.001, use_conv_last=False, num_steps=4000,
-                 learn_sigma=False, use_fp16=False, drop_label_prob=0.0, **kwargs):  #classifier_free_scale=1.0,
+                 learn_sigma=False, use_fp16=False, drop_label_prob=0.0, mask_decoder_depth=0, **kwargs):  #classifier_free_scale=1.0,
         super().__init__()
         self.num_classes = num_classes
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
@@ -341,6 +350,14 @@ class ViT(nn.Module):
                 init_values=init_values, num_extra_tokens=self.num_extra_tokens,
                 window_size=self.patch_embed.patch_shape if use_rel_pos_bias else None)
             for i in range(depth)])
+        # Masked training (see tools/masking.py): blocks on the restored token grid
+        self.decoder_blocks = nn.ModuleList([
+            Block(
+                dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
+                drop=drop_rate, attn_drop=attn_drop_rate, norm_layer=norm_layer,
+                init_values=init_values, num_extra_tokens=self.num_extra_tokens)
+            for _ in range(mask_decoder_depth)])
+        self.mask_token = nn.Parameter(torch.zeros(1, 1, embed_dim)) if mask_decoder_depth > 0 else None
         self.norm = nn.Identity() if use_mean_pooling else norm_layer(embed_dim)
 
         if learn_sigma:
@@ -356,6 +373,8 @@ class ViT(nn.Module):
 
         if self.pos_embed is not None:
             trunc_normal_(self.pos_embed, std=.02)
+        if self.mask_token is not None:
+            trunc_normal_(self.mask_token, std=.02)
 
         if isinstance(self.linear_projection, nn.Linear):
             trunc_normal_(self.linear_projection.weight, std=.02)
@@ -400,6 +419,9 @@ class ViT(nn.Module):
     def get_num_layers(self):
         return len(self.blocks)
 
+    def checkpoint_blocks(self):
+        return [*self.blocks, *self.decoder_blocks]
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
@@ -442,7 +464,7 @@ class ViT(nn.Module):
         labels = torch.where(drop_ids, self.num_classes, labels)
         return labels
     
-    def forward_features(self, x, timesteps, y=None, force_drop_ids=None):
+    def forward_features(self, x, timesteps, y=None, force_drop_ids=None, token_mask=None):
         x = self.patch_embed(x)
         B, L, C = x.size()
         timesteps = timesteps.long() #ensure timesteps are longtensor
@@ -463,15 +485,31 @@ class ViT(nn.Module):
 
         rel_pos_bias = self.rel_pos_bias() if self.rel_pos_bias is not None else None
         x = x.type(self.dtype)
+        if token_mask is not None:
+            # Relative position biases are tied to the full token grid
+            assert rel_pos_bias is None and not self.use_rel_pos_bias, "masked training needs absolute positions"
+            e = self.num_extra_tokens
+            x = torch.cat((x[:, :e], drop_tokens(x[:, e:], token_mask)), dim=1)
         for blk in self.blocks:
             x = blk(x, rel_pos_bias=rel_pos_bias)
+        if token_mask is not None:
+            x = torch.cat((x[:, :e], restore_tokens(x[:, e:], token_mask, self._mask_fill(x))), dim=1)
+        for blk in self.decoder_blocks:
+            x = blk(x, rel_pos_bias=rel_pos_bias)
     
         x = self.norm(x)
         return x
 
-    def forward(self, x, timesteps, y=None, force_drop_ids=None, **kwargs):
+    def _mask_fill(self, x):
+        """Tokens of the dropped positions: mask token plus positional embedding."""
+        fill = x.new_zeros(1, 1, x.shape[-1]) if self.mask_token is None else self.mask_token
+        if self.pos_embed is not None:
+            fill = fill + self.pos_embed[:, self.num_extra_tokens:]
+        return fill
+
+    def forward(self, x, timesteps, y=None, force_drop_ids=None, token_mask=None, **kwargs):
         input_dtype = x.dtype
-        x = self.forward_features(x, timesteps, y=y, force_drop_ids=force_drop_ids)
+        x = self.forward_features(x, timesteps, y=y, force_drop_ids=force_drop_ids, token_mask=token_mask)
         B, L, C = x.shape
 
         x = x.type(input_dtype)
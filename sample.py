@@ -1,13 +1,14 @@
 import argparse
 import os
+import sys
 import torch
 from PIL import Image
 from tools.utils import *
-from tools import dist_util
+from tools import dist_util, compile_util, sharding
 import tensorflow.compat.v1 as tf  # type: ignore
 from tools.sampler import Sampler, Classifier
-from torch.nn.parallel import DistributedDataParallel as DDP
 from main import build_diffusion, build_model
+from models.attention import ATTENTION_BACKENDS, set_attention_backend
 from models.unet import *; from models.dit import *; from models.vit import *; from models.uvit import *
 
 
@@ -26,6 +27,7 @@ def parse_args():
     parser.add_argument("--image_size", type=int, default=32, help="Image size")
     parser.add_argument("--num_classes", type=int, default=1000, help="Number of classes, type is int")
     parser.add_argument("--class_cond", default=True, type=str2bool, help="Set class_cond to enable class-conditional generation.")    
+    parser.add_argument("--mask_decoder_depth", type=int, default=0, help="DiT/ViT: number of mask decoder blocks the model was trained with")
     parser.add_argument("--seed", type=int, default=42, help="Random seed for reproducibility")
 
     # Gaussian Diffusion
@@ -39,13 +41,26 @@ def parse_args():
     # 
     parser.add_argument("--latent_scale", type=float, default=0.18215, help="scaling factor for latent sample normalization. (0.18215 for unit variance)")
     parser.add_argument("--parallel", default=True, type=str2bool, help="Use multi-GPU sampling")
+    parser.add_argument("--dist_backend", type=str, default=None, choices=["nccl", "gloo"], help="Process group backend for --parallel (default: nccl with CUDA, gloo on CPU)")
     parser.add_argument('--amp', default=True, type=str2bool, help='Use AMP for mixed precision sampling')
     parser.add_argument('--resume', type=str, default=None, help='Path to the checkpoint to resume from')
+    parser.add_argument('--weights', type=str, default=None, help='Exported weights file (see export.py); its stored config replaces the model and diffusion flags')
     parser.add_argument("--save_path", type=str, default='./sample_images', help="Log directory")
+    # torch.compile
+    parser.add_argument('--compile', default=False, type=str2bool, help='Compile the denoiser with torch.compile')
+    parser.add_argument('--compile_backend', type=str, default='inductor', help='torch.compile backend (inductor also runs on CPU via its C++ backend)')
+    parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode')
+    parser.add_argument('--compile_verbose', default=False, type=str2bool, help='Log recompilations and graph breaks as they happen')
+    parser.add_argument('--compile_cache_limit', type=int, default=8, help='Max number of recompilations per compiled frame before falling back to eager')
     
+    parser.add_argument('--attention_backend', type=str, default='sdpa', choices=list(ATTENTION_BACKENDS), help='Attention implementation of every model family: sdpa, chunked (blocks of --attention_chunk_size queries, for CPU and long sequences), reference (float32 math) or xformers if installed')
+    parser.add_argument('--attention_chunk_size', type=int, default=1024, help='Queries per block of --attention_backend chunked')
     # Logging & Sampling
     parser.add_argument("--vae", type=str, choices=["ema", "mse"], default="ema")
     parser.add_argument("--solver", type=str, default='heun', choices=['ddim', 'heun', 'euler'], help="Choose sampler 'ddim', 'euler' or 'heun'")
+    parser.add_argument('--sampler_type', type=str, default='sde', choices=['sde', 'ode'], help='Type of flow matching sampler to use')
+    parser.add_argument("--atol", type=float, default=1e-6, help="Absolute tolerance")
+    parser.add_argument("--rtol", type=float, default=1e-3, help="Relative tolerance")
     parser.add_argument('--discretization', type=str, default='edm', choices=['vp', 've', 'iddpm', 'edm'], help='Discretization method for edm solver.')
     parser.add_argument('--schedule', type=str, default='linear', choices=['vp', 've', 'linear'], help='Noise schedule for edm sampling.')
     parser.add_argument('--scaling', type=str, default='none', choices=['vp', 'none'], help='Scaling strategy for model output in edm.')
@@ -63,24 +78,29 @@ def parse_args():
 
 def main():
     args = parse_args()
-    if args.parallel:
-        dist_util.setup_dist()  
-        local_rank = int(os.getenv('LOCAL_RANK', 0))
-        device = torch.device(f'cuda:{local_rank}')
-    else:
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = dist_util.setup_dist(args.dist_backend) if args.parallel else dist_util.dev()
         
     set_random_seed(args, args.seed)
+    compile_util.configure(args)
+    set_attention_backend(args.attention_backend, args.attention_chunk_size)
     
-    sample_diffusion = build_diffusion(args, use_ddim=True)
-    ema_model = build_model(args).to(device)
-    
-    if args.parallel:
-        ema_model = DDP(ema_model, device_ids=[local_rank], output_device=local_rank)
+    if args.weights:
+        ema_model, config = load_inference_checkpoint(args.weights, build_model, device)
+        # The stored architecture and diffusion, except for flags given here.
+        # Older files also stored sampling-only settings, which are dropped.
+        explicit = {arg[2:].split('=')[0] for arg in sys.argv[1:] if arg.startswith('--')}
+        vars(args).update({k: v for k, v in config.items()
+                           if k in MODEL_CONFIG_KEYS + DIFFUSION_CONFIG_KEYS and k not in explicit})
+        ema_model = sharding.wrap_model(ema_model, args, device)
+    else:
+        ema_model = build_model(args).to(device)
+
+        ema_model = sharding.wrap_model(ema_model, args, device)
+        assert os.path.exists(args.resume), 'Error: checkpoint {} not found'.format(args.resume)
+        checkpoint = dist_util.load_state_dict(args.resume, keys=['ema_model'])
+        ema_model.load_state_dict(checkpoint['ema_model'])
 
-    assert os.path.exists(args.resume), 'Error: checkpoint {} not found'.format(args.resume)
-    checkpoint = torch.load(args.resume)
-    ema_model.load_state_dict(checkpoint['ema_model'])
+    sample_diffusion = build_diffusion(args, use_ddim=True)
 
     classifier = Classifier(args, device, ema_model) if args.use_classifier else None
     sampler = Sampler(args, device, ema_model, sample_diffusion, classifier=classifier)
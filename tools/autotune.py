@@ -0,0 +1,223 @@
+"""
+Startup autotuning of the micro-batch size (--autotune).
+
+The built model is probed with forward + backward of the training loss at
+growing micro-batch sizes, under the run's precision (--amp) and
+activation checkpointing policy, until the CUDA peak memory would exceed
+the device memory minus --autotune_headroom and the training state the
+probe doesn't hold (EMA weights and AdamW moments). The micro-batch is the
+largest divisor of the per-rank batch that fits, and --grad_accumulation is
+derived so that the global batch (--batch_size x --grad_accumulation) is
+unchanged. The same search over an eval-mode, no_grad denoiser call (with
+the classifier-free guidance batch doubling) picks --sample_size.
+
+Results are cached in --autotune_cache under a signature of the model,
+resolution, device and the settings that change memory use, so later runs
+skip probing. Rank 0 probes and the other ranks use its result; under
+--tensor_parallel it probes its shard of the model on its own, with the
+communication of the group skipped (tensor_parallel.local_only), so an
+out-of-memory error can't leave the other ranks waiting in a collective.
+"""
+
+import json
+import os
+
+import torch as th
+import torch.distributed as dist
+from torch.cuda.amp import autocast
+
+from tools import dist_util, tensor_parallel
+
+# Largest --sample_size considered
+MAX_SAMPLE_SIZE = 1024
+
+
+def signature(args, device):
+    props = th.cuda.get_device_properties(device)
+    return "|".join(str(v) for v in (
+        args.model, args.image_size, args.in_chans, args.patch_size, props.name, props.total_memory,
+        f"amp={args.amp}", f"checkpoint={args.checkpoint_policy}/{args.checkpoint_every}",
+        f"attention={args.attention_backend}", f"shard={args.shard if args.parallel else 'none'}",
+        f"headroom={args.autotune_headroom}", f"cfg={args.guidance_scale != 1.0}",
+        f"tp={args.tensor_parallel if args.parallel else 1}",
+        # Model size and what a training step computes
+        f"decoder={args.mask_decoder_depth}", f"learn_sigma={args.learn_sigma}", f"class_cond={args.class_cond}",
+        f"mode={args.model_mode}/{args.path_type}", f"repeats={args.noise_repeats}",
+    ))
+
+
+def _load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_cache(path, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def peak_bytes(fn, batch_size, device):
+    """
+    CUDA peak memory of `fn(batch_size)`, or None if it runs out of memory.
+    """
+    th.cuda.synchronize(device)
+    th.cuda.empty_cache()
+    th.cuda.reset_peak_memory_stats(device)
+    try:
+        fn(batch_size)
+        th.cuda.synchronize(device)
+    except th.cuda.OutOfMemoryError:
+        return None
+    finally:
+        th.cuda.empty_cache()
+    return th.cuda.max_memory_allocated(device)
+
+
+def max_batch_size(fits, cap):
+    """
+    Largest batch size in [1, cap] for which `fits` holds, assuming it is
+    monotone: doubling, then bisection. Returns 0 if even 1 doesn't fit.
+    """
+    low, high = 0, 1
+    while high <= cap and fits(high):
+        low, high = high, high * 2
+    high = min(high, cap + 1)
+    while high - low > 1:
+        mid = (low + high) // 2
+        low, high = (mid, high) if fits(mid) else (low, mid)
+    return low
+
+
+def micro_batch_size(per_rank_batch, max_micro_batch, multiple=1):
+    """
+    Largest divisor of `per_rank_batch` that is a multiple of `multiple`
+    (see --noise_repeats) and at most `max_micro_batch`.
+    """
+    candidates = [m for m in range(multiple, per_rank_batch + 1, multiple)
+                  if per_rank_batch % m == 0 and m <= max_micro_batch]
+    if not candidates:
+        raise RuntimeError(f"--autotune: not even a micro-batch of {multiple} fits into memory")
+    return max(candidates)
+
+
+def _inputs(args, batch_size, device):
+    x = th.randn(batch_size, args.in_chans, args.image_size, args.image_size, device=device)
+    t = th.randint(0, 1000, (batch_size,), device=device)
+    y = th.randint(0, max(args.num_classes, 1), (batch_size,), device=device) if args.class_cond else None
+    return x, t, y
+
+
+def _probe(args, device, build_model, build_diffusion, per_rank_batch, sample_cap):
+    model = build_model(args)
+    if tensor_parallel.is_initialized():
+        model = tensor_parallel.parallelize(model)
+    model = model.to(device)
+    diffusion = build_diffusion(args, use_ddim=False)
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    # Held during training but not by the probe: the EMA copy and the two
+    # AdamW moments, partitioned across ranks by --shard zero/fsdp.
+    world_size = tensor_parallel.data_parallel_size() if args.parallel else 1
+    optimizer_bytes = 2 * param_bytes
+    if args.parallel and args.shard != "none":
+        optimizer_bytes //= world_size
+    resident = param_bytes + optimizer_bytes
+    budget = th.cuda.get_device_properties(device).total_memory * (1 - args.autotune_headroom) - resident
+
+    def train_step(n):
+        x, _, y = _inputs(args, n, device)
+        model.train()
+        try:
+            with autocast(enabled=args.amp):
+                losses = diffusion.training_losses(model, x, model_kwargs={"y": y} if y is not None else {})
+            losses["loss"].mean().backward()
+        finally:
+            model.zero_grad(set_to_none=True)
+
+    @th.no_grad()
+    def sample_step(n):
+        # Classifier-free guidance runs the conditional and unconditional halves together
+        n = n * 2 if args.guidance_scale != 1.0 else n
+        x, t, y = _inputs(args, n, device)
+        model.eval()
+        with autocast(enabled=args.amp):
+            model(x, t, y)
+
+    def fits(fn):
+        def check(n):
+            peak = peak_bytes(fn, n, device)
+            return peak is not None and peak <= budget
+        return check
+
+    result = {"max_micro_batch": max_batch_size(fits(train_step), per_rank_batch), "micro_batch_cap": per_rank_batch}
+    if sample_cap:
+        result["sample_size"] = max_batch_size(fits(sample_step), sample_cap)
+        result["sample_size_cap"] = sample_cap
+    del model
+    th.cuda.empty_cache()
+    return result
+
+
+def _covers(result, per_rank_batch, sample_cap):
+    """
+    Whether a cached search answers a request: a search that stopped at its
+    cap only says the cap fits.
+    """
+    def covers(value, cap, requested):
+        return value < cap or cap >= requested
+
+    if not covers(result["max_micro_batch"], result["micro_batch_cap"], per_rank_batch):
+        return False
+    if sample_cap:
+        return "sample_size" in result and covers(result["sample_size"], result["sample_size_cap"], sample_cap)
+    return True
+
+
+def autotune(args, device, build_model, build_diffusion):
+    """
+    Set args.batch_size, args.grad_accumulation and (unless --class_labels
+    fixes it) args.sample_size for `device`. Call on every rank, before the
+    data loader is built.
+    """
+    if device.type != "cuda":
+        if dist_util.is_main_process():
+            print("--autotune needs CUDA memory statistics; keeping --batch_size and --sample_size")
+        return None
+    world_size = tensor_parallel.data_parallel_size() if args.parallel else 1
+    global_batch = args.batch_size * max(1, args.grad_accumulation)
+    assert global_batch % world_size == 0, "the global batch must be divisible by the number of ranks"
+    per_rank_batch = global_batch // world_size
+    tune_sample = args.class_labels is None
+    sample_cap = min(MAX_SAMPLE_SIZE, max(1, args.num_samples // world_size)) if tune_sample else 0
+
+    key = signature(args, device)
+    result = None
+    if dist_util.is_main_process():
+        result = _load_cache(args.autotune_cache).get(key)
+        if result is not None and not _covers(result, per_rank_batch, sample_cap):
+            result = None
+        if result is None:
+            print(f"--autotune: probing {args.model} at {args.image_size}px on {th.cuda.get_device_name(device)}")
+            with tensor_parallel.local_only():
+                result = _probe(args, device, build_model, build_diffusion, per_rank_batch, sample_cap)
+            cache = _load_cache(args.autotune_cache)
+            cache[key] = result
+            _save_cache(args.autotune_cache, cache)
+    if args.parallel:
+        objects = [result]
+        dist.broadcast_object_list(objects, src=0)
+        result = objects[0]
+
+    micro_batch = micro_batch_size(per_rank_batch, result["max_micro_batch"], args.noise_repeats)
+    args.batch_size = micro_batch * world_size
+    args.grad_accumulation = per_rank_batch // micro_batch
+    if tune_sample:
+        args.sample_size = max(1, min(result["sample_size"], sample_cap))
+    if dist_util.is_main_process():
+        print(f"--autotune: micro-batch {micro_batch} per rank x {args.grad_accumulation} accumulation steps "
+              f"x {world_size} ranks = {global_batch}, sample_size {args.sample_size}")
+    return result
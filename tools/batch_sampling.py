@@ -0,0 +1,112 @@
+"""
+Construction of the (image, timestep, noise) triples of a training batch.
+
+With --noise_repeats k, each loaded image appears k times in the batch, with
+independent noise and timesteps, so the data loader only has to deliver
+batch_size / k images per step. The timesteps of the k copies can be
+stratified: the j-th copy is drawn from the j-th of k equal intervals of the
+t-range, so every image is seen across the whole noise range.
+
+BatchConstructor draws the timesteps and noise of a whole batch with variance
+reduction: stratified timesteps over the batch of a rank, or over the global
+batch of all ranks, and antithetic noise pairs (eps, -eps).
+"""
+
+import torch as th
+import torch.distributed as dist
+
+from tools import tensor_parallel
+
+STRATIFY_MODES = ["none", "rank", "global"]
+
+
+def repeat_batch(images, labels, repeats):
+    """
+    Repeat every image (and its label) `repeats` times, copies adjacent.
+    """
+    if repeats == 1:
+        return images, labels
+    images = images.repeat_interleave(repeats, dim=0)
+    if labels is not None:
+        labels = labels.repeat_interleave(repeats, dim=0)
+    return images, labels
+
+
+def stratified_timesteps(num_groups, repeats, num_timesteps=None, device=None):
+    """
+    Timesteps for `num_groups` images repeated `repeats` times (as laid out
+    by repeat_batch), stratified within each group.
+
+    :param num_timesteps: the number of discrete diffusion steps, or None for
+                          continuous t in [0, 1).
+    :return: a [num_groups * repeats] tensor of timestep indices, or of
+             floats if num_timesteps is None.
+    """
+    u = th.rand(num_groups, repeats, device=device)
+    strata = (th.arange(repeats, device=device) + u) / repeats
+    if num_timesteps is None:
+        return strata.flatten()
+    return (strata * num_timesteps).long().clamp_(max=num_timesteps - 1).flatten()
+
+
+class BatchConstructor:
+    """
+    Timesteps and noise of a training batch, for Trainer._compute_loss.
+
+    :param num_timesteps: the number of discrete diffusion steps, or None for
+                          continuous t in [0, 1) (flow matching).
+    :param stratify: "none" draws i.i.d. timesteps, "rank" splits the t-range
+                     into as many strata as the rank's batch size and draws
+                     one timestep from each, "global" does the same over the
+                     global batch, each rank taking every world_size-th
+                     stratum (offset by its rank).
+    :param antithetic: if True, the noise of every odd element is the
+                       negated noise of the element before it. Pairs are
+                       copies of the same image with --noise_repeats 2 or more.
+    :param repeats: with stratify "none", stratify the timesteps within each
+                    group of `repeats` copies of an image (see --noise_repeats).
+
+    Returns None for what it leaves to training_losses, so the default
+    configuration draws exactly as before.
+    """
+
+    def __init__(self, num_timesteps=None, stratify="none", antithetic=False, repeats=1):
+        assert stratify in STRATIFY_MODES, f"unknown stratification: {stratify}"
+        self.num_timesteps = num_timesteps
+        self.stratify = stratify
+        self.antithetic = antithetic
+        self.repeats = repeats
+
+    def __call__(self, x_start):
+        """
+        :return: a tuple (t, noise) for training_losses; either may be None.
+        """
+        n, device = x_start.shape[0], x_start.device
+        t = None
+        if self.stratify != "none":
+            t = self.stratified_timesteps(n, device)
+        elif self.repeats > 1:
+            t = stratified_timesteps(n // self.repeats, self.repeats, self.num_timesteps, device)
+        noise = self.antithetic_noise(x_start) if self.antithetic else None
+        return t, noise
+
+    def stratified_timesteps(self, batch_size, device):
+        if self.stratify == "global" and dist.is_available() and dist.is_initialized():
+            # Over data-parallel ranks: a tensor-parallel group shares one batch
+            rank, world_size = tensor_parallel.data_parallel_rank(), tensor_parallel.data_parallel_size()
+        else:
+            rank, world_size = 0, 1
+        strata = th.arange(batch_size, device=device) * world_size + rank
+        u = (strata + th.rand(batch_size, device=device)) / (batch_size * world_size)
+        # Shuffled, so that strata don't follow the order of the batch
+        # (e.g. the copies of an image with --noise_repeats)
+        u = u[th.randperm(batch_size, device=device)]
+        if self.num_timesteps is None:
+            return u
+        return (u * self.num_timesteps).long().clamp_(max=self.num_timesteps - 1)
+
+    @staticmethod
+    def antithetic_noise(x_start):
+        n = x_start.shape[0]
+        half = th.randn(((n + 1) // 2, *x_start.shape[1:]), device=x_start.device, dtype=x_start.dtype)
+        return th.stack([half, -half], dim=1).flatten(0, 1)[:n]
@@ -0,0 +1,149 @@
+"""
+Asynchronous, atomic checkpoint writing with retention.
+
+The state is first copied into pinned CPU buffers (reused between saves), so
+training can continue while a background thread serialises the snapshot.
+Files are written to a temporary name and renamed into place, and a
+`<prefix>_latest` pointer file names the newest complete checkpoint.
+"""
+
+import glob
+import os
+import re
+import threading
+
+import torch
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints named `<prefix>_<step>.pth` into `checkpoint_dir`.
+
+    :param checkpoint_dir: directory of the checkpoints.
+    :param keep_last: number of most recent checkpoints to keep, 0 keeps all.
+    :param milestone_step: checkpoints whose step is a multiple of this are
+                           never deleted, 0 disables milestones.
+    :param async_save: if True, serialise on a background thread.
+    """
+
+    def __init__(self, checkpoint_dir, keep_last=0, milestone_step=0, async_save=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.milestone_step = milestone_step
+        self.async_save = async_save
+        self._pinned = {}
+        self._thread = None
+        self._error = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save(self, state, prefix, step):
+        """
+        Snapshot `state` and write it as `<prefix>_<step>.pth`. Only the
+        snapshot is synchronous; call wait() to block until it is on disk.
+        """
+        # At most one write in flight, and the pinned buffers are free again.
+        self.wait()
+        snapshot = self._snapshot(state, ())
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        path = os.path.join(self.checkpoint_dir, f"{prefix}_{step}.pth")
+        if self.async_save:
+            self._thread = threading.Thread(target=self._write, args=(snapshot, path, prefix), name="checkpoint-writer")
+            self._thread.start()
+        else:
+            self._write(snapshot, path, prefix)
+            self._raise_error()
+        return path
+
+    def wait(self):
+        """
+        Block until the pending write (if any) has finished, and re-raise
+        any error it hit.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._pinned.clear()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("checkpoint write failed") from error
+
+    def _snapshot(self, obj, key):
+        if isinstance(obj, torch.Tensor):
+            return self._copy_tensor(obj, key)
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def _copy_tensor(self, tensor, key):
+        buf = self._pinned.get(key)
+        if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+            buf = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device="cpu",
+                pin_memory=torch.cuda.is_available(),
+            )
+            self._pinned[key] = buf
+        # Even CPU tensors are copied: the state dict references live parameters.
+        buf.copy_(tensor.detach(), non_blocking=tensor.is_cuda)
+        return buf
+
+    def _write(self, snapshot, path, prefix):
+        try:
+            tmp_path = path + ".tmp"
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, path)
+            self._write_pointer(prefix, os.path.basename(path))
+            self._prune(prefix)
+            print(f"Checkpoint saved: {path}")
+        except Exception as e:
+            self._error = e
+
+    def _write_pointer(self, prefix, filename):
+        pointer = os.path.join(self.checkpoint_dir, f"{prefix}_latest")
+        with open(pointer + ".tmp", "w") as f:
+            f.write(filename + "\n")
+        os.replace(pointer + ".tmp", pointer)
+
+    def _prune(self, prefix):
+        if self.keep_last <= 0:
+            return
+        steps = sorted(checkpoint_steps(self.checkpoint_dir, prefix))
+        for step in steps[:-self.keep_last]:
+            if self.milestone_step > 0 and step % self.milestone_step == 0:
+                continue
+            path = os.path.join(self.checkpoint_dir, f"{prefix}_{step}.pth")
+            os.remove(path)
+            # Per-rank files written next to it (see tools/comm_hooks.py)
+            for sidecar in glob.glob(glob.escape(path) + ".*"):
+                os.remove(sidecar)
+
+
+def checkpoint_steps(checkpoint_dir, prefix):
+    """
+    Steps of the complete `<prefix>_<step>.pth` checkpoints in `checkpoint_dir`.
+    """
+    pattern = re.compile(re.escape(prefix) + r"_(\d+)\.pth$")
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    return [int(m.group(1)) for m in map(pattern.match, os.listdir(checkpoint_dir)) if m]
+
+
+def latest_checkpoint(checkpoint_dir, prefix):
+    """
+    Path of the newest checkpoint according to the `<prefix>_latest` pointer,
+    or None if there is none yet.
+    """
+    pointer = os.path.join(checkpoint_dir, f"{prefix}_latest")
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        path = os.path.join(checkpoint_dir, f.read().strip())
+    return path if os.path.exists(path) else None
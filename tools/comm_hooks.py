@@ -0,0 +1,124 @@
+"""
+Gradient compression for DDP all-reduce (--ddp_comm_hook).
+
+  none      plain float32 all-reduce.
+  fp16      gradients are cast to float16 for the all-reduce (half the bytes).
+  bf16      the same in bfloat16: float32's range, coarser mantissa. Needs
+            NCCL, or a gloo build with bfloat16 support.
+  powersgd  rank --powersgd_rank approximation of each gradient matrix
+            (Vogels et al., 2019, https://arxiv.org/abs/1905.13727), after
+            --powersgd_start_iter steps of plain all-reduce. The compression
+            error is fed back into the next step's gradient, and with
+            --powersgd_warm_start the low-rank factors of the previous step
+            seed the next power iteration.
+
+PowerSGD's error feedback and warm-start factors live in its state. Each
+rank writes its own next to the checkpoint (`<checkpoint>.comm_rank<r>.pt`,
+the error differs between ranks and is about the size of the gradient), so a
+resumed run continues with the same residuals.
+
+`python -m benchmarks.comm_hooks` compares the hooks over gloo on CPU processes.
+"""
+
+import os
+
+import torch as th
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+from tools import dist_util, tensor_parallel
+from tools.timer import timed_comm_hook
+
+COMM_HOOKS = ["none", "fp16", "bf16", "powersgd"]
+
+
+def build_comm_hook(args):
+    """
+    The (state, hook) pair of --ddp_comm_hook for DDP.register_comm_hook.
+    The hooks reduce over the state's process group, not DDP's, so the state
+    is DDP's group (the data-parallel group under --tensor_parallel, where the
+    ranks of a tensor-parallel group hold different shards), or PowerSGD's
+    state over it.
+    """
+    group = tensor_parallel.data_parallel_group()
+    if args.ddp_comm_hook == "none":
+        return group, default_hooks.allreduce_hook
+    if args.ddp_comm_hook == "fp16":
+        return group, default_hooks.fp16_compress_hook
+    if args.ddp_comm_hook == "bf16":
+        return group, default_hooks.bf16_compress_hook
+    if args.ddp_comm_hook == "powersgd":
+        state = powerSGD_hook.PowerSGDState(
+            process_group=group,
+            matrix_approximation_rank=args.powersgd_rank,
+            # Error feedback and warm start need a few uncompressed steps first
+            start_powerSGD_iter=max(2, args.powersgd_start_iter),
+            use_error_feedback=True,
+            warm_start=args.powersgd_warm_start,
+            random_seed=args.seed,
+        )
+        return state, powerSGD_hook.powerSGD_hook
+    raise ValueError(f"Unknown --ddp_comm_hook {args.ddp_comm_hook!r}, expected one of {COMM_HOOKS}")
+
+
+def register_comm_hook(model, args, timer=None):
+    """
+    Register --ddp_comm_hook on the DDP `model`, with its all-reduce timed by
+    `timer` if given. Without either, DDP keeps its built-in all-reduce.
+    Returns the hook state to checkpoint (PowerSGD's), or None.
+    """
+    if args.ddp_comm_hook == "none" and timer is None:
+        return None
+    state, hook = build_comm_hook(args)
+    if timer is not None:
+        hook = timed_comm_hook(timer, hook)
+    model.register_comm_hook(state=state, hook=hook)
+    return state if args.ddp_comm_hook == "powersgd" else None
+
+
+def _to(value, device):
+    if th.is_tensor(value):
+        return value.to(device)
+    if isinstance(value, dict):
+        return {k: _to(v, device) for k, v in value.items()}
+    return value
+
+
+def state_path(checkpoint_path, rank):
+    """The file next to a checkpoint holding rank `rank`'s hook state."""
+    return f"{checkpoint_path}.comm_rank{rank}.pt"
+
+
+def save_state(state, checkpoint_path):
+    """
+    Write this rank's hook state next to the checkpoint at `checkpoint_path`.
+    Every rank writes its own file, so no rank holds another's error feedback.
+    """
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+    local = {slot: _to(getattr(state, slot), "cpu") for slot in state.__slots__ if slot != "process_group"}
+    path = state_path(checkpoint_path, rank)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    th.save({"world_size": world_size, "state": local}, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_state(state, checkpoint_path, device):
+    """
+    Restore this rank's hook state saved with `checkpoint_path`. Skipped, as
+    for the RNG states, when the number of ranks changed or it wasn't saved.
+    """
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+    path = state_path(checkpoint_path, rank)
+    saved = th.load(path, map_location="cpu") if os.path.exists(path) else None
+    if saved is None:
+        if dist_util.is_main_process():
+            print(f"No comm hook state next to {checkpoint_path}: not restored")
+        return
+    if saved["world_size"] != world_size:
+        if dist_util.is_main_process():
+            print(f"Checkpoint has comm hook states of {saved['world_size']} ranks, running on {world_size}: not restored")
+        return
+    for slot, value in saved["state"].items():
+        setattr(state, slot, _to(value, device))
@@ -0,0 +1,95 @@
+"""
+Helpers for opt-in torch.compile of the training loss and the sampling denoiser.
+"""
+
+import weakref
+
+import torch as th
+import torch._dynamo
+import torch._logging
+
+from tools import dist_util
+
+# Compiled denoisers are cached per eval model, so that periodic sampling during
+# training (which builds a fresh Sampler every time) does not recompile.
+_COMPILED_DENOISERS = weakref.WeakKeyDictionary()
+
+
+def configure(args):
+    """
+    Apply global dynamo settings. Call once before compiling anything.
+    """
+    if not args.compile:
+        return
+    th._dynamo.config.cache_size_limit = args.compile_cache_limit
+    if args.compile_verbose:
+        th._logging.set_logs(recompiles=True, graph_breaks=True)
+
+
+def compile_fn(fn, args):
+    """
+    Wrap `fn` (a function or module) with torch.compile if compilation is enabled.
+
+    On CPU the inductor backend emits C++/OpenMP kernels, so the same settings
+    can be validated without GPUs.
+    """
+    if not args.compile:
+        return fn
+    return th.compile(fn, backend=args.compile_backend, mode=_mode(args))
+
+
+def mark_batch_dynamic(*tensors):
+    """
+    Mark the batch dimension as dynamic so that e.g. the CFG-doubled batch or
+    the last partial batch reuses the same graph instead of recompiling.
+    """
+    for x in tensors:
+        # Dims of size 0/1 are always specialised by dynamo.
+        if isinstance(x, th.Tensor) and x.dim() > 0 and x.shape[0] > 1:
+            th._dynamo.mark_dynamic(x, 0)
+
+
+def compile_denoiser(model, args):
+    """
+    Return a callable with the model's signature that runs a compiled copy of
+    `model` with a dynamic batch dimension. Returns `model` unchanged if
+    compilation is disabled.
+    """
+    if not args.compile:
+        return model
+    if model in _COMPILED_DENOISERS:
+        return _COMPILED_DENOISERS[model]
+
+    compiled = compile_fn(model, args)
+
+    def denoiser(x, t, *model_args, **model_kwargs):
+        mark_batch_dynamic(x, t, *model_args, *model_kwargs.values())
+        return compiled(x, t, *model_args, **model_kwargs)
+
+    _COMPILED_DENOISERS[model] = denoiser
+    return denoiser
+
+
+def report_graph_breaks(fn, *args, **kwargs):
+    """
+    Run `fn` once through dynamo's explain() and print the number of graphs,
+    graph breaks and their reasons. Executes `fn` as a side effect, RNG draws
+    included; callers that need an unchanged RNG wrap it in
+    tools.utils.preserve_rng_state.
+    """
+    explanation = th._dynamo.explain(fn)(*args, **kwargs)
+    if dist_util.is_main_process():
+        print(
+            f"torch.compile: {explanation.graph_count} graph(s), "
+            f"{explanation.graph_break_count} graph break(s)"
+        )
+        for i, reason in enumerate(explanation.break_reasons):
+            frame = reason.user_stack[-1] if reason.user_stack else None
+            location = f" ({frame.filename}:{frame.lineno})" if frame is not None else ""
+            print(f"  break {i}: {reason.reason}{location}")
+    th._dynamo.reset()
+    return explanation
+
+
+def _mode(args):
+    return None if args.compile_mode == "default" else args.compile_mode
@@ -61,29 +61,30 @@ def is_main_process():
     # In a multi-card distributed environment, only the process with a rank of 0 is the master process
     return dist.get_rank() == 0
 
-def setup_dist():
+def setup_dist(backend=None):
     """
-    Setup a distributed process group.
+    Setup a distributed process group and return the device of this process.
+
+    RANK, WORLD_SIZE, LOCAL_RANK and LOCAL_WORLD_SIZE are read as set by
+    torchrun, so one job can span several nodes. Without them, the process
+    is rank 0 of a world of one. The backend defaults to nccl on CUDA and to
+    gloo otherwise, so several CPU processes on one machine can run the
+    whole train, sample and eval loop.
     """
+    if backend is None:
+        backend = "nccl" if th.cuda.is_available() else "gloo"
+    if backend == "nccl":
+        th.cuda.set_device(dev())
     if dist.is_initialized():
-        return
-
-    # Dynamically get the number of GPUs
-    visible_devices = os.getenv("CUDA_VISIBLE_DEVICES", "")
-    GPUS_PER_NODE = len(visible_devices.split(",")) if visible_devices else th.cuda.device_count()
-
-    local_rank = int(os.getenv('LOCAL_RANK', 0))
-    th.cuda.set_device(local_rank)
+        return dev()
 
-    os.environ["MASTER_ADDR"] = os.getenv("MASTER_ADDR", "127.0.0.1")  
-    os.environ["MASTER_PORT"] = os.getenv("MASTER_PORT", "12345")  
+    os.environ["MASTER_ADDR"] = os.getenv("MASTER_ADDR", "127.0.0.1")
+    os.environ["MASTER_PORT"] = os.getenv("MASTER_PORT", "12345")
+    os.environ["RANK"] = os.getenv("RANK", str(local_rank()))
+    os.environ["WORLD_SIZE"] = os.getenv("WORLD_SIZE", os.getenv("LOCAL_WORLD_SIZE", "1"))
 
-    # Setting RANK and WORLD_SIZE
-    os.environ["RANK"] = os.getenv("RANK", str(local_rank))  
-    os.environ["WORLD_SIZE"] = os.getenv("WORLD_SIZE", str(GPUS_PER_NODE))  
-
-    # Initialise process group, use nccl for GPU communication
-    dist.init_process_group(backend="nccl", init_method="env://")
+    dist.init_process_group(backend=backend, init_method="env://")
+    return dev()
 
 def cleanup_dist():
     """
@@ -91,37 +92,142 @@ def cleanup_dist():
     """
     if dist.is_initialized():
         dist.destroy_process_group()
-        
+
+def local_rank():
+    """
+    Get the rank of this process on its node (LOCAL_RANK, set by torchrun).
+    """
+    return int(os.getenv("LOCAL_RANK", 0))
+
 def dev():
     """
-    Get the device to use for torch.distributed.
+    Get the device of this process: its node-local GPU, or the CPU.
     """
     if th.cuda.is_available():
-        return th.device(f"cuda")
+        return th.device(f"cuda:{local_rank() % th.cuda.device_count()}")
     return th.device("cpu")
 
 
-# def load_state_dict(path, **kwargs):
-#     """
-#     Load a PyTorch file without redundant fetches across MPI ranks.
-#     """
-#     chunk_size = 2 ** 30  # MPI has a relatively small size limit
-#     if MPI.COMM_WORLD.Get_rank() == 0:
-#         with bf.BlobFile(path, "rb") as f:
-#             data = f.read()
-#         num_chunks = len(data) // chunk_size
-#         if len(data) % chunk_size:
-#             num_chunks += 1
-#         MPI.COMM_WORLD.bcast(num_chunks)
-#         for i in range(0, len(data), chunk_size):
-#             MPI.COMM_WORLD.bcast(data[i : i + chunk_size])
-#     else:
-#         num_chunks = MPI.COMM_WORLD.bcast(None)
-#         data = bytes()
-#         for _ in range(num_chunks):
-#             data += MPI.COMM_WORLD.bcast(None)
+_NODE_GROUP = None
+
+# Tensors are broadcast in flat buckets of this size to limit the number of
+# collectives without doubling the peak memory.
+BROADCAST_BUCKET_BYTES = 256 * 2 ** 20
+
 
-#     return th.load(io.BytesIO(data), **kwargs)
+def node_group():
+    """
+    Get the process group of the ranks on this node, and the global rank of
+    its leader (the lowest rank on the node). Nodes are assumed to hold
+    LOCAL_WORLD_SIZE consecutive ranks, as launched by torchrun.
+    """
+    global _NODE_GROUP
+    if _NODE_GROUP is None:
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        local_size = int(os.getenv("LOCAL_WORLD_SIZE", world_size))
+        if local_size >= world_size:
+            _NODE_GROUP = (dist.group.WORLD, 0)
+        else:
+            # new_group() is collective: every rank creates every group.
+            for start in range(0, world_size, local_size):
+                ranks = list(range(start, min(start + local_size, world_size)))
+                group = dist.new_group(ranks)
+                if rank in ranks:
+                    _NODE_GROUP = (group, start)
+    return _NODE_GROUP
+
+
+def load_state_dict(path, keys=None, device=None):
+    """
+    Load a PyTorch file without redundant reads across ranks.
+
+    One rank per node memory-maps the file and the tensors reach the other
+    ranks of the node by broadcast. Only the top-level entries in `keys` (all
+    if None) are kept, and their tensors are placed directly on `device`
+    (default: dev()).
+    """
+    device = dev() if device is None else th.device(device)
+    is_leader = True
+    if dist.is_initialized():
+        group, leader = node_group()
+        is_leader = dist.get_rank() == leader
+
+    if is_leader:
+        state = th.load(path, map_location="cpu", mmap=True)
+        if keys is not None:
+            state = {k: state[k] for k in keys if k in state}
+        tensors = []
+        skeleton = _replace_tensors(state, tensors)
+    if not dist.is_initialized():
+        return _restore_tensors(skeleton, [t.to(device) for t in tensors])
+
+    meta = [(skeleton, [(t.shape, t.dtype) for t in tensors])] if is_leader else [None]
+    dist.broadcast_object_list(meta, src=leader, group=group)
+    skeleton, specs = meta[0]
+
+    received = [None] * len(specs)
+    for bucket in _buckets(specs):
+        dtype = specs[bucket[0]][1]
+        if is_leader:
+            flat = th.cat([tensors[i].reshape(-1) for i in bucket]).to(device)
+        else:
+            numel = sum(specs[i][0].numel() for i in bucket)
+            flat = th.empty(numel, dtype=dtype, device=device)
+        dist.broadcast(flat, src=leader, group=group)
+        offset = 0
+        for i in bucket:
+            shape = specs[i][0]
+            received[i] = flat[offset: offset + shape.numel()].view(shape)
+            offset += shape.numel()
+    return _restore_tensors(skeleton, received)
+
+
+class _TensorRef:
+    def __init__(self, index):
+        self.index = index
+
+
+def _replace_tensors(obj, tensors):
+    if isinstance(obj, th.Tensor):
+        tensors.append(obj)
+        return _TensorRef(len(tensors) - 1)
+    if isinstance(obj, dict):
+        return {k: _replace_tensors(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_replace_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _restore_tensors(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        return {k: _restore_tensors(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_restore_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _buckets(specs):
+    """
+    Group tensor indices into runs of equal dtype of at most
+    BROADCAST_BUCKET_BYTES (a single larger tensor gets its own bucket).
+    """
+    by_dtype = {}
+    for i, (_, dtype) in enumerate(specs):
+        by_dtype.setdefault(dtype, []).append(i)
+    for dtype, indices in by_dtype.items():
+        itemsize = th.empty((), dtype=dtype).element_size()
+        bucket, size = [], 0
+        for i in indices:
+            nbytes = specs[i][0].numel() * itemsize
+            if bucket and size + nbytes > BROADCAST_BUCKET_BYTES:
+                yield bucket
+                bucket, size = [], 0
+            bucket.append(i)
+            size += nbytes
+        if bucket:
+            yield bucket
 
 
 def sync_params(params):
@@ -140,4 +246,4 @@ def _find_free_port():
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         return s.getsockname()[1]
     finally:
-        s.close()
\ No newline at end of file
+        s.close()
@@ -13,6 +13,8 @@ import torch as th
 import torch.distributed as dist
 from tools.nn import mean_flat
 from tools.losses import normal_kl, discretized_gaussian_log_likelihood
+from tools.loss_weights import mse_loss_weight_fn
+from tools.masking import masked_mean, masked_mse
 from tools import logger
 import torch.nn.functional as F
 
@@ -230,6 +232,73 @@ class GaussianDiffusion:
             / (1.0 - self.alphas_cumprod)
         )
 
+        # float32 copies of the tables above, per device (see _extract)
+        self._device_tables = {}
+        # MSE loss weight per timestep, per device (see _mse_loss_weight)
+        self._mse_loss_weights = {}
+
+    def _coefficient_tables(self):
+        """
+        The per-timestep tables gathered by _extract, as float64 numpy arrays.
+        """
+        fixed_large_variance = np.append(self.posterior_variance[1], self.betas[1:])
+        return {
+            "alphas_cumprod": self.alphas_cumprod,
+            "alphas_cumprod_prev": self.alphas_cumprod_prev,
+            "alphas_cumprod_next": self.alphas_cumprod_next,
+            "one_minus_alphas_cumprod": 1.0 - self.alphas_cumprod,
+            "sqrt_alphas_cumprod": self.sqrt_alphas_cumprod,
+            "sqrt_one_minus_alphas_cumprod": self.sqrt_one_minus_alphas_cumprod,
+            "log_one_minus_alphas_cumprod": self.log_one_minus_alphas_cumprod,
+            "sqrt_recip_alphas_cumprod": self.sqrt_recip_alphas_cumprod,
+            "sqrt_recipm1_alphas_cumprod": self.sqrt_recipm1_alphas_cumprod,
+            "log_betas": np.log(self.betas),
+            "posterior_variance": self.posterior_variance,
+            "posterior_log_variance_clipped": self.posterior_log_variance_clipped,
+            "posterior_mean_coef1": self.posterior_mean_coef1,
+            "posterior_mean_coef2": self.posterior_mean_coef2,
+            "recip_posterior_mean_coef1": 1.0 / self.posterior_mean_coef1,
+            "posterior_mean_coef2_over_coef1": self.posterior_mean_coef2 / self.posterior_mean_coef1,
+            # for fixedlarge, we set the initial (log-)variance like so
+            # to get a better decoder log likelihood.
+            "fixed_large_variance": fixed_large_variance,
+            "fixed_large_log_variance": np.log(fixed_large_variance),
+        }
+
+    def _tables_on(self, device):
+        """
+        The coefficient tables as float32 tensors on `device`, created on
+        first use and cached, so that per-step gathers stay on the device.
+        """
+        tables = self._device_tables.get(device)
+        if tables is None:
+            tables = {
+                name: th.from_numpy(arr).to(device=device, dtype=th.float32)
+                for name, arr in self._coefficient_tables().items()
+            }
+            self._device_tables[device] = tables
+        return tables
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Gather the coefficient table `name` at `timesteps`, like
+        _extract_into_tensor.
+        """
+        return _broadcast_to(self._tables_on(timesteps.device)[name][timesteps], broadcast_shape)
+
+    def _mse_loss_weight(self, t):
+        """
+        The --weight_type weights of timesteps `t`, gathered from a table that
+        is computed in float64 over all timesteps on first use.
+        """
+        table = self._mse_loss_weights.get(t.device)
+        if table is None:
+            weight = mse_loss_weight_fn(self.model_mean_type, self.mse_loss_weight_type, self.p2_k, self.p2_gamma)
+            table = weight(th.from_numpy(self.sqrt_alphas_cumprod), th.from_numpy(self.sqrt_one_minus_alphas_cumprod))
+            table = table.to(device=t.device, dtype=th.float32)
+            self._mse_loss_weights[t.device] = table
+        return table[t]
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -239,11 +308,11 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
         )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract(
+            "log_one_minus_alphas_cumprod", t, x_start.shape
         )
         return mean, variance, log_variance
 
@@ -262,8 +331,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape)
             * noise
         )
 
@@ -276,12 +345,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -328,29 +397,21 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
+                min_log = self._extract(
+                    "posterior_log_variance_clipped", t, x.shape
                 )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+                max_log = self._extract("log_betas", t, x.shape)
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
                 model_variance = th.exp(model_log_variance)
         else:
             model_variance, model_log_variance = {
-                # for fixedlarge, we set the initial (log-)variance like so
-                # to get a better decoder log likelihood.
-                ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
-                ),
-                ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
-                ),
+                ModelVarType.FIXED_LARGE: ("fixed_large_variance", "fixed_large_log_variance"),
+                ModelVarType.FIXED_SMALL: ("posterior_variance", "posterior_log_variance_clipped"),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -401,17 +462,16 @@ class GaussianDiffusion:
 
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
-        ind = t[0].cpu().numpy()
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
         
     def _predict_xstart_from_v(self, x_t, t, v):
         assert x_t.shape == v.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, t.shape) * v
+            self._extract("sqrt_alphas_cumprod", t, t.shape) * x_t
+            - self._extract("sqrt_one_minus_alphas_cumprod", t, t.shape) * v
         )
         
     # def _predict_xstart_from_u(self, x_t, t, u):
@@ -425,18 +485,16 @@ class GaussianDiffusion:
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
         return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
-            )
+            self._extract("recip_posterior_mean_coef1", t, x_t.shape) * xprev
+            - self._extract("posterior_mean_coef2_over_coef1", t, x_t.shape)
             * x_t
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -468,7 +526,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -655,8 +713,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -699,10 +757,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -797,7 +855,7 @@ class GaussianDiffusion:
                 img = out["sample"]
 
     def _vb_terms_bpd(
-        self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
+        self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None, loss_mask=None
     ):
         """
         Get a term for the variational lower-bound.
@@ -805,6 +863,9 @@ class GaussianDiffusion:
         The resulting units are bits (rather than nats, as one might expect).
         This allows for comparison to other papers.
 
+        :param loss_mask: if specified, an [N x 1 x ...] float mask of the pixels
+            to average the terms over (see training_losses).
+
         :return: a dict with the following keys:
                  - 'output': a shape [N] tensor of NLLs or KLs.
                  - 'pred_xstart': the x_0 predictions.
@@ -818,13 +879,14 @@ class GaussianDiffusion:
         kl = normal_kl(
             true_mean, true_log_variance_clipped, out["mean"], out["log_variance"]
         )
-        kl = mean_flat(kl) / np.log(2.0)
+        mean = mean_flat if loss_mask is None else (lambda x: masked_mean(x, loss_mask))
+        kl = mean(kl) / np.log(2.0)
 
         decoder_nll = -discretized_gaussian_log_likelihood(
             x_start, means=out["mean"], log_scales=0.5 * out["log_variance"]
         )
         assert decoder_nll.shape == x_start.shape
-        decoder_nll = mean_flat(decoder_nll) / np.log(2.0)
+        decoder_nll = mean(decoder_nll) / np.log(2.0)
 
         # At the first timestep return the decoder NLL,
         # otherwise return KL(q(x_{t-1}|x_t,x_0) || p(x_{t-1}|x_t))
@@ -832,7 +894,8 @@ class GaussianDiffusion:
         return {"output": output, "pred_xstart": out["pred_xstart"]}
 
 
-    def training_losses(self, model, x_start, t=None, model_kwargs=None, noise=None):
+    def training_losses(self, model, x_start, t=None, model_kwargs=None, noise=None, mse_weights=None,
+                        loss_mask=None, recon_weight=0.0):
         """
         Compute training losses for a single timestep.
 
@@ -842,6 +905,13 @@ class GaussianDiffusion:
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
         :param noise: if specified, the specific Gaussian noise to try to remove.
+        :param mse_weights: if specified, an [N] tensor of extra weights of the
+            MSE term, e.g. from the SpeeDiffusion timestep sampler.
+        :param loss_mask: if specified, an [N x 1 x ...] float mask of the pixels
+            the model saw (masked training, see tools/masking.py). The MSE and
+            variational bound terms are then averaged over these pixels only.
+        :param recon_weight: with loss_mask, the weight of the "recon" term,
+            the reconstruction error of x_t on the masked pixels.
         :return: a dict with the key "loss" containing a tensor of shape [N].
                  Some mean or variance settings may also have other keys.
         """
@@ -856,16 +926,15 @@ class GaussianDiffusion:
 
         terms = {}
         
-        mse_loss_weight = None
-        alpha = _extract_into_tensor(self.sqrt_alphas_cumprod, t, t.shape)
-        sigma = _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, t.shape)
+        alpha = self._extract("sqrt_alphas_cumprod", t, t.shape)
+        sigma = self._extract("sqrt_one_minus_alphas_cumprod", t, t.shape)
         
         # velocity = (alpha[:, None, None, None] * x_t - x_start) / sigma[:, None, None, None]
         
         # unravel = alpha[:, None, None, None] * x_start - sigma[:, None, None, None] * noise  # u = \sqrt{\bar{alpha}_t} * x_0 - \sqrt{1-\bar{alpha}_t} * \epsilon
         # unravel = sigma[:, None, None, None] * noise - alpha[:, None, None, None] * x_start # u= \sqrt{1-\bar{alpha}_t}epsilon - \sqrt{\bar{alpha}_t}x_0
         
-        mse_loss_weight = compute_mse_loss_weight(self.model_mean_type, self.mse_loss_weight_type, t, alpha, sigma, self.p2_k, self.p2_gamma)
+        mse_loss_weight = self._mse_loss_weight(t)
                 
         if self.loss_type == LossType.KL or self.loss_type == LossType.RESCALED_KL:
             terms["loss"] = self._vb_terms_bpd(
@@ -875,6 +944,7 @@ class GaussianDiffusion:
                 t=t,
                 clip_denoised=False,
                 model_kwargs=model_kwargs,
+                loss_mask=loss_mask,
             )["output"]
             if self.loss_type == LossType.RESCALED_KL:
                 terms["loss"] *= self.num_timesteps
@@ -899,6 +969,7 @@ class GaussianDiffusion:
                     x_t=x_t,
                     t=t,
                     clip_denoised=False,
+                    loss_mask=loss_mask,
                 )["output"]
                 if self.loss_type == LossType.RESCALED_MSE:
                     # Divide by 1000 for equivalence with initial implementation.
@@ -917,9 +988,16 @@ class GaussianDiffusion:
             }[self.model_mean_type]
             assert model_output.shape == target.shape == x_start.shape
 
-            raw_mse = mean_flat((target - model_output) ** 2)
+            if loss_mask is None:
+                raw_mse = mean_flat((target - model_output) ** 2)
+            else:
+                raw_mse, terms["recon"] = masked_mse(model_output, target, x_t, loss_mask)
                 
             terms["mse"] = mse_loss_weight * raw_mse
+            if mse_weights is not None:
+                terms["mse"] = terms["mse"] * mse_weights
+            if recon_weight > 0 and "recon" in terms:
+                terms["mse"] = terms["mse"] + recon_weight * terms["recon"]
 
             if self.gamma > 0:
                 # Initialize RFFCosineReg if not already
@@ -1037,6 +1115,10 @@ def _extract_into_tensor(arr, timesteps, broadcast_shape):
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
     res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    return _broadcast_to(res, broadcast_shape)
+
+
+def _broadcast_to(res, broadcast_shape):
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res.expand(broadcast_shape)
@@ -1060,58 +1142,11 @@ def concat_all_gather(tensor):
 
 
 def compute_mse_loss_weight(model_mean_type, mse_loss_weight_type, t, alpha, sigma, p2_k=1.0, p2_gamma=1.0):
-    snr = (alpha / sigma) ** 2
-    mse_loss_weight = None
-
-    if mse_loss_weight_type == 'constant':
-        return th.ones_like(t)
-
-    if model_mean_type.name == "EPSILON":
-        if mse_loss_weight_type.startswith("min_snr_"):
-            k = float(mse_loss_weight_type.split('min_snr_')[-1])
-            mse_loss_weight = th.stack([snr, k * th.ones_like(t)], dim=1).min(dim=1)[0] / snr
-        elif mse_loss_weight_type.startswith("max_snr_"):
-            k = float(mse_loss_weight_type.split('max_snr_')[-1])
-            mse_loss_weight = th.stack([snr, k * th.ones_like(t)], dim=1).max(dim=1)[0] / snr
-        elif mse_loss_weight_type == 'lambda':
-            mse_loss_weight = sigma
-        elif mse_loss_weight_type == 'debias':
-            mse_loss_weight = sigma / alpha
-        elif mse_loss_weight_type == 'p2':
-            mse_loss_weight = 1 / (p2_k + snr) ** p2_gamma
-        elif mse_loss_weight_type == 'min_debias':
-            mse_loss_weight = th.minimum(sigma / alpha, th.ones_like(sigma))
-        elif mse_loss_weight_type == 'max_debias':
-            mse_loss_weight = th.maximum(sigma / alpha, th.ones_like(sigma))
-
-    elif model_mean_type.name == "START_X":
-        if mse_loss_weight_type == 'trunc_snr':
-            mse_loss_weight = th.stack([snr, th.ones_like(t)], dim=1).max(dim=1)[0]
-        elif mse_loss_weight_type == 'snr':
-            mse_loss_weight = snr
-        elif mse_loss_weight_type == 'inv_snr':
-            mse_loss_weight = 1. / snr
-        elif mse_loss_weight_type.startswith("min_snr_"):
-            k = float(mse_loss_weight_type.split('min_snr_')[-1])
-            mse_loss_weight = th.stack([snr, k * th.ones_like(t)], dim=1).min(dim=1)[0]
-        elif mse_loss_weight_type.startswith("max_snr_"):
-            k = float(mse_loss_weight_type.split('max_snr_')[-1])
-            mse_loss_weight = th.stack([snr, k * th.ones_like(t)], dim=1).max(dim=1)[0]
-        elif mse_loss_weight_type == 'lambda':
-            mse_loss_weight = alpha
-
-    elif model_mean_type.name == "VELOCITY":
-        if mse_loss_weight_type.startswith("min_snr_"):
-            k = float(mse_loss_weight_type.split('min_snr_')[-1])
-            mse_loss_weight = th.stack([snr, k * th.ones_like(t)], dim=1).min(dim=1)[0] / (snr + 1)
-        elif mse_loss_weight_type == 'lambda':
-            mse_loss_weight = 2 * alpha * sigma
-
-    if mse_loss_weight is None:
-        raise ValueError(f"Invalid mse_loss_weight_type: {mse_loss_weight_type}")
-
-    mse_loss_weight[snr == 0] = 1.0  # Handle edge cases
-    return mse_loss_weight
+    """
+    Weights of the MSE loss at alpha, sigma. Resolves the weighting on every
+    call; the diffusions resolve it once (see tools/loss_weights.py).
+    """
+    return mse_loss_weight_fn(model_mean_type, mse_loss_weight_type, p2_k, p2_gamma)(alpha, sigma)
 
 
 class FlowMatching:
@@ -1134,6 +1169,9 @@ class FlowMatching:
         # P2 weighting
         self.p2_gamma = p2_gamma
         self.p2_k = p2_k
+        # --weight_type as a closed-form function of alpha_t, sigma_t, resolved
+        # on the first training step
+        self._mse_loss_weight_fn = None
         #sample tolenace
         self.atol = atol
         self.rtol = rtol
@@ -1223,7 +1261,8 @@ class FlowMatching:
         return x_t
     
     #taining
-    def training_losses(self, model, x_start, t=None, model_kwargs=None, noise=None):
+    def training_losses(self, model, x_start, t=None, model_kwargs=None, noise=None, mse_weights=None,
+                        loss_mask=None, recon_weight=0.0):
         if model_kwargs is None:
             model_kwargs = {}
         if noise is None:
@@ -1237,7 +1276,9 @@ class FlowMatching:
         
         terms = {}
         
-        mse_loss_weight = compute_mse_loss_weight(self.model_mean_type, self.mse_loss_weight_type, t, alpha_t, sigma_t, self.p2_k, self.p2_gamma)
+        if self._mse_loss_weight_fn is None:
+            self._mse_loss_weight_fn = mse_loss_weight_fn(self.model_mean_type, self.mse_loss_weight_type, self.p2_k, self.p2_gamma)
+        mse_loss_weight = self._mse_loss_weight_fn(alpha_t, sigma_t)
         
         target = {
             ModelMeanType.START_X: x_start,
@@ -1252,9 +1293,16 @@ class FlowMatching:
         
         assert model_output.shape == target.shape == x_start.shape
 
-        raw_mse = mean_flat((target - model_output) ** 2)
+        if loss_mask is None:
+            raw_mse = mean_flat((target - model_output) ** 2)
+        else:
+            raw_mse, terms["recon"] = masked_mse(model_output, target, x_t, loss_mask)
             
         terms["loss"] = mse_loss_weight * raw_mse
+        if mse_weights is not None:
+            terms["loss"] = terms["loss"] * mse_weights
+        if recon_weight > 0 and "recon" in terms:
+            terms["loss"] = terms["loss"] + recon_weight * terms["recon"]
 
         return terms
 
@@ -0,0 +1,165 @@
+"""
+Registry of MSE loss weightings (--weight_type), as functions of the noise
+schedule.
+
+A weighting is registered for the model mean types it applies to, and is
+resolved once from its name into an MSELossWeight. For discrete diffusion
+it is evaluated once over all timesteps into a lookup table, so that the
+training step only gathers it. For continuous-time flow matching it is
+evaluated in closed form on each batch. Either way the name is never
+parsed in the training step.
+
+New weightings only need a registered function:
+
+    @register_mse_loss_weight("sigmoid_", "EPSILON")
+    def _sigmoid(snr, alpha, sigma, k, **_):
+        return th.sigmoid(k - th.log(snr))
+
+Names ending in "_" take a numeric suffix, passed as `k` (e.g. min_snr_5).
+"""
+
+import torch as th
+
+MSE_LOSS_WEIGHTS = {}
+
+
+def register_mse_loss_weight(name, *mean_types):
+    """
+    Register `fn(snr, alpha, sigma, **params)` as weighting `name` for the
+    ModelMeanType names `mean_types`. `params` holds p2_k, p2_gamma and, for
+    names ending in "_", the suffix `k`. Functions must be elementwise on
+    tensors.
+    """
+
+    def decorator(fn):
+        for mean_type in mean_types:
+            MSE_LOSS_WEIGHTS[(mean_type, name)] = fn
+        return fn
+
+    return decorator
+
+
+class MSELossWeight:
+    """
+    A resolved weighting: called with alpha and sigma of a batch (or of all
+    timesteps), it returns the per-element weights. Where the SNR is 0 the
+    weight is 1.
+    """
+
+    def __init__(self, fn, **params):
+        self.fn = fn
+        self.params = params
+
+    def __call__(self, alpha, sigma):
+        snr = (alpha / sigma) ** 2
+        weight = self.fn(snr, alpha, sigma, **self.params)
+        return th.where(snr == 0, th.ones_like(weight), weight)
+
+
+class ConstantLossWeight:
+    def __call__(self, alpha, sigma):
+        return th.ones_like(alpha)
+
+
+def mse_loss_weight_fn(model_mean_type, mse_loss_weight_type, p2_k=1.0, p2_gamma=1.0):
+    """
+    Resolve `mse_loss_weight_type` for `model_mean_type` into a callable
+    weight(alpha, sigma).
+    """
+    if mse_loss_weight_type == "constant":
+        return ConstantLossWeight()
+    params = dict(p2_k=p2_k, p2_gamma=p2_gamma)
+    fn = MSE_LOSS_WEIGHTS.get((model_mean_type.name, mse_loss_weight_type))
+    if fn is None:
+        for (mean_type, name), candidate in MSE_LOSS_WEIGHTS.items():
+            if mean_type == model_mean_type.name and name.endswith("_") and mse_loss_weight_type.startswith(name):
+                try:
+                    params["k"] = float(mse_loss_weight_type[len(name):])
+                except ValueError:
+                    continue
+                fn = candidate
+                break
+    if fn is None:
+        raise ValueError(f"Invalid mse_loss_weight_type: {mse_loss_weight_type}")
+    return MSELossWeight(fn, **params)
+
+
+# EPSILON prediction
+
+@register_mse_loss_weight("min_snr_", "EPSILON")
+def _eps_min_snr(snr, alpha, sigma, k, **_):
+    return th.clamp(snr, max=k) / snr
+
+
+@register_mse_loss_weight("max_snr_", "EPSILON")
+def _eps_max_snr(snr, alpha, sigma, k, **_):
+    return th.clamp(snr, min=k) / snr
+
+
+@register_mse_loss_weight("lambda", "EPSILON")
+def _eps_lambda(snr, alpha, sigma, **_):
+    return sigma
+
+
+@register_mse_loss_weight("debias", "EPSILON")
+def _eps_debias(snr, alpha, sigma, **_):
+    return sigma / alpha
+
+
+@register_mse_loss_weight("p2", "EPSILON")
+def _eps_p2(snr, alpha, sigma, p2_k, p2_gamma, **_):
+    return 1 / (p2_k + snr) ** p2_gamma
+
+
+@register_mse_loss_weight("min_debias", "EPSILON")
+def _eps_min_debias(snr, alpha, sigma, **_):
+    return th.clamp(sigma / alpha, max=1.0)
+
+
+@register_mse_loss_weight("max_debias", "EPSILON")
+def _eps_max_debias(snr, alpha, sigma, **_):
+    return th.clamp(sigma / alpha, min=1.0)
+
+
+# START_X prediction
+
+@register_mse_loss_weight("trunc_snr", "START_X")
+def _x0_trunc_snr(snr, alpha, sigma, **_):
+    return th.clamp(snr, min=1.0)
+
+
+@register_mse_loss_weight("snr", "START_X")
+def _x0_snr(snr, alpha, sigma, **_):
+    return snr
+
+
+@register_mse_loss_weight("inv_snr", "START_X")
+def _x0_inv_snr(snr, alpha, sigma, **_):
+    return 1. / snr
+
+
+@register_mse_loss_weight("min_snr_", "START_X")
+def _x0_min_snr(snr, alpha, sigma, k, **_):
+    return th.clamp(snr, max=k)
+
+
+@register_mse_loss_weight("max_snr_", "START_X")
+def _x0_max_snr(snr, alpha, sigma, k, **_):
+    return th.clamp(snr, min=k)
+
+
+@register_mse_loss_weight("lambda", "START_X")
+def _x0_lambda(snr, alpha, sigma, **_):
+    return alpha
+
+
+# VELOCITY prediction
+
+@register_mse_loss_weight("min_snr_", "VELOCITY")
+def _v_min_snr(snr, alpha, sigma, k, **_):
+    return th.clamp(snr, max=k) / (snr + 1)
+
+
+@register_mse_loss_weight("lambda", "VELOCITY")
+def _v_lambda(snr, alpha, sigma, **_):
+    return 2 * alpha * sigma
@@ -0,0 +1,96 @@
+"""
+Masked-token training for the transformer backbones (DiT, ViT), after
+MaskDiT (Zheng et al., 2023, https://arxiv.org/abs/2306.09305).
+
+With --mask_ratio r, a random fraction r of the patch tokens of every image
+is dropped after the patch embedding, so the encoder blocks only process the
+visible ones. The full token grid is then restored: with --mask_decoder_depth
+d > 0 the dropped positions get a learned mask token and d extra blocks
+(the decoder) run on the full grid, otherwise they only get their positional
+embedding. The denoising loss is computed on the visible patches. With
+--mask_recon_weight w, the model output on the dropped patches is also
+trained to reconstruct the noisy input there, weighted by w.
+
+The decoder also runs without a mask, so unmasked fine-tuning and sampling
+use the same model; with d = 0 and no mask the forward pass is unchanged.
+"""
+
+import torch as th
+
+
+def random_token_mask(batch_size, num_tokens, mask_ratio, device=None):
+    """
+    Draw which tokens to drop, the same number for every image.
+
+    :return: an [N x T] bool tensor, True where a token is dropped.
+    """
+    num_masked = int(round(mask_ratio * num_tokens))
+    assert num_masked < num_tokens, "--mask_ratio must leave at least one visible token"
+    order = th.rand(batch_size, num_tokens, device=device).argsort(dim=1)
+    mask = th.zeros(batch_size, num_tokens, dtype=th.bool, device=device)
+    return mask.scatter_(1, order[:, :num_masked], True)
+
+
+def _visible_index(token_mask, dim):
+    num_visible = token_mask.shape[1] - int(token_mask[0].sum())
+    # A stable sort keeps the visible tokens in their original order
+    index = token_mask.to(th.uint8).argsort(dim=1, stable=True)[:, :num_visible]
+    return index.unsqueeze(-1).expand(-1, -1, dim)
+
+
+def drop_tokens(x, token_mask):
+    """
+    Keep the visible tokens of x [N x T x D], in order: [N x T_visible x D].
+    """
+    return x.gather(1, _visible_index(token_mask, x.shape[-1]))
+
+
+def restore_tokens(x, token_mask, fill):
+    """
+    Scatter the visible tokens x [N x T_visible x D] back into a full grid
+    whose dropped positions hold `fill` (broadcastable to [N x T x D]).
+    """
+    n, t = token_mask.shape
+    full = fill.to(x.dtype).expand(n, t, x.shape[-1])
+    return full.scatter(1, _visible_index(token_mask, x.shape[-1]), x)
+
+
+def visible_pixels(token_mask, patch_size):
+    """
+    Expand a token mask of a square grid to a float [N x 1 x H x W] mask
+    of the visible pixels, for the loss.
+    """
+    n, t = token_mask.shape
+    h = int(t ** 0.5)
+    assert h * h == t
+    visible = (~token_mask).view(n, 1, h, h).float()
+    return visible.repeat_interleave(patch_size, dim=2).repeat_interleave(patch_size, dim=3)
+
+
+def masked_mean(values, loss_mask):
+    """
+    Mean of the per-pixel `values` [N x C x ...] over the visible pixels of
+    `loss_mask` [N x 1 x ...]: an [N] tensor.
+    """
+    visible = loss_mask.expand_as(values)
+    dims = list(range(1, values.ndim))
+    return (values * visible).sum(dim=dims) / visible.sum(dim=dims).clamp(min=1)
+
+
+def masked_mse(model_output, target, x_t, loss_mask):
+    """
+    Split the squared error of a masked batch.
+
+    :param loss_mask: [N x 1 x ...] float mask of the visible pixels.
+    :return: a tuple (mse, recon) of [N] tensors: the mean squared error to
+             `target` over the visible pixels, and to the noisy input `x_t`
+             over the dropped ones.
+    """
+    channels = model_output.shape[1]
+    visible = loss_mask.expand_as(model_output)
+    dims = list(range(1, model_output.ndim))
+    num_visible = visible.sum(dim=dims).clamp(min=1)
+    num_masked = (channels * loss_mask[0].numel() - num_visible).clamp(min=1)
+    mse = masked_mean((target - model_output) ** 2, loss_mask)
+    recon = ((x_t - model_output) ** 2 * (1 - visible)).sum(dim=dims) / num_masked
+    return mse, recon
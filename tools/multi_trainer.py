@@ -0,0 +1,163 @@
+"""
+Co-training of several small experiments in one process (--experiments).
+
+Each experiment is the base run with a few settings overridden, e.g.
+
+    --experiments "eps:mean_type=EPSILON" "minsnr:weight_type=min_snr_5" "dit:model=DiT-S,lr=2e-4"
+
+and gets its own model, EMA, optimizer, scheduler and diffusion. They all
+train on the same batches, fetched and (for latents) sampled once per step,
+and with --share_noise on the same timesteps and noise, so differences
+between them come from the settings alone. --share_noise takes uniform (or
+stratified) timesteps, so it rules out --timestep_sampler and overrides of it. Experiments run one after the
+other within a step.
+
+Every experiment logs to --logdir/<name> (sample grids, its training loss
+in <dataset>/log/progress.csv and metric CSVs) and checkpoints to checkpoint/<dataset>/<model>/<name>, so `--resume auto`
+resumes each on its own. The first experiment's trainer owns the data
+iterator, and with it the data position stored in checkpoints.
+"""
+
+import argparse
+import os
+
+import torch
+
+from tools import dist_util, logger
+from tools.trainer import Trainer
+
+# Settings an experiment may override
+EXPERIMENT_KEYS = [
+    "model", "patch_size", "dropout", "lr", "final_lr", "warmup_steps", "ema_decay", "grad_clip",
+    "mean_type", "weight_type", "beta_schedule", "p", "var_type", "loss_type", "gamma",
+    "path_type", "timestep_sampler", "drop_label_prob", "mask_ratio", "mask_recon_weight",
+]
+
+
+def _cast(value, default):
+    if isinstance(default, bool):
+        return value.lower() in ("yes", "true", "t", "y", "1")
+    if default is None:
+        # Unset optional numbers (e.g. --grad_clip)
+        for cast in (int, float):
+            try:
+                return cast(value)
+            except ValueError:
+                pass
+        return value
+    return type(default)(value)
+
+
+def experiment_args(args):
+    """
+    Parse --experiments into one Namespace per experiment: a copy of `args`
+    with the experiment's overrides, logdir and checkpoint directory.
+    """
+    experiments = []
+    for spec in args.experiments:
+        name, _, overrides = spec.partition(":")
+        assert name and name not in [e.experiment for e in experiments], f"experiment names must be unique: {spec!r}"
+        exp_args = argparse.Namespace(**vars(args))
+        for item in filter(None, overrides.split(",")):
+            key, _, value = item.partition("=")
+            if key not in EXPERIMENT_KEYS or not hasattr(args, key):
+                raise ValueError(f"--experiments {name}: can't override {key!r}, expected one of {EXPERIMENT_KEYS}")
+            if key == "timestep_sampler" and args.share_noise:
+                raise ValueError(f"--experiments {name}: a timestep sampler draws its own timesteps, "
+                                 "which --share_noise shares between the experiments")
+            setattr(exp_args, key, _cast(value, getattr(args, key)))
+        exp_args.experiment = name
+        exp_args.logdir = os.path.join(args.logdir, name)
+        experiments.append(exp_args)
+    return experiments
+
+
+class MultiTrainer:
+    """
+    Steps every experiment on the same batches.
+
+    :param experiments: a list of dicts with the 'args', 'model', 'ema_model',
+                        'optimizer', 'scheduler' and 'diffusion' of each
+                        experiment (see main.init).
+    """
+
+    def __init__(self, args, device, experiments, train_loader, start_step, pbar=None):
+        self.args = args
+        self.device = device
+        self.experiments = experiments
+        self.pbar = pbar
+        self.trainers = []
+        for i, exp in enumerate(experiments):
+            exp_args = exp["args"]
+            # Phase timings would mix the experiments
+            exp_args.timing = False
+            assert exp_args.grad_accumulation == args.grad_accumulation
+            loader = train_loader if i == 0 else None
+            self.trainers.append(Trainer(exp_args, device, exp["model"], exp["ema_model"], exp["optimizer"],
+                                         exp["scheduler"], exp["diffusion"], loader, start_step))
+        # Each experiment's losses go to its own progress.csv, next to its metrics
+        self.loggers = []
+        if dist_util.is_main_process():
+            for exp in experiments:
+                log_dir = os.path.join(exp["args"].logdir, exp["args"].dataset, "log")
+                self.loggers.append(logger.Logger(log_dir, [logger.make_output_format("csv", log_dir)]))
+        if args.share_noise:
+            assert args.timestep_sampler == "uniform", "--share_noise shares uniform timesteps, not --timestep_sampler's"
+            steps = {getattr(exp["diffusion"], "num_timesteps", None) for exp in experiments}
+            assert len(steps) == 1, "--share_noise needs the same timesteps (--model_mode, --diffusion_steps) in every experiment"
+            self.num_timesteps = steps.pop()
+
+    @property
+    def names(self):
+        return [exp["args"].experiment for exp in self.experiments]
+
+    def _draw(self, images):
+        # The first experiment's batch construction, completed with the
+        # uniform draws training_losses would make
+        t, noise = self.trainers[0].batch_constructor(images)
+        if t is None:
+            n = images.shape[0]
+            if self.num_timesteps is None:
+                t = torch.rand(n, device=images.device)
+            else:
+                t = torch.randint(0, self.num_timesteps, (n,), device=images.device)
+        if noise is None:
+            noise = torch.randn_like(images)
+        return t, noise
+
+    def train_step(self, step):
+        """
+        Fetch the step's batches once and take an optimizer step of every
+        experiment on them. Returns the loss of each experiment by name.
+        """
+        lead = self.trainers[0]
+        if self.args.parallel:
+            lead.train_loader.sampler.set_epoch(step)
+        batches = []
+        for _ in range(max(1, self.args.grad_accumulation)):
+            images, labels = lead.prepare_batch(*lead._get_next_batch())
+            draws = self._draw(images) if self.args.share_noise else None
+            batches.append((images, labels, draws))
+
+        losses = {name: trainer.train_step(step, batches) for name, trainer in zip(self.names, self.trainers)}
+        if dist_util.is_main_process() and self.pbar is not None:
+            self.pbar.update(1)
+            self.pbar.set_postfix(losses)
+        return losses
+
+    def log_step(self, step, losses):
+        # The run's logger only gets the console summary of all experiments
+        for name, loss in losses.items():
+            logger.logkv_mean(f"loss_{name}", loss)
+        for exp_logger, loss in zip(self.loggers, losses.values()):
+            exp_logger.logkv_mean("loss", loss)
+        if step % self.args.log_interval == 0:
+            for exp_logger in self.loggers:
+                exp_logger.logkv("step", step)
+                exp_logger.dumpkvs()
+            logger.logkv("step", step)
+            logger.dumpkvs()
+
+    def close(self):
+        for exp_logger in self.loggers:
+            exp_logger.close()
@@ -6,6 +6,7 @@ import math
 
 import torch as th
 import torch.nn as nn
+import torch.utils.checkpoint
 
 
 # PyTorch 1.7 has SiLU, but we support PyTorch 1.5.
@@ -126,45 +127,49 @@ def checkpoint(func, inputs, params, flag):
     Evaluate a function without caching intermediate activations, allowing for
     reduced memory at the expense of extra compute in the backward pass.
 
+    Uses the non-reentrant torch.utils.checkpoint implementation, which
+    handles inputs that don't require grad (e.g. None or integer tensors) and
+    nested checkpoints.
+
     :param func: the function to evaluate.
     :param inputs: the argument sequence to pass to `func`.
     :param params: a sequence of parameters `func` depends on but does not
-                   explicitly take as arguments.
-    :param flag: if False, disable gradient checkpointing.
+                   explicitly take as arguments. Unused by the non-reentrant
+                   implementation; kept for API compatibility.
+    :param flag: if False, disable gradient checkpointing. Also disabled when
+                 grad mode is off, since there is no backward to save memory for.
     """
-    if flag:
-        args = tuple(inputs) + tuple(params)
-        return CheckpointFunction.apply(func, len(inputs), *args)
+    if flag and th.is_grad_enabled():
+        return th.utils.checkpoint.checkpoint(func, *inputs, use_reentrant=False)
     else:
         return func(*inputs)
 
 
-class CheckpointFunction(th.autograd.Function):
-    @staticmethod
-    def forward(ctx, run_function, length, *args):
-        ctx.run_function = run_function
-        ctx.input_tensors = list(args[:length])
-        ctx.input_params = list(args[length:])
-        with th.no_grad():
-            output_tensors = ctx.run_function(*ctx.input_tensors)
-        return output_tensors
-
-    @staticmethod
-    def backward(ctx, *output_grads):
-        ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
-        with th.enable_grad():
-            # Fixes a bug where the first op in run_function modifies the
-            # Tensor storage in place, which is not allowed for detach()'d
-            # Tensors.
-            shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
-            output_tensors = ctx.run_function(*shallow_copies)
-        input_grads = th.autograd.grad(
-            output_tensors,
-            ctx.input_tensors + ctx.input_params,
-            output_grads,
-            allow_unused=True,
-        )
-        del ctx.input_tensors
-        del ctx.input_params
-        del output_tensors
-        return (None, None) + input_grads
+CHECKPOINT_POLICIES = ["none", "all", "every_k", "attn", "mlp"]
+
+
+def set_checkpoint_policy(blocks, policy, every_k=1):
+    """
+    Configure activation checkpointing on an ordered sequence of blocks.
+
+    Transformer blocks expose `use_checkpoint` (the whole block) as well as
+    `checkpoint_attn` and `checkpoint_mlp` (only that sub-layer). UNet blocks
+    only have `use_checkpoint` and declare through `checkpoint_kind` whether
+    they count as an attention ("attn") or an MLP-like ("mlp") block.
+
+    :param blocks: the blocks, in forward order.
+    :param policy: one of CHECKPOINT_POLICIES.
+    :param every_k: for "every_k", checkpoint blocks 0, k, 2k, ...
+    """
+    if policy not in CHECKPOINT_POLICIES:
+        raise ValueError(f"unknown checkpoint policy: {policy}")
+    assert every_k >= 1, "every_k must be a positive integer"
+    for i, block in enumerate(blocks):
+        whole = policy == "all" or (policy == "every_k" and i % every_k == 0)
+        kind = getattr(block, "checkpoint_kind", None)
+        if kind is None:
+            block.use_checkpoint = whole
+            block.checkpoint_attn = policy == "attn"
+            block.checkpoint_mlp = policy == "mlp"
+        else:
+            block.use_checkpoint = whole or policy == kind
@@ -0,0 +1,307 @@
+"""
+Pipeline-parallel training of the deep transformers (DiT, U-ViT).
+
+The model is flattened into a list of layers (the embeddings, every block,
+the output head) that map a tuple of tensors to the next one. The list is
+split into contiguous stages, one per rank, with the blocks balanced across
+them. For DiT the tuple is (tokens, conditioning). For U-ViT it is
+(tokens, *skips): every in-block pushes its output and every out-block pops
+the last one, so the long skip connections cross stage boundaries along with
+the tokens.
+
+Each batch is split into micro-batches and run with the GPipe schedule: every
+micro-batch goes forward through all stages, then every micro-batch goes
+backward in reverse order. Activations and their gradients move between
+neighbouring ranks with point-to-point send/recv, so the runner works with
+gloo on CPU. The loss of every micro-batch is scaled by 1 / (micro-batches x
+accumulation steps), so the gradients and the returned loss match those of
+Trainer.train_step on the same data.
+
+Each rank only holds its own stage's parameters, and builds its optimizer
+and EMA on them. full_state_dict() gathers the weights under the keys of the
+unsplit model, so exported weights don't depend on the split.
+
+Run `python -m checks.pipeline` for a 3-stage check against a single process
+with gloo on CPU.
+"""
+
+import torch as th
+import torch.distributed as dist
+import torch.nn as nn
+
+from models.uvit import timestep_embedding, unpatchify
+
+# Wire codes of the dtypes sent between stages
+_DTYPES = [th.float32, th.float16, th.bfloat16, th.float64, th.int64, th.int32, th.bool]
+
+
+class _DiTEmbed(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.x_embedder, self.t_embedder, self.y_embedder = model.x_embedder, model.t_embedder, model.y_embedder
+        self.pos_embed = model.pos_embed
+
+    def forward(self, x, t, y=None):
+        c = self.t_embedder(t) + self.y_embedder(y, self.training)
+        return self.x_embedder(x) + self.pos_embed, c
+
+
+class _DiTBlock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        self.block = block
+
+    def forward(self, x, c):
+        return self.block(x, c), c
+
+
+class _DiTHead(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.final_layer = model.final_layer
+        self.out_channels = model.out_channels
+
+    def forward(self, x, c):
+        # DiT's unpatchify has U-ViT's (p1 p2 C) layout
+        return (unpatchify(self.final_layer(x, c), self.out_channels),)
+
+
+class _UViTEmbed(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.patch_embed, self.time_embed = model.patch_embed, model.time_embed
+        self.label_emb = model.label_emb if model.num_classes > 0 else None
+        self.pos_embed = model.pos_embed
+        self.embed_dim = model.embed_dim
+
+    def forward(self, x, t, y=None):
+        x = self.patch_embed(x)
+        tokens = [self.time_embed(timestep_embedding(t, self.embed_dim)).unsqueeze(dim=1), x]
+        if y is not None:
+            tokens.insert(0, self.label_emb(y).unsqueeze(dim=1))
+        return (th.cat(tokens, dim=1) + self.pos_embed,)
+
+
+class _UViTBlock(nn.Module):
+    def __init__(self, block, kind):
+        super().__init__()
+        self.block, self.kind = block, kind
+
+    def forward(self, x, *skips):
+        if self.kind == "in":
+            x = self.block(x)
+            return (x, *skips, x)
+        if self.kind == "mid":
+            return (self.block(x), *skips)
+        return (self.block(x, skips[-1]), *skips[:-1])
+
+
+class _UViTHead(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.norm, self.decoder_pred, self.final_layer = model.norm, model.decoder_pred, model.final_layer
+        self.extras, self.in_channels = model.extras, model.in_channels
+
+    def forward(self, x):
+        x = self.decoder_pred(self.norm(x))[:, self.extras:, :]
+        return (self.final_layer(unpatchify(x, self.in_channels)),)
+
+
+def pipeline_layers(model):
+    """
+    The layers of a DiT or U-ViT in execution order, and whether each is a
+    transformer block (what the stages are balanced by).
+    """
+    from models.dit import DiT
+    from models.uvit import UViT
+
+    if isinstance(model, DiT):
+        # Without a token mask the decoder blocks just follow the blocks
+        blocks = [_DiTBlock(b) for b in [*model.blocks, *model.decoder_blocks]]
+        return [_DiTEmbed(model), *blocks, _DiTHead(model)], [False, *[True] * len(blocks), False]
+    if isinstance(model, UViT):
+        blocks = ([_UViTBlock(b, "in") for b in model.in_blocks] + [_UViTBlock(model.mid_block, "mid")]
+                  + [_UViTBlock(b, "out") for b in model.out_blocks])
+        return [_UViTEmbed(model), *blocks, _UViTHead(model)], [False, *[True] * len(blocks), False]
+    raise ValueError(f"Pipeline parallelism supports DiT and U-ViT, not {type(model).__name__}")
+
+
+def partition(is_block, num_stages):
+    """
+    The stage of every layer: contiguous, with the blocks split as evenly as
+    possible; the embedding goes to the first stage and the head to the last.
+    """
+    num_blocks = sum(is_block)
+    assert num_blocks >= num_stages, f"{num_blocks} blocks don't fill {num_stages} stages"
+    stages, seen = [], 0
+    for block in is_block:
+        stages.append(min(num_stages - 1, seen * num_stages // num_blocks))
+        seen += block
+    return stages
+
+
+def _send(tensors, dst, device):
+    header = [len(tensors)]
+    for t in tensors:
+        header += [_DTYPES.index(t.dtype), t.dim(), *t.shape]
+    dist.send(th.tensor([len(header)], device=device), dst)
+    dist.send(th.tensor(header, device=device), dst)
+    for t in tensors:
+        dist.send(t.detach().contiguous(), dst)
+
+
+def _recv(src, device):
+    length = th.empty(1, dtype=th.long, device=device)
+    dist.recv(length, src)
+    header = th.empty(int(length), dtype=th.long, device=device)
+    dist.recv(header, src)
+    header, tensors, i = header.tolist(), [], 1
+    for _ in range(header[0]):
+        dtype, ndim = _DTYPES[header[i]], header[i + 1]
+        t = th.empty(header[i + 2:i + 2 + ndim], dtype=dtype, device=device)
+        dist.recv(t, src)
+        tensors.append(t)
+        i += 2 + ndim
+    return tensors
+
+
+class PipelineStage(nn.Module):
+    """This rank's layers, run in order on the tuple of tensors."""
+
+    def __init__(self, layers):
+        super().__init__()
+        self.layers = nn.ModuleList(layers)
+
+    def forward(self, *state):
+        for layer in self.layers:
+            state = layer(*state)
+        return state
+
+
+class PipelineRunner:
+    """
+    Train a DiT or U-ViT split into one stage per rank.
+
+    Every rank builds the full model with the same weights and keeps only its
+    stage (self.stage), which the optimizer and EMA of the rank are built on.
+
+    :param num_microbatches: micro-batches each batch is split into.
+    :param balance: optional number of layers per stage (embedding and head
+                    included), instead of balancing the blocks.
+    """
+
+    def __init__(self, model, device, num_microbatches=1, balance=None):
+        self.device = device
+        self.rank, self.num_stages = dist.get_rank(), dist.get_world_size()
+        self.num_microbatches = num_microbatches
+        self.out_channels = getattr(model, "out_channels", model.in_channels)
+        layers, is_block = pipeline_layers(model)
+        if balance is None:
+            stages = partition(is_block, self.num_stages)
+        else:
+            assert len(balance) == self.num_stages and sum(balance) == len(layers)
+            stages = [s for s, n in enumerate(balance) for _ in range(n)]
+        self.stage = PipelineStage([l for l, s in zip(layers, stages) if s == self.rank])
+        # Keys of the unsplit model, for checkpoints
+        full_keys = {id(v): k for k, v in model.state_dict(keep_vars=True).items()}
+        self.full_keys = {k: full_keys[id(v)] for k, v in self.stage.state_dict(keep_vars=True).items()}
+        self.stage.to(device)
+
+    @property
+    def is_first(self):
+        return self.rank == 0
+
+    @property
+    def is_last(self):
+        return self.rank == self.num_stages - 1
+
+    def _forward_backward(self, diffusion, x_start, t, noise, model_kwargs, scale):
+        """GPipe schedule over the micro-batches of one batch; returns its scaled loss."""
+        m = self.num_microbatches
+        assert x_start.shape[0] % m == 0, "the batch must split into equal micro-batches"
+        assert set(model_kwargs) <= {"y"}, "pipeline stages only take the class labels"
+        micro = [dict(x_start=x, t=ts, noise=n, model_kwargs={k: v.chunk(m)[i] for k, v in model_kwargs.items()})
+                 for i, (x, ts, n) in enumerate(zip(x_start.chunk(m), t.chunk(m), noise.chunk(m)))]
+
+        records = []
+        for kwargs in micro:
+            record = {}
+
+            def stage_fn(x_t, timesteps, y=None):
+                if self.is_first:
+                    inputs = (x_t, timesteps) + ((y,) if y is not None else ())
+                else:
+                    inputs = [v.requires_grad_(v.is_floating_point()) for v in _recv(self.rank - 1, self.device)]
+                    record["inputs"] = inputs
+                outputs = self.stage(*inputs)
+                if self.is_last:
+                    return outputs[0]
+                _send(outputs, self.rank + 1, self.device)
+                record["outputs"] = outputs
+                # training_losses only needs the shape from the other stages
+                return th.zeros(x_t.shape[0], self.out_channels, *x_t.shape[2:], device=x_t.device)
+
+            losses = diffusion.training_losses(stage_fn, **kwargs)
+            record["loss"] = losses["loss"].mean() * scale
+            records.append(record)
+
+        loss = th.zeros((), device=self.device)
+        for record in reversed(records):
+            if self.is_last:
+                record["loss"].backward()
+                loss += record["loss"].detach()
+            else:
+                outputs = [o for o in record["outputs"] if o.requires_grad]
+                grads = _recv(self.rank + 1, self.device)
+                th.autograd.backward(outputs, [g for o, g in zip(record["outputs"], grads) if o.requires_grad])
+            if not self.is_first:
+                _send([v.grad if v.grad is not None else th.zeros_like(v) for v in record["inputs"]
+                       if v.is_floating_point()], self.rank - 1, self.device)
+        dist.broadcast(loss, src=self.num_stages - 1)
+        return loss.item()
+
+    def train_step(self, diffusion, optimizer, batches, scheduler=None, grad_clip=None):
+        """
+        One optimizer step over `batches`, the accumulation steps: a list of
+        (x_start, t, noise, model_kwargs), the same on every rank. The
+        timesteps and noise are drawn by the caller so that all stages agree.
+        Returns the accumulated loss on every rank, as Trainer.train_step.
+        """
+        self.stage.train()
+        scale = 1.0 / (len(batches) * self.num_microbatches)
+        loss_accumulated = 0.0
+        for x_start, t, noise, model_kwargs in batches:
+            loss_accumulated += self._forward_backward(diffusion, x_start, t, noise, model_kwargs, scale)
+        if grad_clip:
+            self.clip_grad_norm_(grad_clip)
+        optimizer.step()
+        optimizer.zero_grad()
+        if scheduler is not None:
+            scheduler.step()
+        return loss_accumulated
+
+    def clip_grad_norm_(self, max_norm):
+        """Clip by the norm of the gradient of all stages."""
+        grads = [p.grad for p in self.stage.parameters() if p.grad is not None]
+        sq = sum((g.detach().float().square().sum() for g in grads), th.zeros((), device=self.device))
+        dist.all_reduce(sq)
+        total_norm = sq.sqrt()
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.detach().mul_(clip_coef.to(g.dtype))
+        return total_norm
+
+    def full_state_dict(self, module=None):
+        """
+        The state dict of the unsplit model on rank 0 (other ranks get an
+        empty dict), from this runner's stage or from `module`, a copy of it
+        such as its EMA. Call on every rank.
+        """
+        state = (module or self.stage).state_dict()
+        local = {self.full_keys[k]: v.detach().cpu() for k, v in state.items()}
+        parts = [None] * self.num_stages if self.is_first else None
+        dist.gather_object(local, parts, dst=0)
+        return {k: v for part in parts for k, v in part.items()} if self.is_first else {}
+
+    def load_full_state_dict(self, state, module=None):
+        (module or self.stage).load_state_dict({k: state[full] for k, full in self.full_keys.items()})
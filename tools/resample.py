@@ -1,22 +1,42 @@
+import math
 from abc import ABC, abstractmethod
 
-import numpy as np
 import torch as th
-import torch.nn.functional as F
 import torch.distributed as dist
 
+from tools import tensor_parallel
 
-def create_named_schedule_sampler(name : str, diffusion):
+# Training timestep distributions of discrete diffusion and of flow matching
+DIFFUSION_SAMPLERS = ["uniform", "loss-second-moment", "speed"]
+FLOW_SAMPLERS = ["uniform", "logit-normal", "mode", "cosine", "adaptive"]
+TIMESTEP_SAMPLERS = DIFFUSION_SAMPLERS + [name for name in FLOW_SAMPLERS if name not in DIFFUSION_SAMPLERS]
+
+
+def create_named_schedule_sampler(name : str, diffusion, device="cpu", **kwargs):
     """
     Create a ScheduleSampler from a library of pre-defined samplers.
 
+    Diffusions without discrete timesteps (FlowMatching) get the continuous
+    samplers of FLOW_SAMPLERS.
+
     :param name: the name of the sampler.
     :param diffusion: the diffusion object to sample for.
+    :param device: the device holding the sampler's state.
+    :param kwargs: parameters of the continuous samplers.
     """
+    if not hasattr(diffusion, "num_timesteps"):
+        if name not in FLOW_SAMPLERS:
+            raise ValueError(f"schedule sampler {name} needs a discrete diffusion, use one of {FLOW_SAMPLERS}")
+        return create_flow_time_sampler(name, device, **kwargs)
     if name == "uniform":
-        return UniformSampler(diffusion)
+        return UniformSampler(diffusion, device)
     elif name == "loss-second-moment":
-        return LossSecondMomentResampler(diffusion)
+        return LossSecondMomentResampler(diffusion, device=device)
+    elif name == "speed":
+        from .speed import SpeedSampler
+        return SpeedSampler(diffusion, device=device)
+    elif name in FLOW_SAMPLERS:
+        raise ValueError(f"schedule sampler {name} is for flow matching, use one of {DIFFUSION_SAMPLERS}")
     else:
         raise NotImplementedError(f"unknown schedule sampler: {name}")
 
@@ -30,12 +50,21 @@ class ScheduleSampler(ABC):
     objective's mean is unchanged.
     However, subclasses may override sample() to change how the resampled
     terms are reweighted, allowing for actual changes in the objective.
+
+    The weights are kept on the sampler's device, so that sampling does not
+    copy from or synchronise with the host.
+
+    `loss_weights` says how the weights returned by sample() are applied:
+    "importance" scales the total loss, "mse" is passed to training_losses
+    as `mse_weights` and scales only its MSE term.
     """
 
+    loss_weights = "importance"
+
     @abstractmethod
     def weights(self):
         """
-        Get a numpy array of weights, one per diffusion step.
+        Get a 1-D tensor of weights, one per diffusion step.
 
         The weights needn't be normalized, but must be positive.
         """
@@ -51,18 +80,22 @@ class ScheduleSampler(ABC):
                  - weights: a tensor of weights to scale the resulting losses.
         """
         w = self.weights()
-        p = w / np.sum(w)
-        indices_np = np.random.choice(len(p), size=(batch_size,), p=p)
-        indices = th.from_numpy(indices_np).long().to(device)
-        weights_np = 1 / (len(p) * p[indices_np])
-        weights = th.from_numpy(weights_np).float().to(device)
-        return indices, weights
+        p = w / w.sum()
+        indices = th.multinomial(p, batch_size, replacement=True)
+        weights = 1 / (len(p) * p[indices])
+        return indices.to(device), weights.float().to(device)
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
 
 
 class UniformSampler(ScheduleSampler):
-    def __init__(self, diffusion):
+    def __init__(self, diffusion, device="cpu"):
         self.diffusion = diffusion
-        self._weights = np.ones([diffusion.num_timesteps])
+        self._weights = th.ones([diffusion.num_timesteps], dtype=th.float64, device=device)
 
     def weights(self):
         return self._weights
@@ -78,38 +111,22 @@ class LossAwareSampler(ScheduleSampler):
         This method will perform synchronization to make sure all of the ranks
         maintain the exact same reweighting.
 
+        All ranks must pass the same number of timesteps, as the training
+        loader does with drop_last, so that a single all_gather of the packed
+        (timestep, loss) pairs is enough.
+
         :param local_ts: an integer Tensor of timesteps.
         :param local_losses: a 1D Tensor of losses.
         """
-        # Check if training is distributed
+        # Timesteps are exact in float64, so both travel in one tensor.
+        local = th.stack([local_ts.to(th.float64), local_losses.detach().to(th.float64)], dim=1)
         if dist.is_available() and dist.is_initialized():
-            batch_sizes = [
-                th.tensor([0], dtype=th.int32, device=local_ts.device)
-                for _ in range(dist.get_world_size())
-            ]
-            dist.all_gather(
-                batch_sizes,
-                th.tensor([len(local_ts)], dtype=th.int32, device=local_ts.device),
-            )
-
-            # Pad all_gather batches to be the maximum batch size.
-            batch_sizes = [x.item() for x in batch_sizes]
-            max_bs = max(batch_sizes)
-
-            timestep_batches = [th.zeros(max_bs).to(local_ts) for bs in batch_sizes]
-            loss_batches = [th.zeros(max_bs).to(local_losses) for bs in batch_sizes]
-            dist.all_gather(timestep_batches, local_ts)
-            dist.all_gather(loss_batches, local_losses)
-            timesteps = [
-                x.item() for y, bs in zip(timestep_batches, batch_sizes) for x in y[:bs]
-            ]
-            losses = [x.item() for y, bs in zip(loss_batches, batch_sizes) for x in y[:bs]]
-        else:
-            # In the case of a single card, no synchronisation is required. Local data is used directly.
-            timesteps = local_ts.tolist()
-            losses = local_losses.tolist()
-
-        self.update_with_all_losses(timesteps, losses)
+            # Over data-parallel ranks: a tensor-parallel group shares one batch
+            gathered = [th.empty_like(local) for _ in range(tensor_parallel.data_parallel_size())]
+            dist.all_gather(gathered, local, group=tensor_parallel.data_parallel_group())
+            local = th.cat(gathered, dim=0)
+
+        self.update_with_all_losses(local[:, 0].long(), local[:, 1])
 
     @abstractmethod
     def update_with_all_losses(self, ts, losses):
@@ -124,40 +141,188 @@ class LossAwareSampler(ScheduleSampler):
         ranks with identical arguments. Thus, it should have deterministic
         behavior to maintain state across workers.
 
-        :param ts: a list of int timesteps.
-        :param losses: a list of float losses, one per timestep.
+        :param ts: an integer tensor of timesteps.
+        :param losses: a float tensor of losses, one per timestep.
         """
 
 
 class LossSecondMomentResampler(LossAwareSampler):
-    def __init__(self, diffusion, history_per_term=10, uniform_prob=0.001):
+    """
+    Samples timesteps in proportion to the root mean square of their last
+    `history_per_term` losses, once every timestep has a full history.
+
+    The history of each timestep is a ring buffer: a batch of losses is
+    written with one scatter, and a timestep's oldest entries are the ones
+    overwritten.
+    """
+
+    def __init__(self, diffusion, history_per_term=10, uniform_prob=0.001, device="cpu"):
         self.diffusion = diffusion
         self.history_per_term = history_per_term
         self.uniform_prob = uniform_prob
-        self._loss_history = np.zeros(
-            [diffusion.num_timesteps, history_per_term], dtype=np.float64
-        )
-        self._loss_counts = np.zeros([diffusion.num_timesteps], dtype=int)
+        num_timesteps = diffusion.num_timesteps
+        self._loss_history = th.zeros([num_timesteps, history_per_term], dtype=th.float64, device=device)
+        self._loss_counts = th.zeros([num_timesteps], dtype=th.long, device=device)
+        # Next slot to write in each ring buffer
+        self._next_slot = th.zeros([num_timesteps], dtype=th.long, device=device)
 
     def weights(self):
-        if not self._warmed_up():
-            return np.ones([self.diffusion.num_timesteps], dtype=np.float64)
-        weights = np.sqrt(np.mean(self._loss_history ** 2, axis=-1))
-        weights /= np.sum(weights)
+        weights = th.sqrt(th.mean(self._loss_history ** 2, dim=-1))
+        weights /= th.sum(weights).clamp_min(th.finfo(weights.dtype).tiny)
         weights *= 1 - self.uniform_prob
         weights += self.uniform_prob / len(weights)
-        return weights
+        # Uniform until warmed up; th.where avoids a host sync on the check.
+        return th.where(self._warmed_up(), weights, th.ones_like(weights))
 
     def update_with_all_losses(self, ts, losses):
-        for t, loss in zip(ts, losses):
-            if self._loss_counts[t] == self.history_per_term:
-                # Shift out the oldest loss term.
-                self._loss_history[t, :-1] = self._loss_history[t, 1:]
-                self._loss_history[t, -1] = loss
-            else:
-                self._loss_history[t, self._loss_counts[t]] = loss
-                self._loss_counts[t] += 1
+        ts = ts.to(self._loss_history.device)
+        losses = losses.to(self._loss_history)
+        num_timesteps, history = self._loss_history.shape
+
+        # Rank of each loss among the losses of the same timestep in the batch,
+        # in batch order, from a stable sort by timestep.
+        order = th.sort(ts, stable=True)[1]
+        sorted_ts = ts[order]
+        per_t = th.bincount(ts, minlength=num_timesteps)
+        first = th.cumsum(per_t, dim=0) - per_t
+        occurrence = th.empty_like(ts)
+        occurrence[order] = th.arange(len(ts), device=ts.device) - first[sorted_ts]
+
+        # Only the last `history` losses of a timestep survive; dropping the
+        # others first keeps the scatter free of duplicate indices.
+        keep = occurrence >= per_t[ts] - history
+        slots = (self._next_slot[ts] + occurrence) % history
+        self._loss_history.index_put_((ts[keep], slots[keep]), losses[keep])
+
+        self._next_slot = (self._next_slot + per_t) % history
+        self._loss_counts = th.clamp(self._loss_counts + per_t, max=history)
 
     def _warmed_up(self):
         return (self._loss_counts == self.history_per_term).all()
 
+    def state_dict(self):
+        return {
+            'loss_history': self._loss_history,
+            'loss_counts': self._loss_counts,
+            'next_slot': self._next_slot,
+        }
+
+    def load_state_dict(self, state):
+        self._loss_history.copy_(state['loss_history'])
+        self._loss_counts.copy_(state['loss_counts'])
+        self._next_slot.copy_(state['next_slot'])
+
+
+
+def create_flow_time_sampler(name, device="cpu", location=0.0, scale=1.0, mode_scale=1.29, bins=64):
+    """
+    Create a sampler of continuous training times t in [0, 1] for flow
+    matching, where t = 0 is data and t = 1 is noise.
+
+    :param location, scale: mean and std of the normal of "logit-normal".
+    :param mode_scale: the scale s of "mode".
+    :param bins: the number of histogram bins of "adaptive".
+    """
+    if name == "uniform":
+        return ContinuousTimeSampler(lambda u: u, device)
+    elif name == "logit-normal":
+        return LogitNormalSampler(location, scale, device)
+    elif name == "mode":
+        # Mode sampling with heavy tails (Esser et al., 2024, eq. 20)
+        return ContinuousTimeSampler(
+            lambda u: 1 - u - mode_scale * (th.cos(math.pi / 2 * u) ** 2 - 1 + u), device)
+    elif name == "cosine":
+        # CosMap (Esser et al., 2024, eq. 21)
+        return ContinuousTimeSampler(lambda u: 1 - 1 / (th.tan(math.pi / 2 * u) + 1), device)
+    elif name == "adaptive":
+        return AdaptiveHistogramSampler(bins, device=device)
+    else:
+        raise NotImplementedError(f"unknown flow time sampler: {name}")
+
+
+class ContinuousTimeSampler(ScheduleSampler):
+    """
+    Times t = transform(u) for u ~ U(0, 1). The density of t changes the
+    objective, so no weights are returned.
+    """
+
+    def __init__(self, transform, device="cpu"):
+        self.transform = transform
+        self.device = device
+
+    def weights(self):
+        raise NotImplementedError("continuous samplers have no per-timestep weights")
+
+    def sample(self, batch_size, device):
+        u = th.rand(batch_size, device=device)
+        return self.transform(u).clamp_(0.0, 1.0), None
+
+
+class LogitNormalSampler(ContinuousTimeSampler):
+    """t = sigmoid(z) for z ~ N(location, scale^2) (Esser et al., 2024, eq. 19)."""
+
+    def __init__(self, location=0.0, scale=1.0, device="cpu"):
+        super().__init__(None, device)
+        self.location = location
+        self.scale = scale
+
+    def sample(self, batch_size, device):
+        z = th.randn(batch_size, device=device) * self.scale + self.location
+        return th.sigmoid(z), None
+
+
+class AdaptiveHistogramSampler(LossAwareSampler):
+    """
+    Piecewise-uniform density over `bins` equal bins of [0, 1], proportional
+    to the running RMS of the losses that fall into each bin, mixed with
+    `uniform_prob` of the uniform density. Losses are importance-weighted, so
+    the objective is unchanged.
+
+    The histogram lives on the training device. Updates are a bincount and
+    one all_reduce of the per-bin sums, with no host synchronisation.
+    """
+
+    def __init__(self, bins=64, decay=0.99, uniform_prob=0.1, device="cpu"):
+        self.bins = bins
+        self.decay = decay
+        self.uniform_prob = uniform_prob
+        self._second_moment = th.ones([bins], dtype=th.float64, device=device)
+
+    def weights(self):
+        weights = th.sqrt(self._second_moment)
+        weights = weights / weights.sum() * (1 - self.uniform_prob)
+        return weights + self.uniform_prob / self.bins
+
+    def sample(self, batch_size, device):
+        p = self.weights()
+        indices = th.multinomial(p, batch_size, replacement=True)
+        t = (indices + th.rand(batch_size, device=p.device, dtype=p.dtype)) / self.bins
+        weights = 1 / (self.bins * p[indices])
+        return t.float().to(device), weights.float().to(device)
+
+    def update_with_local_losses(self, local_ts, local_losses):
+        self.update_with_all_losses(local_ts, local_losses)
+
+    def update_with_all_losses(self, ts, losses):
+        """
+        Sum the squared losses per bin, across ranks if distributed, and move
+        each visited bin's running second moment towards their mean.
+        """
+        device = self._second_moment.device
+        indices = (ts.detach().to(device) * self.bins).long().clamp_(0, self.bins - 1)
+        sums = th.stack([
+            th.bincount(indices, weights=losses.detach().to(device, th.float64) ** 2, minlength=self.bins),
+            th.bincount(indices, minlength=self.bins).to(th.float64),
+        ])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(sums, group=tensor_parallel.data_parallel_group())
+        visited = sums[1] > 0
+        mean = sums[0] / sums[1].clamp_min(1)
+        updated = self.decay * self._second_moment + (1 - self.decay) * mean
+        self._second_moment = th.where(visited, updated, self._second_moment)
+
+    def state_dict(self):
+        return {'second_moment': self._second_moment}
+
+    def load_state_dict(self, state):
+        self._second_moment.copy_(state['second_moment'])
@@ -3,7 +3,7 @@ from tqdm import tqdm
 import torch.distributed as dist
 from diffusers.models import AutoencoderKL
 from torch.cuda.amp import autocast
-from tools import dist_util
+from tools import dist_util, compile_util, sharding, tensor_parallel
 from .cfg_edm import ablation_sampler, float_equal, Net
 from models.unet import EncoderUNetModel
 
@@ -51,6 +51,9 @@ class Classifier:
 
 def sync_ema_model(eval_model):
     """Synchronize EMA model parameters across distributed devices."""
+    if sharding.is_fsdp(eval_model) or tensor_parallel.is_parallel(eval_model):
+        # Each rank already holds its own up-to-date EMA shard
+        return
     for param in eval_model.parameters():
         dist.broadcast(param.data, src=0)
 
@@ -59,16 +62,19 @@ class Sampler:
         self.args = args     
         self.device = device
         self.model = eval_model
+        # Denoiser used inside the solvers; a compiled copy of the model under --compile
+        self.denoiser = compile_util.compile_denoiser(eval_model, args)
         self.diffusion = diffusion      
         self.classifier = classifier
 
     def _model_fn(self, x, t, y=None):
-        return self.model(x, t, y if self.args.class_cond else None)
+        return self.denoiser(x, t, y if self.args.class_cond else None)
     
     def ddim_sampler(self, num_samples, sample_size, image_size, num_classes, progress_bar=False):
         self.model.eval()
         all_samples, all_labels = [], []
-        world_size = dist.get_world_size() if self.args.parallel else 1
+        # The ranks of a tensor-parallel group sample together
+        world_size = tensor_parallel.data_parallel_size() if self.args.parallel else 1
 
         if self.args.parallel:
             sync_ema_model(self.model)
@@ -82,7 +88,7 @@ class Sampler:
         while len(all_samples) * sample_size < num_samples:
             classes = self._get_y_cond(sample_size, num_classes)
             sample = self.diffusion.ddim_sample_loop(
-                self.model if not self.classifier else self._model_fn,
+                self.denoiser if not self.classifier else self._model_fn,
                 (sample_size, 3, image_size, image_size),
                 device=self.device,
                 model_kwargs={"y": classes} if self.args.class_cond else {},
@@ -100,7 +106,7 @@ class Sampler:
     def edm_sampler(self, num_samples, sample_size, image_size, num_classes, progress_bar=False):
         self.model.eval()
         all_samples, all_labels = [], []
-        world_size = dist.get_world_size() if self.args.parallel else 1
+        world_size = tensor_parallel.data_parallel_size() if self.args.parallel else 1
 
         if self.args.parallel:
             sync_ema_model(self.model)
@@ -110,7 +116,7 @@ class Sampler:
             pbar = tqdm(total=num_samples, desc=f"Generating Samples ({self.args.solver.capitalize()})")
 
         vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-{self.args.vae}", local_files_only=True).to(self.device) if self.args.in_chans == 4 else None
-        net = Net(model=self.model, img_channels=self.args.in_chans, img_resolution=image_size, label_dim=num_classes,
+        net = Net(model=self.denoiser, img_channels=self.args.in_chans, img_resolution=image_size, label_dim=num_classes,
                   noise_schedule=self.args.beta_schedule, amp=self.args.amp, power=self.args.p,
                   pred_type=self.args.mean_type).to(self.device)
 
@@ -136,7 +142,7 @@ class Sampler:
     def flow_matching_sampler(self, num_samples, sample_size, image_size, num_classes, progress_bar=False):
         self.model.eval()
         all_samples, all_labels = [], []
-        world_size = dist.get_world_size() if self.args.parallel else 1
+        world_size = tensor_parallel.data_parallel_size() if self.args.parallel else 1
 
         if self.args.parallel:
             sync_ema_model(self.model)
@@ -155,7 +161,7 @@ class Sampler:
 
             guidance_scale = self._limited_interval_guidance(self.args.t_from, self.args.t_to, self.args.guidance_scale)
 
-            sample = self.diffusion.sample(self.model, z, self.device, num_steps=self.args.sample_steps, solver=self.args.solver,
+            sample = self.diffusion.sample(self.denoiser, z, self.device, num_steps=self.args.sample_steps, solver=self.args.solver,
                                            guidance_scale=guidance_scale, y=class_labels)
             
             sample = self._process_sample(sample, vae)
@@ -181,11 +187,11 @@ class Sampler:
         """Gather samples across devices if running in parallel."""
         if self.args.parallel:
             gathered_samples = [torch.zeros_like(sample) for _ in range(world_size)]
-            dist.all_gather(gathered_samples, sample)
+            dist.all_gather(gathered_samples, sample, group=tensor_parallel.data_parallel_group())
             all_samples.extend([sample.cpu().numpy() for sample in gathered_samples])
             if self.args.class_cond:
                 gathered_labels = [torch.zeros_like(labels) for _ in range(world_size)]
-                dist.all_gather(gathered_labels, labels)
+                dist.all_gather(gathered_labels, labels, group=tensor_parallel.data_parallel_group())
                 all_labels.extend([label.cpu().numpy() for label in gathered_labels])
         else:
             all_samples.append(sample.cpu().numpy())
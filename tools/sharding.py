@@ -0,0 +1,176 @@
+"""
+Data-parallel wrapping with optional sharding of the optimizer state (ZeRO)
+or of parameters, gradients and optimizer state (FSDP).
+
+--shard none: DDP + AdamW, every rank holds the full training state.
+--shard zero: DDP + ZeroRedundancyOptimizer, the Adam moments are partitioned
+              across ranks. Works with gloo on CPU.
+--shard fsdp: FullyShardedDataParallel with one unit per block of the model
+              (see checkpoint_blocks()). The EMA model is sharded the same way
+              and updated on local shards. Requires CUDA with torch 2.1.
+
+With --tensor_parallel (see tools/tensor_parallel.py), DDP runs over the
+data-parallel group and the helpers below gather or split the shards.
+
+Checkpoints always hold full, unsharded state dicts with the same keys as a
+DDP run, so model and EMA weights load in any mode. Gathering them is a
+collective, so the state dict helpers below must be called on every rank.
+
+Run `python -m checks.sharding` for a multi-process check with gloo on CPU.
+"""
+
+import torch as th
+import torch.optim as optim
+from torch.cuda.amp import GradScaler
+from torch.distributed.fsdp import (
+    FullOptimStateDictConfig,
+    FullStateDictConfig,
+    FullyShardedDataParallel as FSDP,
+    ShardingStrategy,
+    StateDictType,
+)
+from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
+from torch.distributed.fsdp.wrap import ModuleWrapPolicy
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from tools import dist_util, tensor_parallel
+
+SHARD_MODES = ["none", "zero", "fsdp"]
+
+
+def is_fsdp(model):
+    return isinstance(model, FSDP)
+
+
+def wrap_model(model, args, device):
+    """
+    Wrap `model` for data-parallel training according to `args.shard`.
+    """
+    if not args.parallel:
+        return model
+    if getattr(args, "shard", "none") == "fsdp":
+        assert device.type == "cuda", "--shard fsdp requires CUDA devices"
+        return FSDP(
+            model,
+            auto_wrap_policy=ModuleWrapPolicy({type(b) for b in model.checkpoint_blocks()}),
+            sharding_strategy=ShardingStrategy.FULL_SHARD,
+            device_id=device,
+            # Ranks are seeded differently, start from rank 0's weights as DDP does.
+            sync_module_states=True,
+            # Frozen parameters (e.g. DiT's pos_embed) share flat parameters
+            # with trainable ones.
+            use_orig_params=True,
+        )
+    process_group = tensor_parallel.data_parallel_group()
+    if device.type == "cuda":
+        return DDP(model, device_ids=[device.index], output_device=device.index, process_group=process_group)
+    return DDP(model, process_group=process_group)
+
+
+def build_optimizer(model, args):
+    """
+    AdamW over the (wrapped) model's parameters, partitioned across ranks
+    with --shard zero. Under FSDP the parameters are already local shards.
+    """
+    kwargs = dict(lr=args.lr, betas=args.betas, weight_decay=args.weight_decay, eps=args.eps)
+    if args.parallel and args.shard == "zero":
+        return ZeroRedundancyOptimizer(model.parameters(), optimizer_class=optim.AdamW, **kwargs)
+    return optim.AdamW(model.parameters(), **kwargs)
+
+
+def grad_scaler(model):
+    """
+    GradScaler for AMP; FSDP and tensor parallelism need the sharded variant
+    to find infs across ranks.
+    """
+    return ShardedGradScaler() if is_fsdp(model) or tensor_parallel.is_parallel(model) else GradScaler()
+
+
+def clip_grad_norm_(model, max_norm):
+    if is_fsdp(model):
+        return model.clip_grad_norm_(max_norm)
+    if tensor_parallel.is_parallel(model):
+        return tensor_parallel.clip_grad_norm_(model, max_norm)
+    return th.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+
+
+@th.no_grad()
+def update_ema_shards(model, ema_model, decay):
+    """
+    EMA update of an FSDP or tensor-parallel model, done by every rank on its
+    own shards.
+    `ema_model` must be wrapped exactly like `model`.
+    """
+    for param, ema_param in zip(model.parameters(), ema_model.parameters()):
+        ema_param.lerp_(param, 1 - decay)
+    for buf, ema_buf in zip(model.buffers(), ema_model.buffers()):
+        ema_buf.copy_(buf)
+
+
+def model_state_dict(model):
+    """
+    Full state dict of `model`. For FSDP it is only materialised on rank 0
+    (other ranks get an empty dict), and keys get the "module." prefix of DDP.
+    """
+    if tensor_parallel.is_parallel(model):
+        return tensor_parallel.full_state_dict(model)
+    if not is_fsdp(model):
+        return model.state_dict()
+    config = FullStateDictConfig(offload_to_cpu=True, rank0_only=True)
+    with FSDP.state_dict_type(model, StateDictType.FULL_STATE_DICT, config):
+        state = model.state_dict()
+    return {f"module.{k}": v for k, v in state.items()}
+
+
+def load_model_state_dict(model, state):
+    if tensor_parallel.is_parallel(model):
+        tensor_parallel.load_full_state_dict(model, state)
+        return
+    if not is_fsdp(model):
+        model.load_state_dict(state)
+        return
+    state = {k[len("module."):] if k.startswith("module.") else k: v for k, v in state.items()}
+    config = FullStateDictConfig(rank0_only=False)
+    with FSDP.state_dict_type(model, StateDictType.FULL_STATE_DICT, config):
+        model.load_state_dict(state)
+
+
+def optimizer_state_dict(model, optimizer):
+    """
+    Full optimizer state dict, consolidated on rank 0 for ZeRO and FSDP
+    (other ranks get None or an empty dict).
+    """
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer.consolidate_state_dict(to=0)
+        return optimizer.state_dict() if dist_util.is_main_process() else None
+    if tensor_parallel.is_parallel(model):
+        return tensor_parallel.full_optimizer_state_dict(model, optimizer)
+    if is_fsdp(model):
+        with FSDP.state_dict_type(
+            model,
+            StateDictType.FULL_STATE_DICT,
+            FullStateDictConfig(offload_to_cpu=True, rank0_only=True),
+            FullOptimStateDictConfig(offload_to_cpu=True, rank0_only=True),
+        ):
+            return FSDP.optim_state_dict(model, optimizer)
+    return optimizer.state_dict()
+
+
+def load_optimizer_state_dict(model, optimizer, state):
+    """
+    Load a full optimizer state dict saved by optimizer_state_dict() in the
+    same --shard mode; every rank keeps only its own partition.
+    """
+    if tensor_parallel.is_parallel(model):
+        tensor_parallel.load_full_optimizer_state_dict(model, optimizer, state)
+        return
+    if is_fsdp(model):
+        with FSDP.state_dict_type(
+            model,
+            StateDictType.FULL_STATE_DICT,
+            FullStateDictConfig(rank0_only=False),
+            FullOptimStateDictConfig(rank0_only=False),
+        ):
+            state = FSDP.optim_state_dict_to_load(model, optimizer, state)
+    optimizer.load_state_dict(state)
@@ -1,45 +1,74 @@
-import numpy as np
 import torch
-import torch.nn.functional as F
 
+from .resample import ScheduleSampler
 from .respace import SpacedDiffusion
 
 
+class SpeedSampler(ScheduleSampler):
+    """
+    Asymmetric timestep sampling of SpeeDiffusion (https://arxiv.org/abs/2405.17403).
+
+    Timesteps after the "meaningful" ones, where sqrt(1 - alpha_bar) has
+    stopped changing, are sampled less often, and every sampled step comes
+    with its dual step across the boundary. The loss is P2-weighted
+    (https://arxiv.org/abs/2204.00227), so the objective changes: the weights
+    act on the MSE term inside training_losses rather than as importance
+    weights on the total loss.
+
+    Works with any GaussianDiffusion, including respaced ones. The sampling
+    distribution and the weights are kept on `device`.
+    """
+
+    loss_weights = "mse"
+
+    def __init__(self, diffusion, device="cpu", p2_k=None, p2_gamma=None):
+        self.diffusion = diffusion
+        sqrt_one_minus_alphas_bar = torch.as_tensor(diffusion.sqrt_one_minus_alphas_cumprod, dtype=torch.float64)
+        grad = torch.gradient(sqrt_one_minus_alphas_bar)[0]
+
+        # set the meaningful steps in diffusion, which is more important in inference
+        self.meaningful_steps = int(torch.argmax((grad < 1e-4).int())) + 1
+
+        # sample more meaningful step
+        p = torch.tanh(1e6 * (grad - 1e-4)) + 1.5
+        self._p = (p / p.sum()).to(device)
+
+        # p2 weighting from: Perception Prioritized Training of Diffusion Models
+        p2_k = getattr(diffusion, "p2_k", 1) if p2_k is None else p2_k
+        p2_gamma = getattr(diffusion, "p2_gamma", 1) if p2_gamma is None else p2_gamma
+        snr = 1.0 / (1 - torch.as_tensor(diffusion.alphas_cumprod, dtype=torch.float64)) - 1
+        self._weights = (1 / (p2_k + snr) ** p2_gamma).float().to(device)
+
+    def weights(self):
+        return self._p
+
+    def sample(self, batch_size, device):
+        """
+        Draw half of the batch from the asymmetric distribution and complete
+        it with the dual steps.
+
+        :return: a tuple (timesteps, weights), where the weights are the P2
+                 weights of the timesteps, to scale the MSE term.
+        """
+        t = torch.multinomial(self._p, batch_size // 2 + 1, replacement=True)
+        dual_t = torch.where(t < self.meaningful_steps, self.meaningful_steps - t, t - self.meaningful_steps)
+        t = torch.cat([t, dual_t], dim=0)[:batch_size]
+        return t.to(device), self._weights[t].to(device)
+
+
 class SpeeDiffusion(SpacedDiffusion):
     def __init__(self, faster, **kwargs):
         super().__init__(**kwargs)
         self.faster = faster
         if faster:
-            grad = np.gradient(self.sqrt_one_minus_alphas_cumprod)
-
-            # set the meaningful steps in diffusion, which is more important in inference
-            self.meaningful_steps = np.argmax(grad < 1e-4) + 1
-
-            # p2 weighting from: Perception Prioritized Training of Diffusion Models
-            self.p2_gamma = 1
-            self.p2_k = 1
-            self.snr = 1.0 / (1 - self.alphas_cumprod) - 1
-            sqrt_one_minus_alphas_bar = torch.from_numpy(self.sqrt_one_minus_alphas_cumprod)
-            # sample more meaningful step
-            p = torch.tanh(1e6 * (torch.gradient(sqrt_one_minus_alphas_bar)[0] - 1e-4)) + 1.5
-            self.p = F.normalize(p, p=1, dim=0)
-            self.weights = self._weights()
+            self.sampler = SpeedSampler(self, p2_k=1, p2_gamma=1)
+            self.meaningful_steps = self.sampler.meaningful_steps
         else:
             self.meaningful_steps = self.num_timesteps
 
-    def _weights(self):
-        # process where all noise to noisy image with content has more weighting in training
-        # the weights act on the mse loss
-        weights = 1 / (self.p2_k + self.snr) ** self.p2_gamma
-        weights = weights
-        return weights
-
     def t_sample(self, n, device):
         if self.faster:
-            t = torch.multinomial(self.p, n // 2 + 1, replacement=True).to(device)
-            dual_t = torch.where(t < self.meaningful_steps, self.meaningful_steps - t, t - self.meaningful_steps)
-            t = torch.cat([t, dual_t], dim=0)[:n]
-            weights = self.weights
+            t, weights = self.sampler.sample(n, device)
         else:
             t = torch.randint(0, self.num_timesteps, (n,), device=device)
             weights = None
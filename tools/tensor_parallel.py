@@ -0,0 +1,332 @@
+"""
+Tensor parallelism of the DiT and U-ViT blocks (--tensor_parallel k).
+
+The ranks are split into groups of k consecutive ranks, and within a group
+the linears of every transformer block are sharded as in Megatron-LM
+(Shoeybi et al., 2019, https://arxiv.org/abs/1909.08053):
+
+  attn.qkv, mlp.fc1       column-parallel: each rank computes its own heads
+                          or hidden units from the full input.
+  attn.proj, mlp.fc2      row-parallel: each rank multiplies its slice of the
+                          input and the partial outputs are all-reduced.
+  adaLN_modulation (DiT)  column-parallel within each of its six shift /
+                          scale / gate chunks, then all-gathered, since every
+                          rank modulates the full hidden state.
+
+Everything else is replicated. The activations between sub-layers are equal
+on all ranks of a group, so replicated parameters get equal gradients. The
+block parameters and the attention / MLP inner activations shrink by k.
+
+The ranks of a group must see the same inputs, so they share a data shard
+and a seed. Data parallelism runs across groups: data_parallel_group() holds
+the ranks at the same position in every group, and DDP is wrapped over it.
+
+Checkpoints hold the full, unsharded tensors under the usual keys, so they
+load with any --tensor_parallel. Converting between the two is a collective.
+
+Run `python -m checks.tensor_parallel` for a 4-process check (2 groups of 2)
+with gloo on CPU.
+"""
+
+import torch as th
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+
+_TP_GROUP = None
+_DP_GROUP = None
+# Set by local_only()
+_LOCAL = False
+
+
+def initialize(size):
+    """
+    Split the ranks into tensor-parallel groups of `size` consecutive ranks
+    and the data-parallel groups across them. Call on every rank.
+    """
+    global _TP_GROUP, _DP_GROUP
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    assert world_size % size == 0, f"--tensor_parallel {size} must divide the number of ranks {world_size}"
+    # new_group must be called by every rank for every group
+    for start in range(0, world_size, size):
+        group = dist.new_group(list(range(start, start + size)))
+        if start <= rank < start + size:
+            _TP_GROUP = group
+    for offset in range(size):
+        group = dist.new_group(list(range(offset, world_size, size)))
+        if rank % size == offset:
+            _DP_GROUP = group
+
+
+def is_initialized():
+    return _TP_GROUP is not None
+
+
+def tensor_parallel_group():
+    return _TP_GROUP
+
+
+def tensor_parallel_size():
+    return dist.get_world_size(_TP_GROUP) if _TP_GROUP is not None else 1
+
+
+def tensor_parallel_rank():
+    return dist.get_rank(_TP_GROUP) if _TP_GROUP is not None else 0
+
+
+def data_parallel_group():
+    """The data-parallel group, or None (the default group) without tensor parallelism."""
+    return _DP_GROUP
+
+
+def data_parallel_size():
+    if _DP_GROUP is not None:
+        return dist.get_world_size(_DP_GROUP)
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def data_parallel_rank():
+    if _DP_GROUP is not None:
+        return dist.get_rank(_DP_GROUP)
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+class local_only:
+    """
+    Context manager that runs sharded models without communication: the
+    all-reduces are skipped and the all-gathers repeat the local slice. The
+    outputs are wrong, but shapes and memory are those of the real run, so a
+    single rank can probe memory without its group (see tools/autotune.py).
+    """
+
+    def __enter__(self):
+        global _LOCAL
+        self.previous, _LOCAL = _LOCAL, True
+
+    def __exit__(self, *exc):
+        global _LOCAL
+        _LOCAL = self.previous
+
+
+class _CopyToGroup(th.autograd.Function):
+    """Identity; the gradient is all-reduced, each rank holding a part of it."""
+
+    @staticmethod
+    def forward(ctx, x):
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous()
+        if not _LOCAL:
+            dist.all_reduce(grad, group=_TP_GROUP)
+        return grad
+
+
+class _ReduceFromGroup(th.autograd.Function):
+    """All-reduce of the partial outputs; the gradient passes through."""
+
+    @staticmethod
+    def forward(ctx, x):
+        x = x.contiguous().clone()
+        if not _LOCAL:
+            dist.all_reduce(x, group=_TP_GROUP)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad
+
+
+class _GatherFromGroup(th.autograd.Function):
+    """All-gather along the last dimension; each rank keeps its slice of the gradient."""
+
+    @staticmethod
+    def forward(ctx, x):
+        ctx.width = x.shape[-1]
+        if _LOCAL:
+            return th.cat([x] * tensor_parallel_size(), dim=-1)
+        parts = [th.empty_like(x) for _ in range(tensor_parallel_size())]
+        dist.all_gather(parts, x.contiguous(), group=_TP_GROUP)
+        return th.cat(parts, dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad.narrow(-1, tensor_parallel_rank() * ctx.width, ctx.width).contiguous()
+
+
+class ParallelLinear(nn.Module):
+    """
+    This rank's shard of an nn.Linear.
+
+    :param dim: 0 splits the output features (column-parallel), 1 the input
+                features (row-parallel, whose bias is replicated).
+    :param shards: a [k x n] tensor of the feature indices of every rank of
+                   the tensor-parallel group along `dim`.
+    :param gather_output: column-parallel only, all-gather the outputs of
+                          every rank in the original feature order.
+    """
+
+    def __init__(self, linear, dim, shards, gather_output=False):
+        super().__init__()
+        assert dim == 0 or not gather_output
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        self.dim, self.gather_output = dim, gather_output
+        self.register_buffer("shards", shards, persistent=False)
+        index = shards[tensor_parallel_rank()].to(linear.weight.device)
+        self.weight = nn.Parameter(linear.weight.detach().index_select(dim, index).clone())
+        if linear.bias is None:
+            self.register_parameter("bias", None)
+        elif dim == 0:
+            self.bias = nn.Parameter(linear.bias.detach().index_select(0, index).clone())
+        else:
+            self.bias = nn.Parameter(linear.bias.detach().clone())
+        if gather_output:
+            self.register_buffer("order", shards.flatten().argsort(), persistent=False)
+
+    def forward(self, x):
+        if self.dim == 0:
+            x = F.linear(_CopyToGroup.apply(x), self.weight, self.bias)
+            if self.gather_output:
+                x = _GatherFromGroup.apply(x)[..., self.order]
+            return x
+        x = _ReduceFromGroup.apply(F.linear(x, self.weight))
+        return x + self.bias if self.bias is not None else x
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, dim={self.dim}"
+
+
+def _contiguous(n, size):
+    assert n % size == 0, f"{n} features don't split across {size} ranks"
+    return th.arange(n).view(size, n // size)
+
+
+def _chunked(n, chunks, size):
+    # The same slice of each of `chunks` equal chunks, e.g. q/k/v or shift/scale/gate
+    return th.cat([c * (n // chunks) + _contiguous(n // chunks, size) for c in range(chunks)], dim=1)
+
+
+def parallelize(model):
+    """
+    Shard the blocks of a DiT or U-ViT across the tensor-parallel group, in
+    place. Every rank of the group must start from the same weights.
+    """
+    from models.dit import DiTBlock
+    from models.uvit import Block as UViTBlock
+
+    size = tensor_parallel_size()
+    for block in model.checkpoint_blocks():
+        assert isinstance(block, (DiTBlock, UViTBlock)), "--tensor_parallel needs a DiT or U-ViT model"
+        attn, mlp = block.attn, block.mlp
+        assert attn.num_heads % size == 0, f"{attn.num_heads} heads don't split across {size} ranks"
+        dim = attn.proj.in_features
+        # Each rank computes whole heads: its slice of q, k and v, then of proj's input
+        attn.qkv = ParallelLinear(attn.qkv, 0, _chunked(3 * dim, 3, size))
+        attn.proj = ParallelLinear(attn.proj, 1, _contiguous(dim, size))
+        attn.num_heads //= size
+        mlp.fc1 = ParallelLinear(mlp.fc1, 0, _contiguous(mlp.fc1.out_features, size))
+        mlp.fc2 = ParallelLinear(mlp.fc2, 1, _contiguous(mlp.fc2.in_features, size))
+        if isinstance(block, DiTBlock):
+            linear = block.adaLN_modulation[-1]
+            block.adaLN_modulation[-1] = ParallelLinear(
+                linear, 0, _chunked(linear.out_features, 6, size), gather_output=True)
+    return model
+
+
+def is_parallel(model):
+    return any(isinstance(m, ParallelLinear) for m in model.modules())
+
+
+def _sharded_params(model):
+    """(state dict key, parameter, dim, shards) of every sharded parameter."""
+    for name, module in model.named_modules():
+        if isinstance(module, ParallelLinear):
+            prefix = f"{name}." if name else ""
+            yield prefix + "weight", module.weight, module.dim, module.shards
+            if module.bias is not None and module.dim == 0:
+                yield prefix + "bias", module.bias, 0, module.shards
+
+
+def _gather(tensor, dim, shards):
+    parts = [th.empty_like(tensor) for _ in range(tensor_parallel_size())]
+    dist.all_gather(parts, tensor.contiguous(), group=_TP_GROUP)
+    shape = list(tensor.shape)
+    shape[dim] = shards.numel()
+    full = tensor.new_empty(shape)
+    return full.index_copy_(dim, shards.flatten().to(tensor.device), th.cat(parts, dim=dim))
+
+
+def _shard(tensor, dim, shards):
+    return tensor.index_select(dim, shards[tensor_parallel_rank()].to(tensor.device))
+
+
+def full_state_dict(model):
+    """
+    state_dict() with every shard gathered into its full tensor, as the
+    unsharded model would have it. Call on every rank of the group.
+    """
+    state = model.state_dict()
+    for name, param, dim, shards in _sharded_params(model):
+        state[name] = _gather(param.detach(), dim, shards)
+    return state
+
+
+def load_full_state_dict(model, state):
+    state = dict(state)
+    for name, _, dim, shards in _sharded_params(model):
+        state[name] = _shard(state[name], dim, shards)
+    model.load_state_dict(state)
+
+
+def _optimizer_params(model, optimizer):
+    # optimizer.state_dict() numbers the parameters in param_groups order
+    specs = {id(param): (dim, shards) for _, param, dim, shards in _sharded_params(model)}
+    params = [p for group in optimizer.param_groups for p in group["params"]]
+    return [(p, specs.get(id(p))) for p in params]
+
+
+def _map_optimizer_state(model, optimizer, state, fn):
+    params = _optimizer_params(model, optimizer)
+    mapped = {}
+    for index, param_state in state["state"].items():
+        param, spec = params[index]
+        if spec is not None:
+            # Per-element state (e.g. Adam's moments), not scalars like the step
+            param_state = {k: fn(v, *spec) if th.is_tensor(v) and v.dim() == param.dim() else v
+                           for k, v in param_state.items()}
+        mapped[index] = param_state
+    return {**state, "state": mapped}
+
+
+def full_optimizer_state_dict(model, optimizer):
+    """Optimizer state dict with the state of sharded parameters gathered. Call on every rank of the group."""
+    return _map_optimizer_state(model, optimizer, optimizer.state_dict(), _gather)
+
+
+def load_full_optimizer_state_dict(model, optimizer, state):
+    optimizer.load_state_dict(_map_optimizer_state(model, optimizer, state, _shard))
+
+
+def clip_grad_norm_(model, max_norm):
+    """
+    Clip by the norm of the full gradient: the squared norms of the shards
+    are summed over the group, replicated gradients count once.
+    """
+    sharded = {id(param) for _, param, _, _ in _sharded_params(model)}
+    params = [p for p in model.parameters() if p.grad is not None]
+    device = params[0].grad.device
+    sharded_sq = th.zeros((), device=device)
+    replicated_sq = th.zeros((), device=device)
+    for p in params:
+        sq = p.grad.detach().float().square().sum()
+        if id(p) in sharded:
+            sharded_sq += sq
+        else:
+            replicated_sq += sq
+    dist.all_reduce(sharded_sq, group=_TP_GROUP)
+    total_norm = (sharded_sq + replicated_sq).sqrt()
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for p in params:
+        p.grad.detach().mul_(clip_coef.to(p.grad.dtype))
+    return total_norm
@@ -0,0 +1,151 @@
+"""
+Lightweight per-phase timing of training steps.
+
+Phases are timed with CUDA events on GPU, so that timing does not force a
+synchronisation, and with the wall clock on CPU. Nested phases are
+exclusive: the time of a phase excludes the phases opened inside it (e.g.
+"loss" excludes the model's "forward"). Events are only resolved when a
+summary is requested, once per logging interval.
+"""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+
+from tools import logger
+
+
+class PhaseTimer:
+    """
+    :param device: the training device; CUDA devices are timed with events.
+    :param enabled: if False, all methods are no-ops.
+    """
+
+    def __init__(self, device, enabled=True):
+        self.enabled = enabled
+        self.use_cuda = enabled and torch.device(device).type == "cuda"
+        self._records = []  # [name, start, end, parent] of the open step
+        self._stack = []    # indices of the open nested phases
+        self._steps = []    # records of the closed steps
+
+    def start(self, name, host=False, nested=True):
+        """
+        Open a phase and return its index for stop(). Host phases (e.g.
+        waiting for the data loader) always use the wall clock. Phases that
+        are not nested, such as asynchronous all-reduces, neither have a
+        parent nor become one.
+        """
+        if not self.enabled:
+            return None
+        if self.use_cuda and not host:
+            start = torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            start = time.perf_counter()
+        parent = self._stack[-1] if nested and self._stack else None
+        self._records.append([name, start, None, parent])
+        index = len(self._records) - 1
+        if nested:
+            self._stack.append(index)
+        return index
+
+    def stop(self, index):
+        if index is None:
+            return
+        record = self._records[index]
+        if isinstance(record[1], float):
+            record[2] = time.perf_counter()
+        else:
+            record[2] = torch.cuda.Event(enable_timing=True)
+            record[2].record()
+        if self._stack and self._stack[-1] == index:
+            self._stack.pop()
+
+    @contextmanager
+    def phase(self, name, host=False):
+        index = self.start(name, host=host)
+        try:
+            yield
+        finally:
+            self.stop(index)
+
+    def time_module(self, module, name="forward"):
+        """Time every forward call of `module` as phase `name`."""
+        if not self.enabled:
+            return
+        module.register_forward_pre_hook(lambda m, args: setattr(m, "_phase_index", self.start(name)))
+        module.register_forward_hook(lambda m, args, out: self.stop(m._phase_index))
+
+    def step(self):
+        """Close the current training step."""
+        if not self.enabled:
+            return
+        self._steps.append(self._records)
+        self._records, self._stack = [], []
+
+    def summary(self):
+        """
+        Per phase, the p50/p90/p99 and mean of its total time per step in ms,
+        over the steps closed since the last summary in which it ran.
+        """
+        if not self._steps:
+            return {}
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        per_step = []
+        for records in self._steps:
+            durations = [_elapsed_ms(start, end) for _, start, end, _ in records]
+            exclusive = list(durations)
+            for (_, _, _, parent), duration in zip(records, durations):
+                if parent is not None:
+                    exclusive[parent] -= duration
+            totals = defaultdict(float)
+            for (name, _, _, _), duration in zip(records, exclusive):
+                totals[name] += duration
+            per_step.append(totals)
+        self._steps = []
+
+        stats = {}
+        for name in sorted({name for totals in per_step for name in totals}):
+            values = np.array([totals[name] for totals in per_step if name in totals])
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stats[name] = dict(p50=p50, p90=p90, p99=p99, mean=values.mean())
+        return stats
+
+    def log(self, prefix="time/"):
+        """Send summary() to the logger's KV writers."""
+        for name, stats in self.summary().items():
+            for stat, value in stats.items():
+                logger.logkv(f"{prefix}{name}_{stat}_ms", value)
+
+
+def _elapsed_ms(start, end):
+    if end is None:
+        return 0.0
+    if isinstance(start, float):
+        return (end - start) * 1000
+    return start.elapsed_time(end)
+
+
+def timed_comm_hook(timer, hook=allreduce_hook):
+    """
+    Wrap a DDP communication hook so that each bucket's communication is
+    timed as phase "allreduce", from launch to completion. The phase overlaps
+    with "backward" and is reported separately. The state registered with
+    the hook (its process group, see tools/comm_hooks.py) is passed on.
+    """
+
+    def timed_hook(state, bucket):
+        index = timer.start("allreduce", nested=False)
+
+        def done(fut):
+            timer.stop(index)
+            return fut.value()
+
+        return hook(state, bucket).then(done)
+
+    return timed_hook
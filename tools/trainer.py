@@ -1,8 +1,11 @@
 import torch
 import torch.nn as nn
 from torch.cuda.amp import autocast, GradScaler
-from tools import dist_util, logger
-# from .resample import LossAwareSampler, UniformSampler, create_named_schedule_sampler
+from torch.nn.parallel import DistributedDataParallel as DDP
+from tools import dist_util, logger, compile_util, sharding, batch_sampling, masking, comm_hooks, tensor_parallel
+from tools.timer import PhaseTimer
+from tools.resample import LossAwareSampler, create_named_schedule_sampler
+from tools.utils import preserve_rng_state
 import csv
 import os
 import torch.distributed as dist
@@ -24,41 +27,175 @@ class Trainer:
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.diffusion = diffusion
+        # None when another trainer feeds the batches (see tools/multi_trainer.py)
         self.train_loader = train_loader
-        self.datalooper = iter(train_loader)
-        # self.schedule_sampler = create_named_schedule_sampler(args.sampler_type, diffusion)
-        self.scaler = GradScaler() if args.amp else None
+        self._data_state = None
+        # Created at the first fetch, after train_step has set the sampler epoch
+        self.datalooper = None
+        # Timestep sampler of the diffusion loss (see --timestep_sampler); None
+        # leaves uniform sampling to training_losses.
+        self.schedule_sampler = None
+        if args.timestep_sampler != 'uniform':
+            kwargs = {}
+            if args.model_mode == 'flow':
+                kwargs = dict(location=args.logit_location, scale=args.logit_scale,
+                              mode_scale=args.mode_scale, bins=args.adaptive_bins)
+            self.schedule_sampler = create_named_schedule_sampler(args.timestep_sampler, diffusion, device, **kwargs)
+        self.scaler = sharding.grad_scaler(model) if args.amp else None
         self.start_step = start_step        
         self.pbar = pbar
+        self.ema_step = 0
+        # Per-phase step timing (see --timing); the compiled forward can't be hooked
+        self.timer = PhaseTimer(device, enabled=args.timing)
+        if args.timing and not args.compile:
+            self.timer.time_module(model, "forward")
+        # Gradient compression of DDP's all-reduce (see --ddp_comm_hook). DDP
+        # takes a single hook, so the timed one wraps it.
+        self.comm_state = None
+        if isinstance(model, DDP):
+            self.comm_state = comm_hooks.register_comm_hook(model, args, self.timer if args.timing else None)
+        elif sharding.is_fsdp(model):
+            assert args.ddp_comm_hook == 'none', "--ddp_comm_hook applies to DDP, not --shard fsdp"
+        # Forward + loss, optionally compiled as one region (see --compile)
+        # Stratified timesteps and antithetic noise (see --stratify_timesteps)
+        self.batch_constructor = batch_sampling.BatchConstructor(
+            getattr(diffusion, 'num_timesteps', None), stratify=args.stratify_timesteps,
+            antithetic=args.antithetic_noise, repeats=args.noise_repeats if args.stratified_repeats else 1)
+        # A timestep sampler draws its own t, which would replace the strata
+        stratified = args.stratify_timesteps != 'none' or (args.noise_repeats > 1 and args.stratified_repeats)
+        assert args.timestep_sampler == 'uniform' or not stratified, \
+            "--timestep_sampler draws its own timesteps: use it with --stratify_timesteps none, and --stratified_repeats False with --noise_repeats"
+        # Masked-token training of DiT/ViT (see --mask_ratio)
+        assert args.mask_ratio == 0 or args.model.startswith(("DiT", "ViT")), "--mask_ratio needs a DiT or ViT model"
+        self.training_losses = compile_util.compile_fn(self._training_losses, args)
+        self._explain_pending = args.compile and args.compile_explain
+
+    def _training_losses(self, images, t, model_kwargs, noise=None, mse_weights=None, loss_mask=None):
+        return self.diffusion.training_losses(self.model, images, t=t, model_kwargs=model_kwargs,
+                                              noise=noise, mse_weights=mse_weights,
+                                              loss_mask=loss_mask, recon_weight=self.args.mask_recon_weight)
+
+    def _new_iterator(self):
+        # The shuffle order (and the worker seeds) are drawn from the torch RNG
+        # when the iterator starts, so its state then, the sampler epoch and
+        # the number of batches consumed pin down the data position. Samplers
+        # may only read their epoch at the first next(), so the iterator is
+        # only created right before it.
+        self._data_state = {
+            'rng': torch.get_rng_state(),
+            'epoch': getattr(self.train_loader.sampler, 'epoch', None),
+            'batches': 0,
+        }
+        return iter(self.train_loader)
 
     def _get_next_batch(self):
-        try:
-            images, labels = next(self.datalooper)
-        except StopIteration:
-            self.datalooper = iter(self.train_loader)
-            images, labels = next(self.datalooper)
-        return images.to(self.device), labels.to(self.device) if self.args.class_cond else None
+        with self.timer.phase("data", host=True):
+            try:
+                if self.datalooper is None:
+                    self.datalooper = self._new_iterator()
+                images, labels = next(self.datalooper)
+            except StopIteration:
+                self.datalooper = self._new_iterator()
+                images, labels = next(self.datalooper)
+        self._data_state['batches'] += 1
+        with self.timer.phase("h2d"):
+            return images.to(self.device), labels.to(self.device) if self.args.class_cond else None
             
-    def _compute_loss(self, images, labels, step):
+    def prepare_batch(self, images, labels):
+        # Copies of an image get their own latent sample, noise and timestep
+        images, labels = batch_sampling.repeat_batch(images, labels, self.args.noise_repeats)
+        if self.args.in_chans == 4:
+            images = self._sample_from_latent(images, self.args.latent_scale)
+        return images, labels
+
+    def _compute_loss(self, images, labels, step, draws=None):
         model_kwargs = {"y": labels} if self.args.class_cond else {}
-        t= None
-        # t, weights = self.schedule_sampler.sample(images.shape[0], device=self.device)
-        # t = torch.full((images.shape[0],), step % 1000, device=images.device)
+        t, noise = self.batch_constructor(images) if draws is None else draws
+        weights, mse_weights = None, None
+        if self.schedule_sampler is not None:
+            t, weights = self.schedule_sampler.sample(images.shape[0], device=self.device)
+            if self.schedule_sampler.loss_weights == "mse":
+                weights, mse_weights = None, weights
 
-        loss_dict = self.diffusion.training_losses(self.model, images, t=t, model_kwargs=model_kwargs)
+        loss_mask = None
+        if self.args.mask_ratio > 0:
+            p = self.args.patch_size
+            num_tokens = (images.shape[2] // p) * (images.shape[3] // p)
+            token_mask = masking.random_token_mask(images.shape[0], num_tokens, self.args.mask_ratio, self.device)
+            model_kwargs["token_mask"] = token_mask
+            loss_mask = masking.visible_pixels(token_mask, p)
 
-        # # Update sampler with local losses if using LossAwareSampler
-        # if isinstance(self.schedule_sampler, LossAwareSampler):
-        #     self.schedule_sampler.update_with_local_losses(t, loss_dict["loss"].detach())
-            
+        if self._explain_pending:
+            # An extra forward: it must not draw from the RNGs of the real step
+            with preserve_rng_state():
+                compile_util.report_graph_breaks(self._training_losses, images, t, model_kwargs, noise, mse_weights, loss_mask)
+            self._explain_pending = False
+
+        loss_dict = self.training_losses(images, t, model_kwargs, noise, mse_weights, loss_mask)
+
+        # Update sampler with local losses if using LossAwareSampler
+        if isinstance(self.schedule_sampler, LossAwareSampler):
+            self.schedule_sampler.update_with_local_losses(t, loss_dict["loss"].detach())
+
+        if weights is not None:
+            # Importance weights keep the loss an unbiased estimate
+            return (loss_dict["loss"] * weights).mean()
         return (loss_dict["loss"]).mean()
 
     def _apply_gradient_clipping(self):
         if self.args.grad_clip:
-            nn.utils.clip_grad_norm_(self.model.parameters(), self.args.grad_clip)
+            sharding.clip_grad_norm_(self.model, self.args.grad_clip)
+
+    def _data_state_dict(self):
+        # Every rank's DataLoader draws its own worker seeds, so the iterator's
+        # RNG state is stored per rank, like the training RNG. Collective.
+        if self._data_state is None:
+            return None
+        rngs = [self._data_state['rng']]
+        if dist.is_initialized():
+            rngs = [None] * dist.get_world_size()
+            dist.all_gather_object(rngs, self._data_state['rng'])
+        return dict(self._data_state, rng=rngs)
+
+    def state_dict(self):
+        return {
+            'scaler': self.scaler.state_dict() if self.scaler is not None else None,
+            'ema_step': self.ema_step,
+            'data': self._data_state_dict(),
+            'schedule_sampler': self.schedule_sampler.state_dict() if self.schedule_sampler is not None else None,
+        }
+
+    def load_state_dict(self, state):
+        if self.scaler is not None and state['scaler'] is not None:
+            self.scaler.load_state_dict(state['scaler'])
+        self.ema_step = state['ema_step']
+        if self.schedule_sampler is not None and state.get('schedule_sampler') is not None:
+            self.schedule_sampler.load_state_dict(state['schedule_sampler'])
+        # Replay the data iterator up to the saved position. This fetches the
+        # skipped batches, so that augmentations in the workers line up too.
+        data = state['data']
+        if data is None or self.train_loader is None:
+            return
+        if data['epoch'] is not None:
+            self.train_loader.sampler.set_epoch(data['epoch'])
+        # Older checkpoints hold rank 0's state only
+        rngs = data['rng'] if isinstance(data['rng'], list) else [data['rng']]
+        rank = dist.get_rank() if dist.is_initialized() else 0
+        world_size = dist.get_world_size() if dist.is_initialized() else 1
+        if len(rngs) != world_size and dist_util.is_main_process():
+            print(f"Checkpoint has data RNG states of {len(rngs)} ranks, running on {world_size}: using rank 0's")
+        torch.set_rng_state(rngs[rank if len(rngs) == world_size else 0].cpu())
+        self.datalooper = self._new_iterator()
+        for _ in range(data['batches']):
+            next(self.datalooper)
+        self._data_state['batches'] = data['batches']
 
     def _update_ema(self):
-        if dist_util.is_main_process():
+        self.ema_step += 1
+        if sharding.is_fsdp(self.model) or tensor_parallel.is_parallel(self.model):
+            # Every rank updates its own shard of the EMA
+            sharding.update_ema_shards(self.model, self.ema_model, self.args.ema_decay)
+        elif dist_util.is_main_process():
             ema(self.model, self.ema_model, self.args.ema_decay)
                    
     def _sample_from_latent(self, latent, latent_scale=1.):
@@ -67,33 +204,44 @@ class Trainer:
         latent_samples = latent_samples * latent_scale 
         return latent_samples 
 
-    def train_step(self, step):
+    def train_step(self, step, batches=None):
+        """
+        One optimizer step over --grad_accumulation batches. `batches`, if
+        given, replaces the loader with a list of prepared (images, labels,
+        draws) tuples, one per accumulation step, where draws is None or the
+        (t, noise) of the batch.
+        """
         self.model.train()
-        if self.args.parallel:
+        if self.args.parallel and self.train_loader is not None:
             self.train_loader.sampler.set_epoch(step)
         
         grad_accumulation = max(1, self.args.grad_accumulation)  # Ensure cumulative steps are least 1
         loss_accumulated = 0.0
 
         for accumulation_step in range(grad_accumulation):
-            images, labels = self._get_next_batch()
-            
-            if self.args.in_chans == 4:
-                images = self._sample_from_latent(images, self.args.latent_scale)  
+            if batches is None:
+                images, labels = self.prepare_batch(*self._get_next_batch())
+                draws = None
+            else:
+                images, labels, draws = batches[accumulation_step]
                 
             if self.args.amp:
-                with autocast():
+                with autocast(), self.timer.phase("loss"):
                 # with autocast(dtype=torch.bfloat16):
-                    loss = self._compute_loss(images, labels, step) / grad_accumulation  # Scale loss for accumulation
-                self.scaler.scale(loss).backward()
+                    loss = self._compute_loss(images, labels, step, draws) / grad_accumulation  # Scale loss for accumulation
+                with self.timer.phase("backward"):
+                    self.scaler.scale(loss).backward()
             else:
-                loss = self._compute_loss(images, labels, step) / grad_accumulation  # Scale loss for accumulation
-                loss.backward()
+                with self.timer.phase("loss"):
+                    loss = self._compute_loss(images, labels, step, draws) / grad_accumulation  # Scale loss for accumulation
+                with self.timer.phase("backward"):
+                    loss.backward()
                 
             loss_accumulated += loss.item()
 
             # Perform optimization step only after grad_accumulation steps
             if (accumulation_step + 1) % grad_accumulation == 0:
+                optimizer_phase = self.timer.start("optimizer")
                 if self.args.amp:
                     if self.args.grad_clip:
                         self.scaler.unscale_(self.optimizer)
@@ -106,13 +254,27 @@ class Trainer:
                     
                     self.optimizer.step()
                 self.optimizer.zero_grad()
+                self.timer.stop(optimizer_phase)
         
         # Update scheduler
         self.scheduler.step()
         
-        if dist_util.is_main_process():
+        with self.timer.phase("ema"):
             self._update_ema()
+        if dist_util.is_main_process() and self.pbar is not None:
             self.pbar.update(1)
             self.pbar.set_postfix(loss=loss_accumulated)
 
         return loss_accumulated  # Return scalar accumulated loss 
+
+    def log_step(self, step, loss):
+        """
+        Close the step's timers and, every --log_interval steps, write the
+        loss and the phase time percentiles through the logger.
+        """
+        self.timer.step()
+        logger.logkv_mean("loss", loss)
+        if step % self.args.log_interval == 0:
+            logger.logkv("step", step)
+            self.timer.log()
+            logger.dumpkvs()
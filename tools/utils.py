@@ -8,7 +8,8 @@ import torch
 import numpy as np
 import torch.distributed as dist
 from torchvision.utils import make_grid, save_image
-from tools import dist_util
+from tools import dist_util, sharding, tensor_parallel, comm_hooks
+from tools.checkpoint_io import CheckpointWriter, latest_checkpoint
 from tools.sampler import Sampler, Classifier
 
 
@@ -24,7 +25,8 @@ def str2bool(v):
 
 
 def set_random_seed(args, seed):
-    rank = dist.get_rank() if args.parallel else 0
+    # The ranks of a tensor-parallel group draw the same timesteps and noise
+    rank = tensor_parallel.data_parallel_rank() if args.parallel else 0
     seed = seed + rank
     random.seed(seed)
     np.random.seed(seed)
@@ -36,6 +38,47 @@ def set_random_seed(args, seed):
     torch.backends.cudnn.benchmark = False
     
     
+def get_rng_state():
+    """RNG states of python, numpy, torch and CUDA of this process."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    # Loaded checkpoints may have put the states on the GPU
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def gather_rng_states():
+    """RNG states of all ranks, indexed by rank. Collective when distributed."""
+    state = get_rng_state()
+    if not dist.is_initialized():
+        return [state]
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, state)
+    return states
+
+
+class preserve_rng_state:
+    """Context manager that restores all RNG states on exit."""
+
+    def __enter__(self):
+        self.state = get_rng_state()
+
+    def __exit__(self, *exc):
+        set_rng_state(self.state)
+
+
 def get_lr_lambda(args):
     return lambda step: warmup_cosine_lr(
         step, args.warmup_steps, args.total_steps,
@@ -54,42 +97,142 @@ def warmup_cosine_lr(step, warmup_steps, total_steps, lr, final_lr, cosine_decay
             return 1
         
         
-def save_checkpoint(args, step, model, optimizer, ema_model=None):
+# Arguments that define the network and the diffusion process. They are stored
+# with every checkpoint so that exported weights can be rebuilt without the CLI.
+# Sampling-only settings (--sampler_type, --atol, --rtol, --vae) are not: they
+# stay sample-time flags.
+MODEL_CONFIG_KEYS = (
+    'model', 'image_size', 'patch_size', 'in_chans', 'num_classes', 'class_cond',
+    'learn_sigma', 'dropout', 'drop_label_prob', 'mask_decoder_depth',
+)
+DIFFUSION_CONFIG_KEYS = (
+    'model_mode', 'beta_schedule', 'p', 'diffusion_steps', 'mean_type', 'var_type',
+    'loss_type', 'weight_type', 'gamma', 'p2_gamma', 'p2_k', 'path_type', 'latent_scale',
+)
+
+
+def model_config(args):
+    return {k: getattr(args, k) for k in MODEL_CONFIG_KEYS + DIFFUSION_CONFIG_KEYS if hasattr(args, k)}
+
+
+def strip_prefix(state_dict, prefix='module.'):
+    """Remove the key prefix added by wrappers such as DDP."""
+    return {k[len(prefix):] if k.startswith(prefix) else k: v for k, v in state_dict.items()}
+
+
+def load_inference_checkpoint(path, build_model, device):
+    """
+    Rebuild the model of an exported weights file (see export.py) from its
+    stored config alone. Returns the model in eval mode and the config.
+    """
+    checkpoint = dist_util.load_state_dict(path, keys=['config', 'ema_model'], device=device)
+    config = checkpoint['config']
+    model = build_model(argparse.Namespace(**config)).to(device)
+    # Weights may be stored in bf16; load_state_dict casts them back.
+    model.load_state_dict(checkpoint['ema_model'])
+    return model.eval(), config
+
+
+def checkpoint_dir(args):
+    # Experiments co-trained with --experiments keep their own directory
+    experiment = getattr(args, 'experiment', None)
+    return os.path.join('checkpoint', args.dataset, args.model, *([experiment] if experiment else []))
+
+
+def checkpoint_prefix(args):
+    prefix = f"{args.mean_type}_{args.weight_type}_{args.beta_schedule}"
+    if args.beta_schedule == "power":
+        prefix += f"_{args.p}"
+    return prefix
+
+
+def build_checkpoint_writer(args):
+    """Checkpoint writer of rank 0; other ranks don't write and get None."""
+    if not dist_util.is_main_process():
+        return None
+    return CheckpointWriter(checkpoint_dir(args), keep_last=args.keep_last,
+                            milestone_step=args.milestone_step, async_save=args.async_save)
+
+
+def resolve_resume(args):
+    """Turn `--resume auto` into the latest checkpoint of this run, or None."""
+    if args.resume != 'auto':
+        return args.resume
+    path = latest_checkpoint(checkpoint_dir(args), checkpoint_prefix(args))
     if dist_util.is_main_process():
-        checkpoint_dir = os.path.join('checkpoint', args.dataset, args.model)
-        os.makedirs(checkpoint_dir, exist_ok=True)
-        state = {
-            'model': model.state_dict(),
-            'optimizer': optimizer.state_dict(),
-            'step': step
-        }
-        if ema_model is not None:
-            state['ema_model'] = ema_model.state_dict()
-        filename = f"{args.mean_type}_{args.weight_type}_{args.beta_schedule}"
-        
-        if args.beta_schedule == "power":
-            filename += f"_{args.p}"
-            
-        filename += f"_{step}.pth"
-        filename = os.path.join(checkpoint_dir, filename)
-        torch.save(state, filename)
-        print(f"Checkpoint saved: {filename}")
+        print(f"--resume auto: {path or 'no checkpoint found, starting from scratch'}")
+    return path
+
+
+def save_checkpoint(args, step, model, optimizer, ema_model=None, writer=None, scheduler=None, trainer=None):
+    # Must be called on every rank: with --shard zero/fsdp, the full state is
+    # gathered to rank 0 collectively, and so are the RNG states of all ranks.
+    state = {
+        'model': sharding.model_state_dict(model),
+        'optimizer': sharding.optimizer_state_dict(model, optimizer),
+        'step': step,
+        'config': model_config(args),
+    }
+    if ema_model is not None:
+        state['ema_model'] = sharding.model_state_dict(ema_model)
+    if scheduler is not None:
+        state['scheduler'] = scheduler.state_dict()
+    if trainer is not None:
+        state['trainer'] = trainer.state_dict()
+        state['rng'] = gather_rng_states()
+        if trainer.comm_state is not None:
+            # Per-rank PowerSGD state, written by each rank next to the checkpoint
+            path = os.path.join(checkpoint_dir(args), f"{checkpoint_prefix(args)}_{step}.pth")
+            comm_hooks.save_state(trainer.comm_state, path)
+    if dist_util.is_main_process():
+        if writer is None:
+            writer = CheckpointWriter(checkpoint_dir(args), async_save=False)
+        writer.save(state, checkpoint_prefix(args), step)
 
 
 def load_checkpoint(ckpt_path, model=None, optimizer=None, ema_model=None):
     if dist_util.is_main_process():
         print('==> Resuming from checkpoint..')
     assert os.path.exists(ckpt_path), 'Error: checkpoint {} not found'.format(ckpt_path)
-    checkpoint = torch.load(ckpt_path)
+    # Only read what will be loaded, e.g. just the EMA weights for evaluation
+    keys = ['step'] + [k for k, v in (('model', model), ('optimizer', optimizer), ('ema_model', ema_model)) if v is not None]
+    if optimizer is not None:
+        # Resuming training: also the state restored by restore_training_state()
+        keys += ['scheduler', 'trainer', 'rng']
+    checkpoint = dist_util.load_state_dict(ckpt_path, keys=keys)
+    if optimizer is not None:
+        # Where restore_training_state() finds the per-rank comm hook states
+        checkpoint['path'] = ckpt_path
     if model:
-        model.load_state_dict(checkpoint['model'])
+        sharding.load_model_state_dict(model, checkpoint['model'])
     if optimizer:
-        optimizer.load_state_dict(checkpoint['optimizer'])
+        sharding.load_optimizer_state_dict(model, optimizer, checkpoint['optimizer'])
     if ema_model and 'ema_model' in checkpoint:
-        ema_model.load_state_dict(checkpoint['ema_model'])
+        sharding.load_model_state_dict(ema_model, checkpoint['ema_model'])
     return checkpoint
 
 
+def restore_training_state(checkpoint, scheduler, trainer):
+    """
+    Restore the scheduler, the trainer (AMP scale, EMA step, data position)
+    and this rank's RNG and comm hook states. Call after the trainer is built, just before
+    the first resumed step. Checkpoints without this state are left as is.
+    """
+    if 'scheduler' in checkpoint:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    if 'trainer' in checkpoint:
+        trainer.load_state_dict(checkpoint['trainer'])
+    if trainer.comm_state is not None and 'path' in checkpoint:
+        comm_hooks.load_state(trainer.comm_state, checkpoint['path'], trainer.device)
+    if 'rng' in checkpoint:
+        rank = dist.get_rank() if dist.is_initialized() else 0
+        world_size = dist.get_world_size() if dist.is_initialized() else 1
+        if len(checkpoint['rng']) == world_size:
+            set_rng_state(checkpoint['rng'][rank])
+        elif dist_util.is_main_process():
+            print(f"Checkpoint has RNG states of {len(checkpoint['rng'])} ranks, running on {world_size}: not restored")
+
+
 def generate_samples(args, step, device, eval_model, sample_diffusion, save_grid=False):
     """Sample images from the model and either save them as a grid or for evaluation."""
     classifier = Classifier(args, device, eval_model) if args.use_classifier else None